@@ -0,0 +1,46 @@
+"""
+Report recall and memory of quantized embeddings search, the quantized
+index alone and together with the float32 vectors and HNSW graph it is
+added to.
+
+Usage:
+    uv run python devtools/bench_quant.py [collection] [config_path]
+
+Without arguments runs on synthetic clustered vectors, otherwise on the
+embeddings of the given Chroma collection.
+"""
+
+import json
+import sys
+
+import numpy as np
+from numpy.typing import NDArray
+
+from botglue.llore.quant import benchmark_recall
+
+
+def load_vectors(argv: list[str]) -> NDArray[np.float32]:
+    if len(argv) == 0:
+        rng = np.random.default_rng(0)
+        centers = rng.normal(size=(64, 384))
+        v = centers[rng.integers(0, 64, 50_000)] + 0.3 * rng.normal(size=(50_000, 384))
+        return (v / np.linalg.norm(v, axis=1, keepdims=True)).astype(np.float32)
+    from botglue.llore.pipeline import Llore
+    from botglue.llore.vector import get_vector_collection
+
+    llore = Llore(argv[1]) if len(argv) > 1 else Llore()
+    db = get_vector_collection(llore.config, argv[0])
+    return np.asarray(db.get(include=["embeddings"])["embeddings"], dtype=np.float32)
+
+
+def main(argv: list[str]) -> int:
+    vectors = load_vectors(argv)
+    queries, vectors = vectors[:200], vectors[200:]
+    for dtype in ("float16", "int8"):
+        report = benchmark_recall(vectors, queries, k=4, dtype=dtype, rescore_candidates=32)
+        print(json.dumps(report))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
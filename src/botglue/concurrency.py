@@ -0,0 +1,244 @@
+import asyncio
+import threading
+import time
+from collections import deque
+from collections.abc import Awaitable, Callable
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Generic, TypeVar
+
+from botglue.deadline import DeadlineExceeded, clear_deadline, remaining_time
+from botglue.metrics import REGISTRY, Counter, Gauge, Histogram, MetricsRegistry
+from botglue.timing import Timings, record, timings
+
+T = TypeVar("T")
+
+
+class ExecutorBusy(Exception):
+    """Raised when a `BoundedExecutor` has no room left in its queue"""
+
+
+class BoundedExecutor:
+    """Dedicated thread pool for blocking calls that must not run on the event loop.
+
+    At most `max_workers` calls run at once and at most `max_queue` more wait for
+    a worker; beyond that `run()` fails fast with `ExecutorBusy`. Queue depth,
+    active workers, queue wait and run time are reported as metrics labeled with
+    the executor name.
+    """
+
+    name: str
+    max_workers: int
+    max_queue: int
+    _pool: ThreadPoolExecutor
+    _lock: threading.Lock
+    _queued: int
+    _active: int
+    _queue_depth: Gauge
+    _active_gauge: Gauge
+    _rejected: Counter
+    _wait: Histogram
+    _run: Histogram
+
+    def __init__(
+        self,
+        name: str,
+        max_workers: int = 4,
+        max_queue: int = 64,
+        registry: MetricsRegistry = REGISTRY,
+    ):
+        self.name = name
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+        self._lock = threading.Lock()
+        self._queued = 0
+        self._active = 0
+        self._queue_depth = registry.gauge("executor_queue_depth", "Calls waiting for a worker")
+        self._active_gauge = registry.gauge("executor_active", "Calls running on a worker")
+        self._rejected = registry.counter("executor_rejected_total", "Calls rejected as busy")
+        self._wait = registry.histogram("executor_queue_wait_seconds", "Time spent in queue")
+        self._run = registry.histogram("executor_run_seconds", "Time spent running")
+
+    @property
+    def queued(self) -> int:
+        return self._queued
+
+    @property
+    def active(self) -> int:
+        return self._active
+
+    def _update(self, queued: int, active: int) -> None:
+        with self._lock:
+            self._update_locked(queued, active)
+
+    def _update_locked(self, queued: int, active: int) -> None:
+        self._queued += queued
+        self._active += active
+        self._queue_depth.set(self._queued, executor=self.name)
+        self._active_gauge.set(self._active, executor=self.name)
+
+    async def run(self, fn: Callable[..., T], *args: Any) -> T:
+        """Calls still queued at the deadline of the request are not run"""
+        with self._lock:  # checked and taken at once, callers may be on other threads
+            if self._queued + self._active >= self.max_workers + self.max_queue:
+                self._rejected.inc(executor=self.name)
+                raise ExecutorBusy(self.name, self._queued, self._active)
+            self._update_locked(1, 0)
+        submitted = time.monotonic()
+        left = remaining_time()
+
+        def call() -> T:
+            started = time.monotonic()
+            self._update(-1, 1)
+            self._wait.observe(started - submitted, executor=self.name)
+            try:
+                if left is not None and started - submitted >= left:
+                    raise DeadlineExceeded(self.name)  # nobody waits for the result
+                return fn(*args)
+            finally:
+                self._run.observe(time.monotonic() - started, executor=self.name)
+                self._update(0, -1)
+
+        future = self._pool.submit(call)
+        try:
+            return await asyncio.wrap_future(future)
+        except asyncio.CancelledError:
+            if future.cancel():  # never started, release its queue slot
+                self._update(-1, 0)
+            raise
+
+    def shutdown(self, wait: bool = False) -> None:
+        self._pool.shutdown(wait=wait, cancel_futures=True)
+
+
+class _Flight(Generic[T]):
+    task: "asyncio.Future[T]"
+    waiters: int
+    # spans of the call, added to the timings of every caller
+    timings: Timings
+
+    def __init__(self, task: "asyncio.Future[T]", timings: Timings):
+        self.task = task
+        self.waiters = 0
+        self.timings = timings
+
+
+class SingleFlight(Generic[T]):
+    """Coalesce concurrent calls with the same key into one in-flight call.
+
+    Callers that arrive while a call is running await its result instead of
+    starting their own. A caller being cancelled does not affect the others,
+    the call itself is cancelled only when nobody waits for it anymore.
+
+    The call runs without the deadline and timings of the caller that
+    started it, each caller waits only until its own deadline. So the call
+    lives as long as the longest deadline of its callers, or as needed if
+    one of them has none.
+    """
+
+    name: str
+    _flights: dict[str, _Flight[T]]
+    _calls: Counter
+    _coalesced: Counter
+
+    def __init__(self, name: str, registry: MetricsRegistry = REGISTRY):
+        self.name = name
+        self._flights = {}
+        self._calls = registry.counter("single_flight_calls_total", "Coalesced calls started")
+        self._coalesced = registry.counter(
+            "single_flight_coalesced_total", "Calls that joined one already in flight"
+        )
+
+    def __len__(self) -> int:
+        return len(self._flights)
+
+    def _forget(self, key: str, flight: _Flight[T]) -> None:
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+
+    async def run(self, key: str, fn: Callable[[], Awaitable[T]]) -> T:
+        spans = Timings()
+
+        async def detached() -> T:
+            # the task has a copy of the caller's context, only that is reset
+            clear_deadline()
+            with timings(spans):
+                return await fn()
+
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = _Flight(asyncio.ensure_future(detached()), spans)
+            self._flights[key] = flight
+            flight.task.add_done_callback(lambda _: self._forget(key, flight))
+            self._calls.inc(name=self.name)
+        else:
+            self._coalesced.inc(name=self.name)
+        flight.waiters += 1
+        wait = asyncio.timeout(remaining_time())
+        try:
+            async with wait:
+                return await asyncio.shield(flight.task)
+        except TimeoutError:
+            if wait.expired():
+                raise DeadlineExceeded(self.name, key) from None
+            raise
+        finally:
+            if flight.task.done():
+                for name, seconds in flight.timings.spans.items():
+                    record(name, seconds)
+            flight.waiters -= 1
+            if flight.waiters == 0 and not flight.task.done():
+                self._forget(key, flight)
+                flight.task.cancel()
+
+
+class RouteLimit:
+    """Admission control of a route: at most `max_concurrency` requests are
+    handled at once and at most `max_queue` more wait for a slot in arrival
+    order. Requests beyond that are shed with 503 and `Retry-After`.
+    """
+
+    max_concurrency: int
+    max_queue: int
+    retry_after: float
+    active: int
+
+    def __init__(self, max_concurrency: int, max_queue: int = 0, retry_after: float = 1.0):
+        assert max_concurrency >= 1 and max_queue >= 0
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.retry_after = retry_after
+        self.active = 0
+        self._waiters: deque[asyncio.Future[None]] = deque()
+
+    @property
+    def queued(self) -> int:
+        return len(self._waiters)
+
+    async def acquire(self) -> bool:
+        """Wait for a slot, False without waiting if the queue is full"""
+        if self.active < self.max_concurrency and not self._waiters:
+            self.active += 1
+            return True
+        if len(self._waiters) >= self.max_queue:
+            return False
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.append(future)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.cancelled():
+                self._waiters.remove(future)
+            else:  # the slot was handed over already
+                self.release()
+            raise
+        return True
+
+    def release(self) -> None:
+        """Hand the slot over to the first waiter or free it"""
+        while self._waiters:
+            future = self._waiters.popleft()
+            if not future.done():
+                future.set_result(None)
+                return
+        self.active -= 1
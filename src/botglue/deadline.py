@@ -0,0 +1,48 @@
+import time
+from collections.abc import Generator
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+_DEADLINE: ContextVar[float | None] = ContextVar("deadline", default=None)
+# upstream requests outlive an abandoned deadline by that much, so the handler
+# answers 504 rather than the upstream client timing out first
+DEADLINE_GRACE_SECONDS = 1.0
+
+
+class DeadlineExceeded(TimeoutError):
+    """Raised instead of starting work after the request's deadline"""
+
+
+def remaining_time() -> float | None:
+    """Seconds left until the deadline of the current request, None without one"""
+    when = _DEADLINE.get()
+    return None if when is None else when - time.monotonic()
+
+
+@contextmanager
+def deadline(seconds: float | None) -> Generator[None, None, None]:
+    """Deadline `seconds` from now for the code within and the tasks it
+    creates. A nested deadline can only shorten the outer one.
+
+    >>> with deadline(10):
+    ...     with deadline(60):
+    ...         round(remaining_time())
+    10
+    >>> remaining_time() is None
+    True
+    """
+    when = None if seconds is None else time.monotonic() + seconds
+    outer = _DEADLINE.get()
+    if when is None or (outer is not None and outer < when):
+        when = outer
+    token = _DEADLINE.set(when)
+    try:
+        yield
+    finally:
+        _DEADLINE.reset(token)
+
+
+def clear_deadline() -> None:
+    """Drop the deadline of the current context, for a task that outlives
+    the request that created it"""
+    _DEADLINE.set(None)
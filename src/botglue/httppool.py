@@ -0,0 +1,304 @@
+import asyncio
+import importlib.util
+import json
+import logging
+import socket
+import time
+from collections.abc import AsyncIterator, Callable
+from pathlib import Path
+from typing import Any
+
+from tornado.httpclient import AsyncHTTPClient, HTTPClientError, HTTPRequest, HTTPResponse
+from tornado.netutil import Resolver
+from typing_extensions import override
+
+from botglue.deadline import DEADLINE_GRACE_SECONDS, DeadlineExceeded, remaining_time
+from botglue.metrics import REGISTRY, Gauge, Histogram, MetricsRegistry
+from botglue.periodic import Moment
+from botglue.timing import record
+
+log = logging.getLogger(__name__)
+
+
+def _unix_client(path: str | Path, **kwargs: Any) -> AsyncHTTPClient:
+    socket_path = str(path)
+
+    class UnixResolver(Resolver):
+        """Resolves every host to the Unix socket at `path`, for the `resolver`
+        of the simple `AsyncHTTPClient`. The host of the URL is still sent in
+        the `Host` header."""
+
+        @override
+        async def resolve(
+            self, host: str, port: int, family: socket.AddressFamily = socket.AF_UNSPEC
+        ) -> list[tuple[int, Any]]:
+            return [(socket.AF_UNIX, socket_path)]
+
+    return AsyncHTTPClient(force_instance=True, resolver=UnixResolver(), **kwargs)
+
+
+class HttpPool:
+    """Dedicated `AsyncHTTPClient` with its own concurrency limit and timeouts,
+    so slow upstreams do not hold slots of Tornado's shared client.
+
+    Requests over `max_clients` wait in this pool; the wait is reported
+    separately from upstream latency. `keep_alive` is honoured only by the curl
+    client, the simple client opens a connection per request. With
+    `unix_socket` all requests go to that socket whatever the URL host.
+
+    A cancelled fetch keeps its slot until the client is done with the
+    request. Streamed requests are aborted on their next chunk, the others
+    run until the upstream answers or `request_timeout`.
+    """
+
+    name: str
+    max_clients: int
+    connect_timeout: float | None
+    request_timeout: float | None
+    use_curl: bool
+    keep_alive: bool
+    unix_socket: str | None
+    _loop: asyncio.AbstractEventLoop | None
+    _client: AsyncHTTPClient | None
+    _slots: asyncio.Semaphore | None
+    _queued: Gauge
+    _in_flight: Gauge
+    _wait: Histogram
+    _upstream: Histogram
+    _ttfb: Histogram
+
+    def __init__(
+        self,
+        name: str,
+        max_clients: int = 10,
+        connect_timeout: float | None = None,
+        request_timeout: float | None = None,
+        use_curl: bool = False,
+        keep_alive: bool = True,
+        unix_socket: str | Path | None = None,
+        registry: MetricsRegistry = REGISTRY,
+    ):
+        if use_curl and importlib.util.find_spec("pycurl") is None:
+            raise ValueError(f"{name}: use_curl requires pycurl to be installed")
+        self.name = name
+        self.max_clients = max_clients
+        self.connect_timeout = connect_timeout
+        self.request_timeout = request_timeout
+        self.use_curl = use_curl
+        self.keep_alive = keep_alive
+        self.unix_socket = None if unix_socket is None else str(unix_socket)
+        self._loop = None
+        self._client = None
+        self._slots = None
+        self._queued = registry.gauge("http_pool_queued", "Requests waiting for a pool slot")
+        self._in_flight = registry.gauge("http_pool_in_flight", "Requests sent upstream")
+        self._wait = registry.histogram("http_pool_queue_wait_seconds", "Wait for a pool slot")
+        self._upstream = registry.histogram("http_pool_upstream_seconds", "Upstream latency")
+        self._ttfb = registry.histogram("http_pool_ttfb_seconds", "Time to the first response byte")
+
+    def _bind(self) -> tuple[AsyncHTTPClient, asyncio.Semaphore]:
+        """Client and slots are bound to the running loop, recreated if it changes"""
+        loop = asyncio.get_running_loop()
+        if self._client is None or self._slots is None or self._loop is not loop:
+            if self.use_curl:
+                from tornado.curl_httpclient import CurlAsyncHTTPClient
+
+                client = CurlAsyncHTTPClient(force_instance=True, max_clients=self.max_clients)
+            elif self.unix_socket is not None:
+                client = _unix_client(self.unix_socket, max_clients=self.max_clients)
+            else:
+                client = AsyncHTTPClient(force_instance=True, max_clients=self.max_clients)
+            self._loop, self._client = loop, client
+            self._slots = asyncio.Semaphore(self.max_clients)
+        return self._client, self._slots
+
+    def prepare(self, request: HTTPRequest) -> HTTPRequest:
+        if self.connect_timeout is not None and request.connect_timeout is None:
+            request.connect_timeout = self.connect_timeout
+        if self.request_timeout is not None and request.request_timeout is None:
+            request.request_timeout = self.request_timeout
+        if self.use_curl and (not self.keep_alive or self.unix_socket is not None):
+            keep_alive, unix_socket = self.keep_alive, self.unix_socket
+
+            def prepare_curl(curl: Any) -> None:
+                import pycurl  # pyright: ignore[reportMissingModuleSource]
+
+                if not keep_alive:
+                    curl.setopt(pycurl.FORBID_REUSE, 1)
+                if unix_socket is not None:
+                    curl.setopt(pycurl.UNIX_SOCKET_PATH, unix_socket)
+
+            request.prepare_curl_callback = prepare_curl
+        return request
+
+    def _time_first_byte(self, request: HTTPRequest, started: float) -> None:
+        """Record when the first response header arrives. The curl client
+        reports it in `time_info` instead, a `header_callback` would stop it
+        from parsing headers."""
+        if self.use_curl:
+            return
+        callback = request.header_callback
+        first = True
+
+        def on_header(line: str) -> None:
+            nonlocal first
+            if first:
+                first = False
+                self._ttfb.observe(time.monotonic() - started, pool=self.name)
+            if callback is not None:
+                callback(line)
+
+        request.header_callback = on_header
+
+    def _abortable(self, request: HTTPRequest) -> Callable[[], None]:
+        """Make the callbacks of `request` fail once the returned function is
+        called, which makes the client drop the connection"""
+        aborted = False
+
+        def check() -> None:
+            if aborted:
+                raise HTTPClientError(599, "Request cancelled")
+
+        def wrap(callback: Callable[[Any], None] | None) -> Callable[[Any], None] | None:
+            if callback is None:
+                return None
+
+            def checked(data: Any) -> None:
+                check()
+                callback(data)
+
+            return checked
+
+        request.header_callback = wrap(request.header_callback)
+        request.streaming_callback = wrap(request.streaming_callback)
+
+        def abort() -> None:
+            nonlocal aborted
+            aborted = True
+
+        return abort
+
+    async def fetch(self, request: HTTPRequest, raise_error: bool = True) -> HTTPResponse:
+        client, slots = self._bind()
+        request = self.prepare(request)
+        queued = time.monotonic()
+        self._queued.inc(pool=self.name)
+        try:
+            await slots.acquire()
+        finally:
+            self._queued.dec(pool=self.name)
+        started = time.monotonic()
+        self._wait.observe(started - queued, pool=self.name)
+        record("pool_wait", started - queued)
+        if (left := remaining_time()) is not None:
+            if left <= 0:
+                slots.release()
+                raise DeadlineExceeded(self.name, request.url)
+            timeout = left + DEADLINE_GRACE_SECONDS
+            request.request_timeout = min(request.request_timeout or timeout, timeout)
+        self._time_first_byte(request, started)
+        abort = self._abortable(request)
+        self._in_flight.inc(pool=self.name)
+        future = client.fetch(request, raise_error=raise_error)
+
+        def done(future: "asyncio.Future[HTTPResponse]") -> None:
+            # the slot is held until the client is done, also for a cancelled fetch
+            if not future.cancelled():
+                future.exception()  # retrieved, even if nobody awaits it anymore
+            self._in_flight.dec(pool=self.name)
+            slots.release()
+
+        future.add_done_callback(done)
+        try:
+            response = await asyncio.shield(future)
+            if self.use_curl and "starttransfer" in response.time_info:
+                self._ttfb.observe(response.time_info["starttransfer"], pool=self.name)
+            return response
+        except asyncio.CancelledError:
+            abort()
+            raise
+        finally:
+            self._upstream.observe(time.monotonic() - started, pool=self.name)
+            record("upstream", time.monotonic() - started)
+            log.info(
+                f"{self.name}: queued {started - queued:.3f}s, "
+                f"upstream {time.monotonic() - started:.3f}s"
+            )
+
+    def close(self) -> None:
+        if self._client is not None:
+            self._client.close()
+            self._client = None
+
+
+async def get_json(
+    url: str | HTTPRequest,
+    to_json: Callable[[str | bytes | bytearray], Any] = json.loads,
+    pool: HttpPool | None = None,
+    unix_socket: str | Path | None = None,
+) -> Any:
+    """Fetch `url` and parse its body, through `pool` if given, else over
+    `unix_socket` if given, else with Tornado's shared client"""
+    moment = Moment.start()
+    if pool is None and unix_socket is not None:
+        client = _unix_client(unix_socket)
+        try:
+            response = await client.fetch(url)
+        finally:
+            client.close()
+    elif pool is None:
+        response = await AsyncHTTPClient().fetch(url)
+    else:
+        response = await pool.fetch(url if isinstance(url, HTTPRequest) else HTTPRequest(url))
+    log.info(f"Request took {moment.elapsed()}s")
+    log.debug(f"Response: {response.body}")
+    return to_json(response.body)
+
+
+async def fetch_lines(request: HTTPRequest, pool: HttpPool | None = None) -> AsyncIterator[bytes]:
+    """Fetch `request` yielding body lines as soon as they arrive (SSE, NDJSON).
+    Error responses are not yielded, `HTTPClientError` is raised instead."""
+    moment = Moment.start()
+    queue: asyncio.Queue[bytes | None] = asyncio.Queue()
+    buffer = bytearray()
+    error_body = bytearray()
+    status: list[int] = []
+
+    def on_header(line: str) -> None:
+        if line.startswith("HTTP/"):
+            status[:] = [int(line.split(" ", 2)[1])]
+
+    def on_chunk(chunk: bytes) -> None:
+        if status and status[0] >= 400:
+            error_body.extend(chunk)
+            return
+        buffer.extend(chunk)
+        *lines, rest = buffer.split(b"\n")
+        buffer[:] = rest
+        for line in lines:
+            queue.put_nowait(bytes(line.rstrip(b"\r")))
+
+    request.header_callback = on_header
+    request.streaming_callback = on_chunk
+    if pool is None:
+        fetch = asyncio.ensure_future(AsyncHTTPClient().fetch(request, raise_error=False))
+    else:
+        fetch = asyncio.ensure_future(pool.fetch(request, raise_error=False))
+    fetch.add_done_callback(lambda _: queue.put_nowait(None))
+    first = True
+    try:
+        while (line := await queue.get()) is not None:
+            if first:
+                log.info(f"First line took {moment.capture('first line').elapsed()}s")
+                first = False
+            yield line
+        response = fetch.result()
+        if response.error is not None:
+            message = bytes(error_body).decode(errors="replace") or None
+            raise HTTPClientError(response.code, message=message, response=response)
+        if buffer:
+            yield bytes(buffer)
+        log.info(f"Streaming request took {moment.capture('done').elapsed()}s")
+    finally:
+        if not fetch.done():
+            fetch.cancel()
@@ -1,7 +1,80 @@
+import os
+import socket
+from collections.abc import Generator, Mapping
+from typing import Any
+
 import requests
 import streamlit as st
+from requests import PreparedRequest
+from requests.adapters import HTTPAdapter
+from typing_extensions import override
+from urllib3 import HTTPConnectionPool
+from urllib3.connection import HTTPConnection
+
+from botglue.llore.api import ChatChunk, ChatMsg, ChatRequest, ChatResponse, Models
+
+# `LLORE_SOCKET` is the Unix socket of `botglue serve --unix-socket`, it takes
+# over the host and port of `LLORE_URL`
+LLORE_URL = os.environ.get("LLORE_URL", "http://localhost:7532").rstrip("/")
+LLORE_SOCKET = os.environ.get("LLORE_SOCKET")
+
+
+class UnixConnection(HTTPConnection):
+    socket_path: str
+
+    def __init__(self, *args: Any, socket_path: str, **kwargs: Any):
+        super().__init__(*args, **kwargs)
+        self.socket_path = socket_path
+
+    @override
+    def _new_conn(self) -> socket.socket:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if isinstance(self.timeout, (int, float)):
+            sock.settimeout(self.timeout)
+        sock.connect(self.socket_path)
+        return sock
+
+
+class UnixConnectionPool(HTTPConnectionPool):
+    # the base declares a union of urllib3's private connection protocols
+    ConnectionCls: type[HTTPConnection] = UnixConnection  # pyright: ignore[reportIncompatibleVariableOverride]
+
+
+class UnixAdapter(HTTPAdapter):
+    """Sends every request of a session to the Unix socket at `socket_path`"""
 
-from botglue.llore.api import ChatMsg, ChatRequest, ChatResponse, Models
+    pool: UnixConnectionPool
+
+    def __init__(self, socket_path: str):
+        super().__init__()
+        self.pool = UnixConnectionPool("localhost", socket_path=socket_path)
+
+    @override
+    def get_connection_with_tls_context(
+        self,
+        request: PreparedRequest,
+        verify: bool | str | None,
+        proxies: Mapping[str, str] | None = None,
+        cert: str | tuple[str, str] | None = None,
+    ) -> HTTPConnectionPool:
+        return self.pool
+
+    @override
+    def request_url(self, request: PreparedRequest, proxies: Mapping[str, str] | None) -> str:
+        return request.path_url
+
+    @override
+    def close(self) -> None:
+        self.pool.close()
+        super().close()
+
+
+@st.cache_resource
+def llore_session() -> requests.Session:
+    session = requests.Session()
+    if LLORE_SOCKET:
+        session.mount("http://", UnixAdapter(LLORE_SOCKET))
+    return session
 
 
 def init_session_state():
@@ -12,8 +85,7 @@ def init_session_state():
 
 
 def send_models_request() -> Models:
-    url = "http://localhost:7532/models"
-    response = requests.get(url)
+    response = llore_session().get(f"{LLORE_URL}/models")
     if response.status_code != 200:
         raise Exception(f"Error: {response.status_code} - {response.text}")
     return Models.model_validate_json(response.content)
@@ -22,14 +94,31 @@ def send_models_request() -> Models:
 def send_chat_request(
     messages: list[ChatMsg], bot_name: str | None = None, llm_name: str | None = None
 ) -> ChatResponse:
-    url = "http://localhost:7532/chats"
     request = ChatRequest(messages=messages, bot_name=bot_name, llm_name=llm_name)
-    response = requests.post(url, json=request.model_dump(mode="json"))
+    response = llore_session().post(f"{LLORE_URL}/chats", json=request.model_dump(mode="json"))
     if response.status_code != 200:
         raise Exception(f"Error: {response.status_code} - {response.text}")
     return ChatResponse.model_validate_json(response.content)
 
 
+def stream_chat_request(
+    messages: list[ChatMsg], bot_name: str | None = None, llm_name: str | None = None
+) -> Generator[str, None, None]:
+    request = ChatRequest(messages=messages, bot_name=bot_name, llm_name=llm_name, stream=True)
+    with llore_session().post(
+        f"{LLORE_URL}/chats", json=request.model_dump(mode="json"), stream=True
+    ) as response:
+        if response.status_code != 200:
+            raise Exception(f"Error: {response.status_code} - {response.text}")
+        for line in response.iter_lines():
+            if line:
+                chunk = ChatChunk.model_validate_json(line)
+                yield chunk.delta
+                if chunk.done:
+                    return
+        raise Exception("Error: the reply was cut off, the stream ended before it was done")
+
+
 st.title("botglue Chat")
 
 init_session_state()
@@ -38,6 +127,7 @@ init_session_state()
 with st.sidebar:
     bot_name = st.selectbox("Bot", options=[None, *st.session_state.models.bots])
     llm_name = st.selectbox("LLM", options=[None, *st.session_state.models.llms])
+    stream = st.toggle("Stream", value=True)
     if st.button("Clear Chat"):
         st.session_state.messages = []
         st.rerun()
@@ -61,13 +151,22 @@ if prompt := st.chat_input("What's on your mind?"):
 
     # Get bot response
     try:
-        response = send_chat_request(
-            messages=st.session_state.messages, bot_name=bot_name, llm_name=llm_name
-        )
-
-        # Add assistant response to chat history
-        st.session_state.messages.append(response.generation)
-        display_message(response.generation)
+        if stream:
+            with st.chat_message("assistant"):
+                content = st.write_stream(
+                    stream_chat_request(
+                        messages=st.session_state.messages, bot_name=bot_name, llm_name=llm_name
+                    )
+                )
+            st.session_state.messages.append(ChatMsg(role="assistant", content=str(content)))
+        else:
+            response = send_chat_request(
+                messages=st.session_state.messages, bot_name=bot_name, llm_name=llm_name
+            )
+
+            # Add assistant response to chat history
+            st.session_state.messages.append(response.generation)
+            display_message(response.generation)
 
     except Exception as e:
         st.error(f"Error: {str(e)}")
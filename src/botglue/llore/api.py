@@ -1,4 +1,4 @@
-from typing import Any
+from typing import Any, Literal
 
 from pydantic import BaseModel, Field, model_validator
 
@@ -28,6 +28,10 @@ class ChatRequest(BaseModel):
     bot_name: str | None = Field(default=None)
     llm_name: str | None = Field(default=None)
     messages: list[ChatMsg]
+    # respond with newline delimited `ChatChunk`s as tokens arrive
+    stream: bool = Field(default=False)
+    # rate limited requests of "interactive" priority are sent ahead of "batch" ones
+    priority: Literal["interactive", "batch"] = Field(default="interactive")
 
     @model_validator(mode="before")
     @classmethod
@@ -39,3 +43,11 @@ class ChatRequest(BaseModel):
 
 class ChatResponse(BaseModel):
     generation: ChatMsg
+
+
+class ChatChunk(BaseModel):
+    """Piece of a streamed generation, the last one has `done=True`"""
+
+    delta: str
+    role: str = Field(default="assistant")
+    done: bool = Field(default=False)
@@ -0,0 +1,147 @@
+import asyncio
+import json
+import logging
+import time
+from collections.abc import Iterator
+from datetime import UTC, datetime
+from pathlib import Path
+from typing import Any
+
+from pydantic import BaseModel, Field
+
+from botglue.llore.api import ChatRequest, ChatResponse
+from botglue.llore.pipeline import Llore
+from botglue.ratelimit import Priority
+
+logger = logging.getLogger(__name__)
+
+
+class BatchResult(BaseModel):
+    """Line of the batch output, `id` is taken from the input line or is its
+    line number"""
+
+    id: str
+    response: ChatResponse | None = Field(default=None)
+    error: str | None = Field(default=None)
+    started: datetime
+    # queued until a worker was free, then running the request
+    wait_seconds: float
+    seconds: float
+
+
+class BatchSummary(BaseModel):
+    total: int = 0
+    skipped: int = 0
+    succeeded: int = 0
+    failed: int = 0
+    seconds: float = 0.0
+
+
+def completed_ids(output: Path) -> set[str]:
+    """Ids answered without an error by a previous run into `output`"""
+    done: set[str] = set()
+    if not output.exists():
+        return done
+    with output.open() as f:
+        for line in f:
+            try:
+                result = BatchResult.model_validate_json(line)
+            except ValueError:
+                continue  # partially written last line of an interrupted run
+            if result.error is None:
+                done.add(result.id)
+    return done
+
+
+def read_requests(input: Path) -> Iterator[tuple[str, str]]:
+    """`(id, line)` of the non-empty lines. Lines that are not JSON objects
+    are identified by their line number, they fail when run."""
+    with input.open() as f:
+        for n, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                data: Any = json.loads(line)
+            except ValueError:
+                logger.warning(f"Line {n} of {input} is not valid JSON")
+                data = None
+            yield str(data.get("id", n) if isinstance(data, dict) else n), line
+
+
+async def run_request(llore: Llore, line: str, priority: Priority) -> ChatResponse:
+    request = ChatRequest.model_validate_json(line)
+    if request.bot_name is not None:
+        return await llore.query_bot(
+            request.bot_name, request.messages, llm_name=request.llm_name, priority=priority
+        )
+    assert request.llm_name is not None
+    return await llore.query_llm(request.llm_name, request.messages, priority=priority)
+
+
+async def run_batch(
+    llore: Llore,
+    input: Path,
+    output: Path,
+    concurrency: int = 8,
+    priority: Priority = "batch",
+) -> BatchSummary:
+    """Run `ChatRequest` lines of `input` with at most `concurrency` in flight,
+    appending `BatchResult` lines to `output` as they complete.
+
+    Requests already answered in `output` are skipped, so an interrupted run
+    resumes where it stopped. Failed ones are retried and get a new line.
+    """
+    summary = BatchSummary()
+    start = time.monotonic()
+    done = completed_ids(output)
+    output.parent.mkdir(parents=True, exist_ok=True)
+
+    if output.exists() and output.stat().st_size > 0:
+        with output.open("rb+") as f:
+            f.seek(-1, 2)
+            if f.read(1) != b"\n":
+                f.write(b"\n")  # terminate the partial line of an interrupted run
+
+    # requests with the time they were queued, at most one ahead per worker
+    queue: asyncio.Queue[tuple[str, str, float] | None] = asyncio.Queue(maxsize=concurrency)
+
+    async def produce() -> None:
+        for request_id, line in read_requests(input):
+            summary.total += 1
+            if request_id in done:
+                summary.skipped += 1
+                continue
+            await queue.put((request_id, line, time.monotonic()))
+        for _ in range(concurrency):
+            await queue.put(None)
+
+    with output.open("a") as out:
+
+        async def worker() -> None:
+            while (item := await queue.get()) is not None:
+                request_id, line, queued = item
+                started = datetime.now(UTC)
+                t0 = time.monotonic()
+                result: dict[str, Any] = {}
+                try:
+                    result["response"] = await run_request(llore, line, priority)
+                    summary.succeeded += 1
+                except Exception as e:
+                    logger.warning(f"Request {request_id} failed: {e!r}")
+                    result["error"] = repr(e)
+                    summary.failed += 1
+                record = BatchResult(
+                    id=request_id,
+                    started=started,
+                    wait_seconds=t0 - queued,
+                    seconds=time.monotonic() - t0,
+                    **result,
+                )
+                out.write(record.model_dump_json() + "\n")
+                out.flush()
+
+        await asyncio.gather(produce(), *(worker() for _ in range(concurrency)))
+
+    summary.seconds = time.monotonic() - start
+    logger.info(f"Batch done: {summary.model_dump_json()}")
+    return summary
@@ -0,0 +1,145 @@
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+from datetime import datetime, timedelta
+from pathlib import Path
+
+from tornado.httpclient import HTTPRequest
+
+from botglue.llore.state import execute_sql, open_sqlite_db
+from botglue.llore.state.schema import LlmResponse, create_tables, utc_now
+from botglue.metrics import REGISTRY, Counter, MetricsRegistry
+
+logger = logging.getLogger(__name__)
+
+# writes of cache accesses give up quickly if another writer holds the db
+FLUSH_BUSY_TIMEOUT_MS = 100
+# the default of `sqlite3.connect`, for the other writes
+SQLITE_BUSY_TIMEOUT_MS = 5000
+
+
+def request_key(request: HTTPRequest) -> str:
+    """Hash of the url and the canonical JSON of the request body, headers
+    (auth, timestamps, request ids) are not part of the key
+
+    >>> a = HTTPRequest("http://x/v1", method="POST", body='{"b": 1, "a": [1, 2]}')
+    >>> b = HTTPRequest("http://x/v1", method="POST", body='{"a":[1,2],"b":1}')
+    >>> request_key(a) == request_key(b)
+    True
+    """
+    body = json.loads(request.body) if request.body else None
+    canonical = json.dumps(body, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(f"{request.url}\n{canonical}".encode()).hexdigest()
+
+
+class ResponseCache:
+    """Raw LLM response bodies in the `LlmResponse` table of the state db.
+
+    Blocking sqlite calls, meant to be run off the event loop. Hits only read,
+    their access times and counts are written in batches: before every `put`,
+    which evicts by them, and once `flush_hits` hits are pending. Those writes
+    are best effort, a locked db keeps them pending for the next batch.
+    """
+
+    db_path: Path
+    flush_hits: int
+    _ready: bool
+    _lookups: Counter
+    _accessed: dict[str, tuple[datetime, int]]
+    _lock: threading.Lock
+
+    def __init__(self, db_path: Path, registry: MetricsRegistry = REGISTRY, flush_hits: int = 100):
+        self.db_path = db_path
+        self.flush_hits = flush_hits
+        self._ready = False
+        self._lookups = registry.counter("llm_cache_lookups_total", "Response cache lookups")
+        # cache key -> last access and hits not yet written
+        self._accessed = {}
+        self._lock = threading.Lock()
+
+    def prepare(self) -> None:
+        """Create the db and its tables, once"""
+        if not self._ready:
+            self.db_path.parent.mkdir(parents=True, exist_ok=True)
+            with open_sqlite_db(self.db_path) as conn:
+                create_tables(conn)
+            self._ready = True
+
+    def _open(self):
+        self.prepare()
+        return open_sqlite_db(self.db_path)
+
+    def get(self, key: str, model: str) -> str | None:
+        now = utc_now()
+        with self._open() as conn:
+            found = LlmResponse.select(conn, cache_key=key)
+        entry = found[0] if found else None
+        if entry is None or entry.expires <= now:
+            self._lookups.inc(model=model, result="miss")
+            return None
+        self._lookups.inc(model=model, result="hit")
+        with self._lock:
+            _, hits = self._accessed.get(key, (now, 0))
+            self._accessed[key] = (now, hits + 1)
+            pending = len(self._accessed)
+        if pending >= self.flush_hits:
+            with self._open() as conn:
+                self._flush(conn)
+        return entry.body
+
+    def put(self, key: str, model: str, body: str, ttl: float, max_entries: int) -> None:
+        now = utc_now()
+        entry = LlmResponse(
+            cache_key=key,
+            model=model,
+            created=now,
+            accessed=now,
+            expires=now + timedelta(seconds=ttl),
+            body=body,
+        )
+        with self._open() as conn:
+            self._flush(conn)
+            entry.save(conn)
+            self._evict(conn, model, max_entries)
+            conn.commit()
+
+    def _flush(self, conn: sqlite3.Connection) -> None:
+        """Write the pending accesses of hits, keep them if the db is locked"""
+        with self._lock:
+            accessed, self._accessed = self._accessed, {}
+        if not accessed:
+            return
+        rows = [(t.isoformat(), hits, key) for key, (t, hits) in accessed.items()]
+        conn.execute(f"PRAGMA busy_timeout = {FLUSH_BUSY_TIMEOUT_MS}")
+        try:
+            conn.executemany(
+                "UPDATE LlmResponse SET accessed = MAX(accessed, ?), hits = hits + ? "
+                "WHERE cache_key = ?",
+                rows,
+            )
+            conn.commit()
+        except sqlite3.OperationalError as e:
+            conn.rollback()
+            logger.debug(f"Cache accesses not written, kept for later: {e}")
+            with self._lock:
+                for key, (t, hits) in accessed.items():
+                    later, more = self._accessed.get(key, (t, 0))
+                    self._accessed[key] = (max(t, later), hits + more)
+        finally:
+            conn.execute(f"PRAGMA busy_timeout = {SQLITE_BUSY_TIMEOUT_MS}")
+
+    def _evict(self, conn: sqlite3.Connection, model: str, max_entries: int) -> None:
+        """Drop expired responses of the model and the least recently used
+        ones beyond `max_entries`"""
+        cursor = conn.cursor()
+        execute_sql(
+            cursor,
+            "DELETE FROM LlmResponse WHERE model = ? AND (expires <= ? OR cache_key IN "
+            "(SELECT cache_key FROM LlmResponse WHERE model = ? "
+            " ORDER BY accessed DESC LIMIT -1 OFFSET ?))",
+            [model, utc_now().isoformat(), model, max_entries],
+        )
+        if cursor.rowcount > 0:
+            logger.debug(f"Evicted {cursor.rowcount} cached responses of {model}")
@@ -1,20 +1,42 @@
+import asyncio
 import base64
 import json
 import logging
+import time
 import uuid
-from collections.abc import Callable
+from collections.abc import AsyncIterator, Awaitable, Callable
 from datetime import datetime
+from functools import partial
 from pathlib import Path
-from typing import Any, Literal
-
-from pydantic import BaseModel, Field
-from tornado.httpclient import HTTPRequest
-
+from typing import Annotated, Any, Literal, TypeVar
+
+from pydantic import BaseModel, Field, PrivateAttr, model_validator
+from tornado.httpclient import HTTPClientError, HTTPRequest
+
+from botglue.httppool import HttpPool, fetch_lines, get_json
+from botglue.llore.api import ChatChunk
+from botglue.llore.cache import ResponseCache, request_key
+from botglue.llore.context import count_tokens
+from botglue.llore.history import token_counter
+from botglue.llore.llm import (
+    STREAM_DONE,
+    response_to_chat_result,
+    stream_line_to_chunk,
+    stream_line_usage,
+    usage_tokens,
+)
+from botglue.llore.quant import QuantizationType
+from botglue.llore.stats import LlmMetrics
 from botglue.llore.utils import get_adjust_to_root_modifier, modify_path_attributes
-from botglue.service import get_json
+from botglue.metrics import REGISTRY, MetricsRegistry
+from botglue.ratelimit import Priority, RateLimiter, parse_retry_after
+from botglue.replicas import Replica, ReplicaSet
+from botglue.timing import span
 
 log = logging.getLogger(__name__)
 
+T = TypeVar("T")
+
 
 class ChatModel(BaseModel):
     name: str
@@ -65,23 +87,223 @@ def translate(dialect: Literal["auto", "copilot"], json: Any) -> Any:
         return json
 
 
+class HttpPoolConfig(BaseModel):
+    # concurrent requests to the backend, others wait in the pool's queue
+    max_clients: int = Field(default=10, ge=1)
+    connect_timeout: float = Field(default=20, gt=0)
+    request_timeout: float = Field(default=100, gt=0)
+    # `tornado.curl_httpclient`, requires pycurl
+    use_curl: bool = Field(default=False)
+    # reuse connections between requests, only the curl client keeps them alive
+    keep_alive: bool = Field(default=True)
+
+
+class ReplicaConfig(BaseModel):
+    # more endpoints serving the same model as `url`, balanced by outstanding requests
+    urls: list[str] = Field(default_factory=list)
+    # retries of connection errors and 5xx responses, backoff doubles up to max_backoff
+    retries: int = Field(default=2, ge=0)
+    backoff: float = Field(default=0.1, ge=0)
+    max_backoff: float = Field(default=2.0, ge=0)
+    # consecutive failures that eject an endpoint for `cooldown` seconds
+    failure_threshold: int = Field(default=3, ge=1)
+    cooldown: float = Field(default=30, ge=0)
+
+
+class RoutingConfig(BaseModel):
+    # other `llm_models` asked for the same answer, the first good one wins.
+    # "hedge" asks the next one only when the previous is late or failed,
+    # "race" asks all of them at once
+    mode: Literal["hedge", "race"] = Field(default="hedge")
+    alternates: list[str]
+    # an answer is late after this percentile of the model's recent latencies
+    percentile: float = Field(default=0.95, gt=0, lt=1)
+    min_delay: float = Field(default=0.05, ge=0)
+    # used until enough latencies are observed
+    initial_delay: float = Field(default=2.0, ge=0)
+
+
+class RateLimitConfig(BaseModel):
+    requests_per_second: float | None = Field(default=None, gt=0)
+    # estimated from the prompt and `max_tokens`, corrected by reported usage
+    tokens_per_minute: float | None = Field(default=None, gt=0)
+    burst_seconds: float = Field(default=1.0, gt=0)
+    # waiting requests beyond that are rejected
+    max_queue: int = Field(default=1000, ge=0)
+    # 429s halve the rates, but not below this share of the configured ones
+    min_rate_share: float = Field(default=0.1, gt=0, le=1)
+    # retries of 429 responses, after waiting for Retry-After
+    retries: int = Field(default=2, ge=0)
+
+
+class HistoryConfig(BaseModel):
+    # share of `context_window` the conversation may take, the rest is left for the answer
+    max_share: float = Field(default=0.75, gt=0, le=1)
+    # last messages kept verbatim even if they don't fit
+    keep_last: int = Field(default=1, ge=1)
+    # `llm_models` entry that summarizes dropped turns, they are just dropped if None
+    summarize_with: str | None = Field(default=None)
+    summary_tokens: int = Field(default=256, ge=16)
+
+
+class ResponseCacheConfig(BaseModel):
+    # seconds a cached response is served for
+    ttl: float = Field(default=24 * 3600, gt=0)
+    # least recently used responses of the model are evicted beyond that
+    max_entries: int = Field(default=10_000, ge=1)
+
+
 class LLMModelConfig(BaseModel):
     model_name: str
     dialect: Literal["auto", "copilot"] = Field(default="auto")
     context_window: int | None = Field(default=None)
+    # HuggingFace tokenizer to count tokens with, estimated from length if None
+    tokenizer: str | None = Field(default=None)
+    # compaction of the conversation to fit `context_window`
+    history: HistoryConfig = Field(default_factory=HistoryConfig)
     url: str
     stream: bool = Field(default=False)
     api_key: str | None = Field(default=None)
     basic_auth: BasicAuth | None = Field(default=None)
     params: dict[str, Any] = Field(default_factory=dict)
     headers: dict[str, Any] = Field(default_factory=dict)
+    http: HttpPoolConfig = Field(default_factory=HttpPoolConfig)
+    # opt-in cache of responses in the state db, keyed by the request body
+    cache: ResponseCacheConfig | None = Field(default=None)
+    replicas: ReplicaConfig = Field(default_factory=ReplicaConfig)
+    # hedged or raced requests to other models, for `Llore.query_llm`
+    routing: RoutingConfig | None = Field(default=None)
+    rate_limit: RateLimitConfig | None = Field(default=None)
+    _name: str | None = PrivateAttr(default=None)
+    _registry: MetricsRegistry = PrivateAttr(default_factory=lambda: REGISTRY)
+    _metrics: LlmMetrics | None = PrivateAttr(default=None)
+    _pool: HttpPool | None = PrivateAttr(default=None)
+    _replica_set: ReplicaSet | None = PrivateAttr(default=None)
+    _limiter: RateLimiter | None = PrivateAttr(default=None)
+
+    @property
+    def name(self) -> str:
+        """Key of the model in `Config.llm_models`, `model_name` if standalone"""
+        return self._name or self.model_name
+
+    @name.setter
+    def name(self, name: str) -> None:
+        self._name = name
+
+    @property
+    def registry(self) -> MetricsRegistry:
+        """Registry of the metrics of the model, its pool, replicas and rate limiter"""
+        return self._registry
+
+    @registry.setter
+    def registry(self, registry: MetricsRegistry) -> None:
+        assert self._pool is None and self._replica_set is None, "Set before the first request"
+        self._registry = registry
+        self._metrics = self._limiter = None
+
+    @property
+    def metrics(self) -> LlmMetrics:
+        if self._metrics is None:
+            self._metrics = LlmMetrics(self._registry)
+        return self._metrics
+
+    @property
+    def pool(self) -> HttpPool:
+        if self._pool is None:
+            self._pool = HttpPool(self.name, registry=self._registry, **self.http.model_dump())
+        return self._pool
+
+    @property
+    def replica_set(self) -> ReplicaSet:
+        if self._replica_set is None:
+            params = self.replicas.model_dump(exclude={"urls"})
+            self._replica_set = ReplicaSet(
+                self.name, [self.url, *self.replicas.urls], registry=self._registry, **params
+            )
+        return self._replica_set
+
+    @property
+    def limiter(self) -> RateLimiter | None:
+        if self._limiter is None and self.rate_limit is not None:
+            params = self.rate_limit.model_dump(exclude={"retries"})
+            self._limiter = RateLimiter(self.name, registry=self._registry, **params)
+        return self._limiter
+
+    def history_budget(self) -> int | None:
+        """Tokens the conversation may take, None if the window is unknown"""
+        if self.context_window is None:
+            return None
+        return int(self.context_window * self.history.max_share)
+
+    def estimate_tokens(self, messages: list[dict[str, Any]]) -> int:
+        """Prompt estimate plus the completion limit if one is set in `params`"""
+        prompt = sum(count_tokens(str(m.get("content", ""))) for m in messages)
+        limit = self.params.get("max_tokens", self.params.get("options", {}).get("num_predict"))
+        return prompt + (limit if isinstance(limit, int) and limit > 0 else 0)
+
+    async def warmup(self) -> None:
+        """Load the tokenizer and connect to the backends ahead of the first
+        request, with a GET to each replica URL whose answer is ignored. That
+        warms a connection only with the curl client of `HttpPool`, which
+        keeps it for reuse; the simple client connects for every request."""
+        await asyncio.to_thread(token_counter, self.tokenizer)
+        for replica in self.replica_set.replicas:
+            try:
+                await self.pool.fetch(HTTPRequest(replica.url), raise_error=False)
+            except Exception as e:
+                log.warning(f"{self.name}: can't connect to {replica.url}: {e!r}")
+
+    def throttled(self, error: Exception, attempt: int) -> bool:
+        """Report a 429 to the limiter, True if the request should be retried"""
+        limiter, rate_limit = self.limiter, self.rate_limit
+        if limiter is None or rate_limit is None:
+            return False
+        if not isinstance(error, HTTPClientError) or error.code != 429:
+            return False
+        headers = error.response.headers if error.response is not None else {}
+        limiter.throttled(parse_retry_after(headers.get("Retry-After")))
+        return attempt < rate_limit.retries
+
+    async def limited(
+        self,
+        call: Callable[[], Awaitable[T]],
+        estimate: int,
+        priority: Priority = "interactive",
+    ) -> T:
+        """Run `call` within the model's rate limits, retrying it on 429"""
+        limiter = self.limiter
+        if limiter is None:
+            return await call()
+        attempt = 0
+        while True:
+            await limiter.acquire(estimate, priority)
+            try:
+                result = await call()
+            except Exception as e:
+                if not self.throttled(e, attempt):
+                    raise
+                attempt += 1
+                continue
+            limiter.succeeded()
+            return result
 
-    async def query(
+    def record_usage(self, response: Any, estimate: int) -> None:
+        if (usage := usage_tokens(response)) is not None:
+            self.record_tokens(usage, estimate)
+
+    def record_tokens(self, usage: tuple[int, int], estimate: int) -> None:
+        """Prompt and completion tokens reported by the backend"""
+        self.metrics.usage(self.name, *usage)
+        if self.limiter is not None:
+            self.limiter.settle(estimate, sum(usage))
+
+    def build_request(
         self,
         messages: list[dict[str, Any]],
-        to_json: Callable[[Any], Any] = json.loads,
-        request_timeout: float = 100,
-    ) -> Any:
+        request_timeout: float | None = None,
+        stream: bool | None = None,
+        url: str | None = None,
+    ) -> HTTPRequest:
         req_body: dict[str, Any] = {
             "model": self.model_name,
             "messages": messages,
@@ -90,7 +312,7 @@ class LLMModelConfig(BaseModel):
             req_body = translate(self.dialect, req_body)
         if self.params:
             req_body.update(self.params)
-        req_body["stream"] = self.stream
+        req_body["stream"] = self.stream if stream is None else stream
         log.debug(f"Request body: {req_body}")
         headers = {}
         if self.headers:
@@ -111,14 +333,166 @@ class LLMModelConfig(BaseModel):
             headers["Authorization"] = f"Bearer {self.api_key}"
         if self.basic_auth:
             headers["Authorization"] = f"Basic {self.basic_auth.encode()}"
-        req = HTTPRequest(
-            url=self.url,
+        return HTTPRequest(
+            url=self.url if url is None else url,
             method="POST",
             body=json.dumps(req_body),
             headers=headers,
             request_timeout=request_timeout,
         )
-        return await get_json(req, to_json=to_json)
+
+    async def query(
+        self,
+        messages: list[dict[str, Any]],
+        to_json: Callable[[Any], Any] = json.loads,
+        request_timeout: float | None = None,
+        cache: ResponseCache | None = None,
+        priority: Priority = "interactive",
+    ) -> Any:
+        """`cache` is used only if the model has `cache` configured"""
+
+        def fetch(url: str, to_json: Callable[[Any], Any] = to_json) -> Awaitable[Any]:
+            req = self.build_request(messages, request_timeout, url=url)
+            return get_json(req, to_json=to_json, pool=self.pool)
+
+        key = None
+        if cache is not None and self.cache is not None:
+            key = request_key(self.build_request(messages, request_timeout))
+            with span("cache"):
+                body = await asyncio.to_thread(cache.get, key, self.name)
+            if body is not None:
+                return to_json(body)
+        estimate = self.estimate_tokens(messages)
+        start = time.monotonic()
+        self.metrics.requests.inc(model=self.name)
+        try:
+            if key is None:
+                result = await self.limited(
+                    partial(self.replica_set.call, fetch), estimate, priority
+                )
+            else:
+                assert cache is not None and self.cache is not None
+                call = partial(self.replica_set.call, partial(fetch, to_json=bytes.decode))
+                body = (await self.limited(call, estimate, priority)).strip()
+                await asyncio.to_thread(
+                    cache.put, key, self.name, body, self.cache.ttl, self.cache.max_entries
+                )
+                result = to_json(body)
+        except Exception as e:
+            self.metrics.failed(self.name, e)
+            raise
+        self.metrics.latency.observe(time.monotonic() - start, model=self.name)
+        self.record_usage(result, estimate)
+        return result
+
+    async def _open_stream(
+        self,
+        messages: list[dict[str, Any]],
+        request_timeout: float | None,
+        priority: Priority,
+    ) -> tuple[Replica, AsyncIterator[bytes]]:
+        """Start a streamed request, retrying on other replicas (and after 429)
+        until the first line arrives"""
+        limiter = self.limiter
+        estimate = self.estimate_tokens(messages)
+        attempt = throttled = 0
+        while True:
+            if limiter is not None:
+                await limiter.acquire(estimate, priority)
+            replica = self.replica_set.acquire()
+            req = self.build_request(messages, request_timeout, stream=True, url=replica.url)
+            lines = fetch_lines(req, pool=self.pool)
+            try:
+                first = await anext(lines, None)
+            except Exception as e:
+                # nothing was streamed yet, safe to retry
+                self.replica_set.release(replica, e)
+                if self.throttled(e, throttled):
+                    throttled += 1
+                    continue
+                if not await self.replica_set.retry(attempt, e, replica):
+                    raise
+                attempt += 1
+                continue
+            except BaseException as e:
+                self.replica_set.release(replica, e)
+                raise
+            if limiter is not None:
+                limiter.succeeded()
+            return replica, _prepend(first, lines)
+
+    async def query_stream(
+        self,
+        messages: list[dict[str, Any]],
+        request_timeout: float | None = None,
+        priority: Priority = "interactive",
+    ) -> AsyncIterator[ChatChunk]:
+        """Stream the generation as `ChatChunk`s, the last one has `done=True`.
+        Backends that ignore `stream` and answer with a single JSON body
+        produce one chunk with the whole generation. Token usage is recorded
+        if the stream reports it, OpenAI compatible backends need
+        `"stream_options": {"include_usage": true}` in `params` for that."""
+        start = time.monotonic()
+        self.metrics.requests.inc(model=self.name)
+        try:
+            replica, lines = await self._open_stream(messages, request_timeout, priority)
+        except Exception as e:
+            self.metrics.failed(self.name, e)
+            raise
+        unparsed: list[bytes] = []
+        usage: tuple[int, int] | None = None
+        final: ChatChunk | None = None
+        first_token = True
+        error: BaseException | None = None
+        try:
+            async for line in lines:
+                if unparsed:
+                    unparsed.append(line)
+                    continue
+                usage = stream_line_usage(line) or usage
+                if final is not None:
+                    continue  # only usage follows the end of the generation
+                try:
+                    chunk = stream_line_to_chunk(line)
+                except ValueError:
+                    unparsed.append(line)
+                    continue
+                if chunk is None:
+                    continue
+                if first_token and chunk.delta:
+                    first_token = False
+                    self.metrics.ttft.observe(time.monotonic() - start, model=self.name)
+                if chunk.done:
+                    final = chunk
+                    continue
+                yield chunk
+            if unparsed:
+                response = json.loads(b"\n".join(unparsed))
+                self.record_usage(response, self.estimate_tokens(messages))
+                msg = response_to_chat_result(response).generation
+                final = ChatChunk(delta=msg.content, role=msg.role, done=True)
+            elif usage is not None:
+                self.record_tokens(usage, self.estimate_tokens(messages))
+        except Exception as e:
+            error = e
+            self.metrics.failed(self.name, e)
+            raise
+        except BaseException as e:
+            # cancelled, or closed by the consumer before the end
+            error = e
+            raise
+        finally:
+            self.replica_set.release(replica, error)
+        self.metrics.latency.observe(time.monotonic() - start, model=self.name)
+        yield STREAM_DONE if final is None else final
+
+
+async def _prepend(first: bytes | None, rest: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+    if first is None:
+        return
+    yield first
+    async for line in rest:
+        yield line
 
 
 class EmbeddingModel(BaseModel):
@@ -132,6 +506,17 @@ class EmbeddingModel(BaseModel):
 class VectorDb(BaseModel):
     dir: Path
     embeddings: EmbeddingModel
+    # search a quantized in-memory copy of the embeddings instead of Chroma's index,
+    # an addition to Chroma's float32 storage, not a replacement
+    quantization: QuantizationType = Field(default="none")
+    # re-rank that many quantized candidates on exact embeddings, 0 - off
+    rescore_candidates: int = Field(default=0, ge=0)
+    # dedicated pool that runs embedding and vector search off the event loop
+    retrieval_workers: int = Field(default=4, ge=1)
+    retrieval_queue: int = Field(default=64, ge=0)
+    # physical Chroma collections per logical one, sources are routed by path hash.
+    # changing it requires rebuilding the vector db
+    shards: int = Field(default=1, ge=1)
 
 
 class FileGlob(BaseModel):
@@ -149,6 +534,19 @@ class Config(BaseModel):
     vector_db: VectorDb
     llm_models: dict[str, LLMModelConfig]
 
+    @model_validator(mode="after")
+    def name_llm_models(self) -> "Config":
+        for name, llm in self.llm_models.items():
+            llm.name = name
+            if llm.routing is not None:
+                unknown = set(llm.routing.alternates) - self.llm_models.keys()
+                assert not unknown, f"{name} routes to unknown llm_models: {unknown}"
+            summarizer = llm.history.summarize_with
+            assert summarizer is None or summarizer in self.llm_models, (
+                f"{name} summarizes with unknown llm_models: {summarizer}"
+            )
+        return self
+
 
 class ModelParams(BaseModel):
     name: str
@@ -157,7 +555,46 @@ class ModelParams(BaseModel):
 
 class RagConfig(BaseModel):
     files: list[FileGlob]
-    vector_db_collection: str
+    # one collection or several, searched concurrently and merged by relevance.
+    # `files` are loaded into the first one, others are populated by other bots
+    vector_db_collection: str | Annotated[list[str], Field(min_length=1)]
+    search_type: Literal["similarity", "mmr", "similarity_score_threshold"] = Field(
+        default="similarity"
+    )
+    k: int = Field(default=4, ge=1)
+    # candidates considered by "mmr" search
+    fetch_k: int = Field(default=20, ge=1)
+    # minimal relevance for "similarity_score_threshold" search
+    score_threshold: float | None = Field(default=None)
+    # share of the model's context_window that retrieved context may take
+    context_share: float = Field(default=0.5, gt=0, le=1)
+
+    @model_validator(mode="after")
+    def check_score_threshold(self) -> "RagConfig":
+        assert (
+            self.search_type != "similarity_score_threshold" or self.score_threshold is not None
+        ), "similarity_score_threshold search needs a score_threshold"
+        return self
+
+    @property
+    def collections(self) -> list[str]:
+        if isinstance(self.vector_db_collection, str):
+            return [self.vector_db_collection]
+        return list(self.vector_db_collection)
+
+    def search_kwargs(self) -> dict[str, Any]:
+        kwargs: dict[str, Any] = {"k": self.k}
+        if self.search_type == "mmr":
+            kwargs["fetch_k"] = max(self.fetch_k, self.k)
+        if self.search_type == "similarity_score_threshold":
+            kwargs["score_threshold"] = self.score_threshold
+        return kwargs
+
+    def context_budget(self, llm: LLMModelConfig) -> int | None:
+        """Tokens available for retrieved context, None if the window is unknown"""
+        if llm.context_window is None:
+            return None
+        return int(llm.context_window * self.context_share)
 
 
 class BotConfig(BaseModel):
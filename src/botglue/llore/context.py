@@ -0,0 +1,172 @@
+import logging
+import math
+from collections.abc import Callable
+from typing import Any
+
+from langchain_core.documents import Document
+
+logger = logging.getLogger(__name__)
+
+CHARS_PER_TOKEN = 4
+MIN_TEXT_OVERLAP = 16
+CHUNK_SEPARATOR = "\n\n"
+
+
+def count_tokens(text: str) -> int:
+    """Rough token estimate, good enough for budgeting prompts
+
+    >>> count_tokens("")
+    0
+    >>> count_tokens("four")
+    1
+    >>> count_tokens("hello world")
+    3
+    """
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+
+def _text_overlap(left: str, right: str, min_overlap: int = MIN_TEXT_OVERLAP) -> int:
+    """Length of the longest suffix of `left` that is a prefix of `right`
+
+    >>> _text_overlap("0123456789abcdefghij", "abcdefghijKLMN", 4)
+    10
+    >>> _text_overlap("0123456789", "abcdef", 4)
+    0
+    """
+    for n in range(min(len(left), len(right)), min_overlap - 1, -1):
+        if left.endswith(right[:n]):
+            return n
+    return 0
+
+
+class _Span:
+    """Run of merged chunks from the same source page"""
+
+    rank: int
+    text: str
+    start: int | None
+    metadata: dict[str, Any]
+
+    def __init__(self, rank: int, doc: Document):
+        self.rank = rank
+        self.text = doc.page_content
+        self.start = doc.metadata.get("start_index")
+        self.metadata = doc.metadata
+
+    @property
+    def end(self) -> int | None:
+        return None if self.start is None else self.start + len(self.text)
+
+    def merge(self, other: "_Span") -> bool:
+        """Absorb `other` if the two spans overlap or touch"""
+        if self.start is not None and other.start is not None:
+            first, second = (self, other) if self.start <= other.start else (other, self)
+            first_start, second_start = min(self.start, other.start), max(self.start, other.start)
+            first_end = first_start + len(first.text)
+            if second_start > first_end:
+                return False
+            if second_start + len(second.text) > first_end:
+                text = first.text + second.text[first_end - second_start :]
+            else:
+                text = first.text
+            self.start, self.text = first_start, text
+        else:
+            if (n := _text_overlap(self.text, other.text)) > 0:
+                self.text = self.text + other.text[n:]
+            elif (n := _text_overlap(other.text, self.text)) > 0:
+                self.text = other.text + self.text[n:]
+            elif other.text in self.text:
+                pass
+            else:
+                return False
+        self.rank = min(self.rank, other.rank)
+        return True
+
+    def to_document(self) -> Document:
+        metadata = dict(self.metadata)
+        if self.start is not None:
+            metadata["start_index"] = self.start
+        return Document(page_content=self.text, metadata=metadata)
+
+
+def merge_chunks(docs: list[Document]) -> list[Document]:
+    """Drop duplicate chunks and merge overlapping or adjacent chunks of the
+    same source page. Result keeps the order of the best ranked member.
+
+    >>> d = lambda t, s, **m: Document(page_content=t, metadata={"source": "a.pdf", "start_index": s, **m})
+    >>> [x.page_content for x in merge_chunks([d("world!", 6), d("Hello world", 0), d("Hello world", 0)])]
+    ['Hello world!']
+    >>> [x.page_content for x in merge_chunks([d("aaa", 0), d("bbb", 0, page=2)])]
+    ['aaa', 'bbb']
+    """
+    spans: list[_Span] = []
+    seen: set[tuple[Any, Any, str]] = set()
+    for rank, doc in enumerate(docs):
+        key = (doc.metadata.get("source"), doc.metadata.get("page"), doc.page_content)
+        if key in seen:
+            continue
+        seen.add(key)
+        span = _Span(rank, doc)
+        same_page = [
+            s
+            for s in spans
+            if s.metadata.get("source") == doc.metadata.get("source")
+            and s.metadata.get("page") == doc.metadata.get("page")
+        ]
+        merged = None
+        for s in same_page:
+            if merged is None:
+                if s.merge(span):
+                    merged = s
+            elif merged.merge(s):
+                spans.remove(s)
+        if merged is None:
+            spans.append(span)
+    return [s.to_document() for s in sorted(spans, key=lambda s: s.rank)]
+
+
+def pack_chunks(
+    docs: list[Document],
+    budget: int | None,
+    count: Callable[[str], int] = count_tokens,
+) -> list[Document]:
+    """Merge chunks and keep the best ranked ones that fit into `budget` tokens,
+    counted as `format_context` renders them, with headers and separators
+
+    >>> docs = [Document(page_content=t, metadata={"source": s}) for t, s in
+    ...         [("x" * 40, "a"), ("y" * 400, "b"), ("z" * 40, "c")]]
+    >>> [d.metadata["source"] for d in pack_chunks(docs, 23)]
+    ['a', 'c']
+    >>> [d.metadata["source"] for d in pack_chunks(docs, 22)]
+    ['a']
+    >>> len(pack_chunks(docs, None))
+    3
+    """
+    packed: list[Document] = []
+    used = 0
+    separator = count(CHUNK_SEPARATOR)
+    for doc in merge_chunks(docs):
+        n = count(_format_chunk(doc)) + (separator if packed else 0)
+        if budget is not None and used + n > budget:
+            continue
+        packed.append(doc)
+        used += n
+    if len(packed) < len(docs):
+        logger.debug(f"Packed {len(docs)} chunks into {len(packed)} ({used} tokens of {budget})")
+    return packed
+
+
+def format_context(docs: list[Document]) -> str:
+    """
+    >>> print(format_context([Document(page_content="text", metadata={"source": "a.pdf", "page": 2})]))
+    [a.pdf, page 2]
+    text
+    """
+    return CHUNK_SEPARATOR.join(_format_chunk(doc) for doc in docs)
+
+
+def _format_chunk(doc: Document) -> str:
+    ref = doc.metadata.get("source", "unknown")
+    if "page" in doc.metadata:
+        ref += f", page {doc.metadata['page']}"
+    return f"[{ref}]\n{doc.page_content}"
@@ -0,0 +1,177 @@
+import hashlib
+import json
+import logging
+import threading
+from collections import OrderedDict
+from collections.abc import Awaitable, Callable
+from functools import lru_cache
+
+from botglue.llore.api import ChatMsg
+from botglue.llore.context import count_tokens
+
+logger = logging.getLogger(__name__)
+
+# role markers and separators a chat template adds around each message
+MESSAGE_OVERHEAD = 4
+SUMMARY_PREFIX = "Summary of the earlier conversation:\n"
+SUMMARY_CACHE_SIZE = 1024
+
+
+@lru_cache(maxsize=16)
+def token_counter(tokenizer: str | None) -> Callable[[str], int]:
+    """Counts tokens with the HuggingFace tokenizer, loaded once per name.
+    Falls back to the `count_tokens` estimate if there is no tokenizer or it
+    can't be loaded.
+
+    >>> token_counter(None)("hello world")
+    3
+    """
+    if tokenizer is None:
+        return count_tokens
+    try:
+        from transformers import AutoTokenizer
+
+        tok = AutoTokenizer.from_pretrained(tokenizer)
+    except Exception as e:
+        logger.warning(f"Can't load tokenizer {tokenizer}, estimating tokens instead: {e}")
+        return count_tokens
+
+    def count(text: str) -> int:
+        return len(tok.encode(text, add_special_tokens=False))
+
+    return count
+
+
+def message_tokens(msg: ChatMsg, count: Callable[[str], int] = count_tokens) -> int:
+    return count(msg.content) + MESSAGE_OVERHEAD
+
+
+def history_tokens(messages: list[ChatMsg], count: Callable[[str], int] = count_tokens) -> int:
+    return sum(message_tokens(m, count) for m in messages)
+
+
+def sliding_window(
+    messages: list[ChatMsg],
+    budget: int,
+    count: Callable[[str], int] = count_tokens,
+    keep_last: int = 1,
+) -> tuple[list[ChatMsg], list[ChatMsg]]:
+    """Split into messages that fit into `budget` tokens and older ones that
+    are dropped. Leading system messages and the last `keep_last` messages are
+    kept even if they don't fit.
+
+    >>> m = lambda role, n: ChatMsg(role=role, content="x" * 4 * n)
+    >>> msgs = [m("system", 6), m("user", 6), m("assistant", 6), m("user", 6)]
+    >>> kept, dropped = sliding_window(msgs, 30)
+    >>> [x.role for x in kept], [x.role for x in dropped]
+    (['system', 'assistant', 'user'], ['user'])
+    >>> [x.role for x in sliding_window(msgs, 5)[0]]
+    ['system', 'user']
+    """
+    head = 0
+    while head < len(messages) and messages[head].role == "system":
+        head += 1
+    system, rest = messages[:head], messages[head:]
+    used = history_tokens(system, count)
+    keep_from = len(rest)
+    for i in range(len(rest) - 1, -1, -1):
+        n = message_tokens(rest[i], count)
+        if used + n > budget and len(rest) - i > keep_last:
+            break
+        used += n
+        keep_from = i
+    return system + rest[keep_from:], rest[:keep_from]
+
+
+def truncate_tokens(text: str, max_tokens: int, count: Callable[[str], int] = count_tokens) -> str:
+    """
+    >>> truncate_tokens("x" * 100, 10)
+    'xxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxx'
+    """
+    while (n := count(text)) > max_tokens:
+        text = text[: len(text) * max_tokens // n]
+    return text
+
+
+def _prefix_keys(messages: list[ChatMsg]) -> list[str]:
+    """Keys of `messages[:1]`, `messages[:2]`, ... up to all of them, hashed
+    one message at a time so each message is serialized and hashed once
+
+    >>> a, b = ChatMsg(role="user", content="a"), ChatMsg(role="user", content="b")
+    >>> _prefix_keys([a, b])[0] == _prefix_keys([a])[0] != _prefix_keys([b])[0]
+    True
+    """
+    running = hashlib.sha256()
+    keys: list[str] = []
+    for m in messages:
+        # json has no raw newlines, messages can't run into each other
+        running.update(json.dumps(m.to_output_dict()).encode() + b"\n")
+        keys.append(running.hexdigest())  # the digest leaves `running` open
+    return keys
+
+
+class HistorySummaries:
+    """Rolling summaries of dropped turns. Clients resend the whole history
+    every turn, so the summary of a prefix is reused and extended with the
+    turns dropped since instead of being recomputed."""
+
+    size: int
+    _lock: threading.Lock
+    _summaries: OrderedDict[str, str]
+
+    def __init__(self, size: int = SUMMARY_CACHE_SIZE):
+        self.size = size
+        self._lock = threading.Lock()
+        self._summaries = OrderedDict()
+
+    def get(self, key: str) -> str | None:
+        with self._lock:
+            if key in self._summaries:
+                self._summaries.move_to_end(key)
+            return self._summaries.get(key)
+
+    def put(self, key: str, summary: str) -> None:
+        with self._lock:
+            self._summaries[key] = summary
+            self._summaries.move_to_end(key)
+            while len(self._summaries) > self.size:
+                self._summaries.popitem(last=False)
+
+    async def summarize(
+        self,
+        dropped: list[ChatMsg],
+        summarize: Callable[[str | None, list[ChatMsg]], Awaitable[str]],
+    ) -> str:
+        """Summary of `dropped`, built on the longest already summarized prefix"""
+        keys = _prefix_keys(dropped)
+        if (found := self.get(keys[-1])) is not None:
+            return found
+        previous, start = None, 0
+        for i in range(len(dropped) - 1, 0, -1):
+            if (previous := self.get(keys[i - 1])) is not None:
+                start = i
+                break
+        summary = await summarize(previous, dropped[start:])
+        self.put(keys[-1], summary)
+        return summary
+
+
+def summary_prompt(previous: str | None, turns: list[ChatMsg], max_tokens: int) -> list[ChatMsg]:
+    transcript = "\n".join(f"{m.role}: {m.content}" for m in turns)
+    if previous is not None:
+        transcript = f"{SUMMARY_PREFIX}{previous}\n\n{transcript}"
+    instructions = (
+        "Summarize the conversation below for a chat assistant that will continue it. "
+        "Keep facts, names, numbers, decisions and open questions. "
+        f"Answer with the summary only, in at most {max_tokens * 3 // 4} words."
+    )
+    return [ChatMsg(role="system", content=instructions), ChatMsg(role="user", content=transcript)]
+
+
+def with_summary(kept: list[ChatMsg], summary: str) -> list[ChatMsg]:
+    """Insert the summary as a system message after the leading system ones"""
+    head = 0
+    while head < len(kept) and kept[head].role == "system":
+        head += 1
+    msg = ChatMsg(role="system", content=SUMMARY_PREFIX + summary)
+    return kept[:head] + [msg] + kept[head:]
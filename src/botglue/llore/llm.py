@@ -1,3 +1,4 @@
+import json
 import logging
 from abc import ABCMeta, abstractmethod
 from collections.abc import Callable, Generator
@@ -6,7 +7,7 @@ from typing import Any, ClassVar
 
 from pydantic import BaseModel
 
-from botglue.llore.api import ChatMsg, ChatResponse, TooledMessages
+from botglue.llore.api import ChatChunk, ChatMsg, ChatResponse, TooledMessages
 
 logger = logging.getLogger(__name__)
 
@@ -63,6 +64,119 @@ def response_to_chat_result(response: dict[str, Any]) -> ChatResponse:
     return ChatResponse(generation=ChatMsg(content=content, role=role))
 
 
+def usage_tokens(response: Any) -> tuple[int, int] | None:
+    """Prompt and completion tokens reported by the backend, if any
+
+    >>> usage_tokens({"usage": {"prompt_tokens": 3, "completion_tokens": 5}})
+    (3, 5)
+    >>> usage_tokens({"prompt_eval_count": 7, "eval_count": 2, "message": {}})
+    (7, 2)
+    >>> usage_tokens({"usage": {"input_tokens": 4, "output_tokens": 1}}), usage_tokens("text")
+    ((4, 1), None)
+    """
+    if not isinstance(response, dict):
+        return None
+    usage = response.get("usage")
+    if isinstance(usage, dict):
+        if "prompt_tokens" in usage:
+            return int(usage["prompt_tokens"]), int(usage.get("completion_tokens", 0))
+        if "input_tokens" in usage:
+            return int(usage["input_tokens"]), int(usage.get("output_tokens", 0))
+    if "prompt_eval_count" in response or "eval_count" in response:
+        return int(response.get("prompt_eval_count", 0)), int(response.get("eval_count", 0))
+    return None
+
+
+STREAM_DONE = ChatChunk(delta="", done=True)
+
+
+def stream_line_to_chunk(line: bytes | str) -> ChatChunk | None:
+    """Parse one line of a streamed response: SSE `data:` lines (OpenAI,
+    Claude, copilot) or NDJSON (Ollama). Returns None for lines that carry
+    no text, raises `ValueError` for lines that are not a stream at all.
+
+    >>> stream_line_to_chunk(b'data: {"choices":[{"delta":{"content":"Hi"},"finish_reason":null}]}')
+    ChatChunk(delta='Hi', role='assistant', done=False)
+    >>> stream_line_to_chunk(b'data: [DONE]').done
+    True
+    >>> stream_line_to_chunk('{"message":{"role":"assistant","content":" there"},"done":false}').delta
+    ' there'
+    >>> stream_line_to_chunk('{"message":{"role":"assistant","content":""},"done":true}').done
+    True
+    >>> stream_line_to_chunk('data: {"type":"content_block_delta","delta":{"type":"text_delta","text":"!"}}').delta
+    '!'
+    >>> stream_line_to_chunk('data: {"chatCompletion":{"chatCompletionContent":"ok"}}').delta
+    'ok'
+    >>> stream_line_to_chunk(b'event: ping') is None
+    True
+    """
+    if isinstance(line, bytes):
+        line = line.decode()
+    line = line.strip()
+    if not line or line.startswith((":", "event:", "id:", "retry:")):
+        return None
+    if line.startswith("data:"):
+        line = line[5:].strip()
+        if line == "[DONE]":
+            return STREAM_DONE
+    try:
+        chunk = json.loads(line)
+    except json.JSONDecodeError as e:
+        raise ValueError(f"Not a stream line: {line[:100]}") from e
+    if not isinstance(chunk, dict):
+        raise ValueError(f"Not a stream line: {line[:100]}")
+    # OpenAI format
+    if "choices" in chunk:
+        if not chunk["choices"]:
+            return None
+        ch = chunk["choices"][0]
+        delta = ch.get("delta") or ch.get("message") or {}
+        return ChatChunk(
+            delta=delta.get("content") or "",
+            role=delta.get("role") or "assistant",
+            done=ch.get("finish_reason") is not None,
+        )
+    # Ollama format
+    if "message" in chunk and "done" in chunk:
+        msg = chunk["message"]
+        return ChatChunk(
+            delta=msg.get("content", ""), role=msg.get("role", "assistant"), done=chunk["done"]
+        )
+    # Claude format
+    if chunk.get("type") == "content_block_delta":
+        return ChatChunk(delta=chunk["delta"].get("text", ""))
+    if chunk.get("type") == "message_stop":
+        return STREAM_DONE
+    if "type" in chunk:
+        return None
+    if "chatCompletion" in chunk:
+        return ChatChunk(delta=chunk["chatCompletion"].get("chatCompletionContent") or "")
+    raise ValueError(f"Unsupported stream format: {line[:100]}")
+
+
+def stream_line_usage(line: bytes | str) -> tuple[int, int] | None:
+    """Prompt and completion tokens reported by a streamed line: the last
+    line of Ollama, the usage chunk of OpenAI, which is sent only if asked for
+    with `"stream_options": {"include_usage": true}`.
+
+    >>> stream_line_usage(b'{"message":{"content":""},"done":true,"prompt_eval_count":7,"eval_count":2}')
+    (7, 2)
+    >>> stream_line_usage('data: {"choices":[],"usage":{"prompt_tokens":3,"completion_tokens":5}}')
+    (3, 5)
+    >>> stream_line_usage(b'data: {"choices":[{"delta":{"content":"Hi"}}]}') is None
+    True
+    """
+    if isinstance(line, bytes):
+        line = line.decode()
+    # most lines are text deltas, not worth parsing twice
+    if "usage" not in line and "eval_count" not in line:
+        return None
+    try:
+        return usage_tokens(json.loads(line.strip().removeprefix("data:")))
+    except json.JSONDecodeError:
+        return None
+
+
 class Tool(metaclass=ABCMeta):
     config_type: ClassVar[type[BaseModel]]
     name: str
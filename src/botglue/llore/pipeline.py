@@ -1,17 +1,39 @@
+import asyncio
 import hashlib
+import json
 import logging
+import threading
+import time
 import traceback
+from collections import defaultdict
+from collections.abc import AsyncIterator
 from datetime import UTC, datetime
+from functools import partial
 from pathlib import Path
-from typing import cast
+from typing import Any, cast
 
+from langchain_chroma import Chroma
+from langchain_core.documents import Document
 from langchain_core.prompt_values import ChatPromptValue
 from langchain_core.prompts import ChatPromptTemplate
-from langchain_core.runnables import RunnablePassthrough
 
-from botglue.llore.api import ChatMsg, ChatResponse, Models
-from botglue.llore.config import BotConfig, Config, load_config
+from botglue.concurrency import BoundedExecutor, SingleFlight
+from botglue.llore.api import ChatChunk, ChatMsg, ChatResponse, Models
+from botglue.llore.cache import ResponseCache
+from botglue.llore.config import BotConfig, Config, RagConfig, load_config
+from botglue.llore.context import format_context, pack_chunks
+from botglue.llore.history import (
+    MESSAGE_OVERHEAD,
+    HistorySummaries,
+    history_tokens,
+    sliding_window,
+    summary_prompt,
+    token_counter,
+    truncate_tokens,
+    with_summary,
+)
 from botglue.llore.llm import response_to_chat_result
+from botglue.llore.routing import LatencyWindow, hedge
 from botglue.llore.state import open_sqlite_db
 from botglue.llore.state.schema import (
     ActionType,
@@ -23,10 +45,22 @@ from botglue.llore.state.schema import (
     select_all_active_sources,
 )
 from botglue.llore.vector import (
+    add_chunks,
+    delete_source,
+    forget_collections,
     get_vector_collection,
+    ingest_version,
     load_document_into_chunks,
+    mark_ingested,
+    merge_top_k,
+    search_by_vector,
+    shard_for_source,
+    shard_names,
 )
+from botglue.metrics import REGISTRY, Counter, MetricsRegistry
 from botglue.misc import ensure_dir
+from botglue.ratelimit import Priority
+from botglue.timing import record, span
 
 logger = logging.getLogger("llore.pipeline")
 
@@ -87,31 +121,190 @@ class FileStates:
 # TODO: langchain pipeline
 
 
+def flight_key(llm_name: str, params: dict[str, Any], messages: list[dict[str, Any]]) -> str:
+    """
+    >>> flight_key("4o", {"t": 1}, [{"role": "user", "content": "hi"}])[:13]
+    '4o:e7ef2b2b7c'
+    """
+    body = json.dumps({"params": params, "messages": messages}, sort_keys=True)
+    return f"{llm_name}:{hashlib.sha256(body.encode()).hexdigest()}"
+
+
 class Llore:
     root: Path | None
     config: Config
+    registry: MetricsRegistry
     bots: dict[str, BotConfig]
+    retrieval: BoundedExecutor
+    llm_flights: SingleFlight[Any]
+    responses: ResponseCache
+    latencies: defaultdict[str, LatencyWindow]
+    summaries: HistorySummaries
+    _hedge_wins: Counter
+    _collections: dict[str, Chroma]
+    _collections_lock: threading.Lock
+    # `ingest_version` the open collections reflect
+    _ingested: int
 
     def __init__(
-        self, config_path: str | Path = "data/config.json", root: str | Path | None = None
+        self,
+        config_path: str | Path = "data/config.json",
+        root: str | Path | None = None,
+        registry: MetricsRegistry = REGISTRY,
     ):
         self.root, self.config, bots = load_config(config_path, root)
         self.bots = {b.name: b for b in bots}
+        self.registry = registry
+        for llm in self.config.llm_models.values():
+            llm.registry = registry
+        self.retrieval = BoundedExecutor(
+            "retrieval",
+            max_workers=self.config.vector_db.retrieval_workers,
+            max_queue=self.config.vector_db.retrieval_queue,
+            registry=registry,
+        )
+        self.llm_flights = SingleFlight("llm", registry=registry)
+        self.responses = ResponseCache(self.config.state_path / "state.db", registry=registry)
+        self.latencies = defaultdict(LatencyWindow)
+        self.summaries = HistorySummaries()
+        self._hedge_wins = registry.counter("llm_hedge_wins_total", "Hedged queries by winner")
+        self._collections = {}
+        self._collections_lock = threading.Lock()
+        self._ingested = ingest_version(self.config)
+
+    def get_collection(self, collection: str) -> Chroma:
+        """Vector collection opened once and reused across queries. Opened
+        again once another process ingested files, only the leader worker
+        runs `process_files`."""
+        with self._collections_lock:
+            if (version := ingest_version(self.config)) != self._ingested:
+                logger.info("Files were ingested by another process, reopening collections")
+                self._ingested = version
+                forget_collections(self.config)
+                self._collections = {
+                    name: get_vector_collection(self.config, name, db.embeddings)
+                    for name, db in self._collections.items()
+                }
+            if collection not in self._collections:
+                self._collections[collection] = get_vector_collection(self.config, collection)
+            return self._collections[collection]
+
+    def embed_query(self, collection: str, question: str) -> list[float]:
+        db = self.get_collection(collection)
+        return db.embeddings.embed_query(question)  # pyright: ignore[reportOptionalMemberAccess]
+
+    def search(
+        self, collection: str, rag: RagConfig, vector: list[float]
+    ) -> list[tuple[Document, float]]:
+        db = self.get_collection(collection)
+        return search_by_vector(self.config, collection, db, rag, vector)
+
+    async def retrieve(self, rag: RagConfig, question: str) -> list[Document]:
+        """Embed the question once, search all collections of the bot (and all
+        their shards) concurrently on `self.retrieval` executor and keep the
+        global top k"""
+        collections = [s for c in rag.collections for s in shard_names(self.config, c)]
+        with span("embed"):
+            vector = await self.retrieval.run(self.embed_query, collections[0], question)
+        with span("search"):
+            results = await asyncio.gather(
+                *(self.retrieval.run(self.search, c, rag, vector) for c in collections)
+            )
+        return [doc for doc, _ in merge_top_k(results, rag.k)]
 
-    async def query_llm(self, llm_name: str, messages: list[ChatMsg]) -> ChatResponse:
+    async def query_llm(
+        self, llm_name: str, messages: list[ChatMsg], priority: Priority = "interactive"
+    ) -> ChatResponse:
+        """Hedged or raced across models if `routing` is configured for the model"""
+        routing = self.config.llm_models[llm_name].routing
+        if routing is None:
+            return await self.query_one_llm(llm_name, messages, priority)
+        names = [llm_name, *(n for n in routing.alternates if n != llm_name)]
+        if routing.mode == "race":
+            delays = [0.0] * (len(names) - 1)
+        else:
+            delays = [
+                max(
+                    routing.min_delay,
+                    self.latencies[n].percentile(routing.percentile, routing.initial_delay),
+                )
+                for n in names[:-1]
+            ]
+        calls = [partial(self.query_one_llm, n, messages, priority) for n in names]
+        winner, response = await hedge(calls, delays)
+        self._hedge_wins.inc(model=llm_name, winner=names[winner], mode=routing.mode)
+        return response
+
+    async def compact_history(
+        self, llm_name: str, messages: list[ChatMsg], priority: Priority = "interactive"
+    ) -> list[ChatMsg]:
+        """Fit the conversation into the model's history budget, dropping or
+        summarizing the oldest turns"""
+        llm = self.config.llm_models[llm_name]
+        budget = llm.history_budget()
+        count = token_counter(llm.tokenizer)
+        if budget is None or history_tokens(messages, count) <= budget:
+            return messages
+        summarizer = llm.history.summarize_with
+        if summarizer is not None:
+            budget -= llm.history.summary_tokens + MESSAGE_OVERHEAD
+        kept, dropped = sliding_window(messages, budget, count, llm.history.keep_last)
+        logger.info(f"Dropping {len(dropped)} of {len(messages)} messages for {llm_name}")
+        if summarizer is None or not dropped:
+            return kept
+
+        async def summarize(previous: str | None, turns: list[ChatMsg]) -> str:
+            prompt = summary_prompt(previous, turns, llm.history.summary_tokens)
+            response = await self.query_one_llm(summarizer, prompt, priority)
+            # models don't always stick to the length asked for
+            return truncate_tokens(response.generation.content, llm.history.summary_tokens, count)
+
+        return with_summary(kept, await self.summaries.summarize(dropped, summarize))
+
+    async def query_one_llm(
+        self, llm_name: str, messages: list[ChatMsg], priority: Priority = "interactive"
+    ) -> ChatResponse:
+        """Identical concurrent requests share one upstream call"""
         llm = self.config.llm_models[llm_name]
-        return response_to_chat_result(await llm.query([m.to_output_dict() for m in messages]))
+        with span("history"):
+            messages = await self.compact_history(llm_name, messages, priority)
+        payload = [m.to_output_dict() for m in messages]
+        key = f"{priority}:{flight_key(llm_name, llm.params, payload)}"
+        start = time.monotonic()
+        response = await self.llm_flights.run(
+            key, lambda: llm.query(payload, cache=self.responses, priority=priority)
+        )
+        self.latencies[llm_name].observe(time.monotonic() - start)
+        record("llm", time.monotonic() - start)
+        return response_to_chat_result(response)
+
+    async def stream_llm(
+        self, llm_name: str, messages: list[ChatMsg], priority: Priority = "interactive"
+    ) -> AsyncIterator[ChatChunk]:
+        llm = self.config.llm_models[llm_name]
+        with span("history"):
+            messages = await self.compact_history(llm_name, messages, priority)
+        payload = [m.to_output_dict() for m in messages]
+        async for chunk in llm.query_stream(payload, priority=priority):
+            yield chunk
 
-    async def query_bot(
+    async def prepare_bot(
         self, bot_name: str, messages: list[ChatMsg], llm_name: str | None = None
-    ) -> ChatResponse:
+    ) -> str:
+        """Augment the last user message with retrieved context, returns the
+        name of the llm that should answer"""
         bot_cfg = self.bots[bot_name]
+        if llm_name is None:
+            llm_name = bot_cfg.model.name
+
         if bot_cfg.rag is not None and len(messages) > 0 and messages[-1].role == "user":
             question = messages[-1].content
 
-            db = get_vector_collection(self.config, bot_cfg.rag.vector_db_collection)
-
-            retriever = db.as_retriever()
+            docs = await self.retrieve(bot_cfg.rag, question)
+            start = time.monotonic()
+            llm = self.config.llm_models[llm_name]
+            budget = bot_cfg.rag.context_budget(llm)
+            context = format_context(pack_chunks(docs, budget, token_counter(llm.tokenizer)))
             template = """Answer the question based only on the following context:
 {context}
 
@@ -121,19 +314,58 @@ Question: {question}
 """
             prompt = ChatPromptTemplate.from_template(template)
 
-            retrieval_chain = {"context": retriever, "question": RunnablePassthrough()} | prompt
             promptValue: ChatPromptValue = cast(
-                ChatPromptValue, await retrieval_chain.ainvoke(question)
+                ChatPromptValue, await prompt.ainvoke({"context": context, "question": question})
             )
             m = promptValue.to_messages()[-1]
             # logger.debug(f"Retrieved mess age: {type(mm)} {len(mm)} {mm}")
             messages[-1] = ChatMsg(role="user", content=m.content)  # pyright: ignore [reportArgumentType]
+            record("prompt", time.monotonic() - start)
             # TODO: clean up later
 
-        if llm_name is None:
-            llm_name = bot_cfg.model.name
+        return llm_name
 
-        return await self.query_llm(llm_name, messages)
+    async def query_bot(
+        self,
+        bot_name: str,
+        messages: list[ChatMsg],
+        llm_name: str | None = None,
+        priority: Priority = "interactive",
+    ) -> ChatResponse:
+        llm_name = await self.prepare_bot(bot_name, messages, llm_name)
+        return await self.query_llm(llm_name, messages, priority)
+
+    async def stream_bot(
+        self,
+        bot_name: str,
+        messages: list[ChatMsg],
+        llm_name: str | None = None,
+        priority: Priority = "interactive",
+    ) -> AsyncIterator[ChatChunk]:
+        llm_name = await self.prepare_bot(bot_name, messages, llm_name)
+        async for chunk in self.stream_llm(llm_name, messages, priority):
+            yield chunk
+
+    async def warmup(self) -> None:
+        """Open the state db and the bots' collections, load the embedding
+        model and connect to the LLM backends, so the first chats don't wait
+        for it. Failures are logged, the same is done lazily on demand."""
+        start = time.monotonic()
+        try:
+            await asyncio.to_thread(self.responses.prepare)
+        except Exception as e:
+            logger.warning(f"Warmup of the state db failed: {e!r}")
+        rags = [b.rag for b in self.bots.values() if b.rag is not None]
+        for c in dict.fromkeys(c for rag in rags for c in rag.collections):
+            shards = shard_names(self.config, c)
+            try:
+                await self.retrieval.run(self.embed_query, shards[0], "warmup")
+                for shard in shards[1:]:
+                    await self.retrieval.run(self.get_collection, shard)
+            except Exception as e:
+                logger.warning(f"Warmup of collection {c} failed: {e!r}")
+        await asyncio.gather(*(llm.warmup() for llm in self.config.llm_models.values()))
+        logger.info(f"Warmed up in {time.monotonic() - start:.2f}s")
 
     def get_models(self) -> Models:
         return Models(llms=list(self.config.llm_models.keys()), bots=list(self.bots.keys()))
@@ -149,7 +381,7 @@ Question: {question}
             for glob in bot.rag.files:
                 for file in sorted(glob.get_matching_files()):
                     fstate = file_states.add_file(file)
-                    fstate.collections[bot.rag.vector_db_collection] = FileTransition(None, True)
+                    fstate.collections[bot.rag.collections[0]] = FileTransition(None, True)
 
         with self.open_db() as conn:
             if not check_all_tables_exist(conn):
@@ -171,6 +403,7 @@ Question: {question}
                             i
                         ].sha256
 
+        changed = False
         for state in file_states.states.values():
             deletes: list[str] = []
             pending_uploads: list[tuple[str, ActionType]] = []
@@ -195,10 +428,12 @@ Question: {question}
                         continue
                     action = self.store_action(source, len(chunks), state)
                     for collection, action_type in pending_uploads:
-                        db = get_vector_collection(self.config, collection)
+                        shard = shard_for_source(self.config, collection, state.path)
+                        db = self.get_collection(shard)
+                        changed = True
                         if action_type == "update":
-                            db.delete(where={"source": str(state.path)})
-                        db.add_documents(chunks)
+                            delete_source(self.config, shard, db, state.path)
+                        add_chunks(self.config, shard, db, chunks)
                         self.store_collection_action(action, collection, action_type)
                 except Exception as e:
                     logger.warning(f"Error loading document {state.path}: {e}")
@@ -209,9 +444,14 @@ Question: {question}
                 if action is None:
                     action = self.store_action(source, 0, state)
                 for collection in deletes:
-                    db = get_vector_collection(self.config, collection)
-                    db.delete(where={"source": str(state.path)})
+                    shard = shard_for_source(self.config, collection, state.path)
+                    changed = True
+                    delete_source(self.config, shard, self.get_collection(shard), state.path)
                     self.store_collection_action(action, collection, "delete")
+        if changed:
+            # this process has the changes already
+            with self._collections_lock:
+                self._ingested = mark_ingested(self.config)
 
     def store_source(self, path: Path) -> RagSource:
         with self.open_db() as conn:
@@ -0,0 +1,342 @@
+import logging
+import threading
+from pathlib import Path
+from typing import Any, Literal
+
+import numpy as np
+from numpy.typing import NDArray
+
+logger = logging.getLogger(__name__)
+
+QuantizationType = Literal["none", "float16", "int8"]
+DistanceSpace = Literal["l2", "ip", "cosine"]
+
+SEARCH_BLOCK_ROWS = 65536
+# Chroma's default "hnsw:M", level 0 of the graph keeps 2 * M links per vector
+HNSW_M = 16
+
+
+class ScalarQuantizer:
+    """Per-dimension affine quantizer: `vector ~= codes * scale + offset`
+
+    >>> v = np.array([[0.0, -1.0], [1.0, 1.0], [0.5, 0.0]], dtype=np.float32)
+    >>> q = ScalarQuantizer.fit("int8", v)
+    >>> q.encode(v).dtype
+    dtype('int8')
+    >>> bool(np.abs(q.decode(q.encode(v)) - v).max() < 0.01)
+    True
+    >>> ScalarQuantizer.fit("float16", v).encode(v).dtype
+    dtype('float16')
+    """
+
+    dtype: QuantizationType
+    scale: NDArray[np.float32]
+    offset: NDArray[np.float32]
+
+    def __init__(
+        self, dtype: QuantizationType, scale: NDArray[np.float32], offset: NDArray[np.float32]
+    ):
+        assert dtype in ("float16", "int8"), f"Unsupported quantization: {dtype}"
+        self.dtype = dtype
+        self.scale = scale.astype(np.float32)
+        self.offset = offset.astype(np.float32)
+
+    @classmethod
+    def fit(cls, dtype: QuantizationType, vectors: NDArray[Any]) -> "ScalarQuantizer":
+        """Calibrate scale and offset on a sample of vectors. Values outside
+        of the calibrated range are clipped by `encode()`, see `covers()`."""
+        vectors = np.asarray(vectors, dtype=np.float32)
+        dim = vectors.shape[1]
+        if dtype == "float16":
+            return cls(dtype, np.ones(dim, np.float32), np.zeros(dim, np.float32))
+        return cls.from_range(vectors.min(axis=0), vectors.max(axis=0))
+
+    @classmethod
+    def from_range(cls, lo: NDArray[np.float32], hi: NDArray[np.float32]) -> "ScalarQuantizer":
+        scale = np.maximum((hi - lo) / 255.0, 1e-12)
+        return cls("int8", scale, lo + 128.0 * scale)
+
+    @property
+    def low(self) -> NDArray[np.float32]:
+        return self.offset - 128.0 * self.scale
+
+    @property
+    def high(self) -> NDArray[np.float32]:
+        return self.offset + 127.0 * self.scale
+
+    def covers(self, vectors: NDArray[Any]) -> bool:
+        """Whether `vectors` are within the calibrated range, float16 covers all"""
+        if self.dtype == "float16":
+            return True
+        vectors = np.asarray(vectors, dtype=np.float32)
+        # half a step of slack, values there round to the edge codes anyway
+        slack = self.scale / 2
+        return bool(
+            np.all(vectors.min(axis=0) >= self.low - slack)
+            and np.all(vectors.max(axis=0) <= self.high + slack)
+        )
+
+    def extend(self, vectors: NDArray[Any]) -> "ScalarQuantizer":
+        """Quantizer for the union of the calibrated range and `vectors`
+
+        >>> q = ScalarQuantizer.fit("int8", np.array([[0.0], [1.0]], dtype=np.float32))
+        >>> q.covers(np.array([[2.0]])), q.extend(np.array([[2.0]])).covers(np.array([[2.0]]))
+        (False, True)
+        """
+        if self.dtype == "float16":
+            return self
+        vectors = np.asarray(vectors, dtype=np.float32)
+        lo = np.minimum(self.low, vectors.min(axis=0))
+        hi = np.maximum(self.high, vectors.max(axis=0))
+        return ScalarQuantizer.from_range(lo, hi)
+
+    def encode(self, vectors: NDArray[Any]) -> NDArray[Any]:
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if self.dtype == "float16":
+            return vectors.astype(np.float16)
+        codes = np.rint((vectors - self.offset) / self.scale)
+        return np.clip(codes, -128, 127).astype(np.int8)
+
+    def decode(self, codes: NDArray[Any]) -> NDArray[np.float32]:
+        if self.dtype == "float16":
+            return codes.astype(np.float32)
+        return codes.astype(np.float32) * self.scale + self.offset
+
+
+def distances(
+    vectors: NDArray[np.float32],
+    query: NDArray[np.float32],
+    space: DistanceSpace = "l2",
+    sq_norms: NDArray[np.float32] | None = None,
+) -> NDArray[np.float32]:
+    """Distances in the same convention as Chroma: lower is more similar,
+    `l2` is squared euclidean.
+
+    >>> v = np.array([[1.0, 0.0], [0.0, 2.0]], dtype=np.float32)
+    >>> distances(v, np.array([1.0, 0.0], dtype=np.float32)).tolist()
+    [0.0, 5.0]
+    >>> distances(v, np.array([1.0, 0.0], dtype=np.float32), "cosine").tolist()
+    [0.0, 1.0]
+    """
+    norms2: NDArray[np.float32] = (
+        np.einsum("ij,ij->i", vectors, vectors) if sq_norms is None else sq_norms
+    )
+    dots = vectors @ query
+    if space == "l2":
+        return norms2 - 2 * dots + float(query @ query)
+    if space == "ip":
+        return 1.0 - dots
+    norms = np.sqrt(norms2) * float(np.sqrt(query @ query))
+    return 1.0 - dots / np.maximum(norms, 1e-12)
+
+
+class QuantizedIndex:
+    """Brute force vector index that keeps only quantized codes in memory.
+
+    It is an opt-in search layer on top of the vector store, not a replacement:
+    the store keeps its float32 embeddings and HNSW graph, which rescoring
+    reads. See `benchmark_recall()` for the memory of both together.
+
+    Search decodes the codes block by block, so the transient float32 copy is
+    bounded by `SEARCH_BLOCK_ROWS` regardless of the size of the index. The
+    int8 range is calibrated on the first batch added and widened, with all
+    codes re-quantized, whenever a later batch falls outside of it.
+
+    >>> rng = np.random.default_rng(0)
+    >>> v = rng.normal(size=(100, 8)).astype(np.float32)
+    >>> idx = QuantizedIndex("int8")
+    >>> idx.add([f"id{i}" for i in range(100)], v)
+    >>> idx.search(v[42], 1)[0][0]
+    'id42'
+    >>> idx.remove(["id42"])
+    >>> len(idx), idx.search(v[42], 1)[0][0] != 'id42'
+    (99, True)
+    """
+
+    dtype: QuantizationType
+    space: DistanceSpace
+    quantizer: ScalarQuantizer | None
+    _lock: threading.Lock
+
+    def __init__(
+        self,
+        dtype: QuantizationType,
+        space: DistanceSpace = "l2",
+        quantizer: ScalarQuantizer | None = None,
+    ):
+        self.dtype = dtype
+        self.space = space
+        self.quantizer = quantizer
+        self._lock = threading.Lock()
+        self._ids: NDArray[np.str_] = np.array([], dtype=np.str_)
+        self._codes: NDArray[Any] | None = None
+        self._sq_norms: NDArray[np.float32] = np.array([], dtype=np.float32)
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    @property
+    def nbytes(self) -> int:
+        """Resident size of ids, codes and norms"""
+        codes = 0 if self._codes is None else self._codes.nbytes
+        return self._ids.nbytes + codes + self._sq_norms.nbytes
+
+    def add(self, ids: list[str], vectors: NDArray[Any] | list[list[float]]) -> None:
+        if len(ids) == 0:
+            return
+        vectors = np.asarray(vectors, dtype=np.float32)
+        with self._lock:
+            if self.quantizer is None:
+                self.quantizer = ScalarQuantizer.fit(self.dtype, vectors)
+            elif not self.quantizer.covers(vectors):
+                self._requantize(self.quantizer.extend(vectors))
+            assert self.quantizer is not None
+            codes = self.quantizer.encode(vectors)
+            decoded = self.quantizer.decode(codes)
+            sq_norms = np.einsum("ij,ij->i", decoded, decoded)
+            keep = ~np.isin(self._ids, ids)
+            self._ids = np.concatenate([self._ids[keep], np.asarray(ids, dtype=np.str_)])
+            self._codes = (
+                codes if self._codes is None else np.concatenate([self._codes[keep], codes])
+            )
+            self._sq_norms = np.concatenate([self._sq_norms[keep], sq_norms])
+
+    def _requantize(self, quantizer: ScalarQuantizer) -> None:
+        """Re-encode the stored codes with `quantizer`, under the lock"""
+        old, self.quantizer = self.quantizer, quantizer
+        if self._codes is None or old is None:
+            return
+        logger.debug(f"Re-quantizing {len(self._ids)} vectors to a wider range")
+        codes = np.empty_like(self._codes)
+        sq_norms = np.empty_like(self._sq_norms)
+        for start in range(0, len(codes), SEARCH_BLOCK_ROWS):
+            end = start + SEARCH_BLOCK_ROWS
+            codes[start:end] = quantizer.encode(old.decode(self._codes[start:end]))
+            decoded = quantizer.decode(codes[start:end])
+            sq_norms[start:end] = np.einsum("ij,ij->i", decoded, decoded)
+        self._codes, self._sq_norms = codes, sq_norms
+
+    def remove(self, ids: list[str]) -> None:
+        if len(ids) == 0 or self._codes is None:
+            return
+        with self._lock:
+            keep = ~np.isin(self._ids, ids)
+            self._ids, self._codes = self._ids[keep], self._codes[keep]
+            self._sq_norms = self._sq_norms[keep]
+
+    def search(self, query: NDArray[Any] | list[float], k: int) -> list[tuple[str, float]]:
+        """Return up to `k` `(id, distance)` pairs, closest first"""
+        with self._lock:
+            ids, codes, sq_norms, quantizer = self._ids, self._codes, self._sq_norms, self.quantizer
+        if codes is None or quantizer is None or len(ids) == 0:
+            return []
+        q = np.asarray(query, dtype=np.float32)
+        dist = np.empty(len(ids), dtype=np.float32)
+        for start in range(0, len(ids), SEARCH_BLOCK_ROWS):
+            end = start + SEARCH_BLOCK_ROWS
+            block = quantizer.decode(codes[start:end])
+            dist[start:end] = distances(block, q, self.space, sq_norms[start:end])
+        k = min(k, len(ids))
+        top = np.argpartition(dist, k - 1)[:k]
+        top = top[np.argsort(dist[top])]
+        return [(str(ids[i]), float(dist[i])) for i in top]
+
+    def save(self, path: Path) -> None:
+        with self._lock:
+            if self._codes is None or self.quantizer is None:
+                return
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = path.with_suffix(".tmp.npz")
+            np.savez(
+                tmp,
+                ids=self._ids,
+                codes=self._codes,
+                sq_norms=self._sq_norms,
+                scale=self.quantizer.scale,
+                offset=self.quantizer.offset,
+                meta=np.array([self.dtype, self.space]),
+            )
+            tmp.replace(path)
+
+    @classmethod
+    def load(cls, path: Path) -> "QuantizedIndex":
+        with np.load(path) as data:
+            dtype, space = (str(s) for s in data["meta"])
+            index = cls(
+                dtype,  # pyright: ignore[reportArgumentType]
+                space,  # pyright: ignore[reportArgumentType]
+                ScalarQuantizer(dtype, data["scale"], data["offset"]),  # pyright: ignore[reportArgumentType]
+            )
+            index._ids = data["ids"]
+            index._codes = data["codes"]
+            index._sq_norms = data["sq_norms"]
+        logger.debug(f"Loaded {len(index)} {dtype} vectors from {path}")
+        return index
+
+
+def exact_top_k(
+    vectors: NDArray[np.float32], query: NDArray[np.float32], k: int, space: DistanceSpace = "l2"
+) -> list[int]:
+    dist = distances(vectors, query, space)
+    return [int(i) for i in np.argsort(dist)[:k]]
+
+
+def hnsw_bytes(n_vectors: int, m: int = HNSW_M) -> int:
+    """Approximate size of an hnswlib graph without its vectors: level 0 links,
+    their count and the label of each vector, upper levels are negligible.
+
+    >>> hnsw_bytes(1000)
+    140000
+    """
+    return n_vectors * (2 * m * 4 + 4 + 8)
+
+
+def benchmark_recall(
+    vectors: NDArray[Any],
+    queries: NDArray[Any],
+    k: int = 4,
+    dtype: QuantizationType = "int8",
+    rescore_candidates: int = 0,
+    space: DistanceSpace = "l2",
+) -> dict[str, Any]:
+    """Compare quantized search against exact float32 search.
+
+    Returns recall@k of the quantized index (with and without rescoring of the
+    top `rescore_candidates`) and its size, ids included, relative to float32
+    vectors. The vector store keeps its float32 vectors and HNSW graph next to
+    the index, `total_bytes` is what a quantized collection holds altogether
+    and `store_bytes` what it would without quantization.
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    index = QuantizedIndex(dtype, space)
+    # ids of the length Chroma uses, uuid4 strings, they take a large part of the index
+    index.add([f"{i:036d}" for i in range(len(vectors))], vectors)
+    hits = rescored_hits = 0
+    for q in np.asarray(queries, dtype=np.float32):
+        exact = set(exact_top_k(vectors, q, k, space))
+        found = [int(i) for i, _ in index.search(q, k)]
+        hits += len(exact.intersection(found))
+        if rescore_candidates > k:
+            candidates = np.array([int(i) for i, _ in index.search(q, rescore_candidates)])
+            order = np.argsort(distances(vectors[candidates], q, space))[:k]
+            rescored_hits += len(exact.intersection(candidates[order].tolist()))
+    total = k * len(queries)
+    store_bytes = vectors.nbytes + hnsw_bytes(len(vectors)) + len(vectors) * 36
+    report: dict[str, Any] = {
+        "dtype": dtype,
+        "n_vectors": len(vectors),
+        "dim": vectors.shape[1],
+        "k": k,
+        "float32_bytes": vectors.nbytes,
+        "quantized_bytes": index.nbytes,
+        "memory_ratio": vectors.nbytes / index.nbytes,
+        "store_bytes": store_bytes,
+        "total_bytes": store_bytes + index.nbytes,
+        "recall": hits / total,
+        "recall_delta": hits / total - 1.0,
+    }
+    if rescore_candidates > k:
+        report["rescore_candidates"] = rescore_candidates
+        report["rescored_recall"] = rescored_hits / total
+        report["rescored_recall_delta"] = rescored_hits / total - 1.0
+    return report
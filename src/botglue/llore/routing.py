@@ -0,0 +1,83 @@
+import asyncio
+import logging
+import threading
+from collections import deque
+from collections.abc import Awaitable, Callable, Sequence
+from typing import TypeVar
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+LATENCY_WINDOW = 200
+MIN_SAMPLES = 20
+
+
+class LatencyWindow:
+    """Latencies of the last `size` successful calls
+
+    >>> w = LatencyWindow(min_samples=2)
+    >>> w.percentile(0.9, default=1.5)
+    1.5
+    >>> for v in (0.1, 0.2, 0.3, 0.4, 1.0): w.observe(v)
+    >>> w.percentile(0.5, default=1.5), w.percentile(0.95, default=1.5)
+    (0.3, 1.0)
+    """
+
+    min_samples: int
+    _lock: threading.Lock
+    _values: deque[float]
+
+    def __init__(self, size: int = LATENCY_WINDOW, min_samples: int = MIN_SAMPLES):
+        self.min_samples = min_samples
+        self._lock = threading.Lock()
+        self._values = deque(maxlen=size)
+
+    def observe(self, seconds: float) -> None:
+        with self._lock:
+            self._values.append(seconds)
+
+    def percentile(self, q: float, default: float) -> float:
+        with self._lock:
+            values = sorted(self._values)
+        if len(values) < self.min_samples:
+            return default
+        return values[min(len(values) - 1, int(q * len(values)))]
+
+
+async def hedge(
+    calls: Sequence[Callable[[], Awaitable[T]]], delays: Sequence[float]
+) -> tuple[int, T]:
+    """Start `calls[0]`, then each next call once the previous `delays[i]`
+    seconds pass without a result or as soon as a call fails. The first
+    successful result wins and the calls still running are cancelled.
+
+    Returns index of the winning call and its result, raises the error of the
+    first call if all of them fail.
+    """
+    assert len(delays) == len(calls) - 1
+    tasks: list[asyncio.Future[T]] = []
+    try:
+        while True:
+            if len(tasks) < len(calls):
+                tasks.append(asyncio.ensure_future(calls[len(tasks)]()))
+            running = [t for t in tasks if not t.done()]
+            timeout = delays[len(tasks) - 1] if len(tasks) < len(calls) else None
+            if running:
+                done, _ = await asyncio.wait(
+                    running, timeout=timeout, return_when=asyncio.FIRST_COMPLETED
+                )
+            else:
+                done = set()
+            for t in sorted(done, key=tasks.index):
+                if t.exception() is None:
+                    return tasks.index(t), t.result()
+                logger.info(f"Hedged call {tasks.index(t)} failed: {t.exception()!r}")
+            # on timeout or failure the next call is started
+            if len(tasks) == len(calls) and all(t.done() for t in tasks):
+                raise tasks[0].exception()  # pyright: ignore[reportGeneralTypeIssues]
+    finally:
+        losers = [t for t in tasks if not t.done()]
+        for t in losers:
+            t.cancel()
+        await asyncio.gather(*losers, return_exceptions=True)
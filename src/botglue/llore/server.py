@@ -1,14 +1,23 @@
+import argparse
 import asyncio
 import logging
+import math
+import sys
 from pathlib import Path
 
 import tornado.web
 from typing_extensions import override
 
+from botglue.concurrency import ExecutorBusy
+from botglue.deadline import DeadlineExceeded
 from botglue.llore.api import ChatRequest, Models
+from botglue.llore.batch import run_batch
 from botglue.llore.pipeline import Llore
+from botglue.metrics import REGISTRY, MetricsRegistry
 from botglue.periodic import Moment
+from botglue.ratelimit import RateLimited
 from botglue.service import App, AppService, AppState, PortSeekStrategy
+from botglue.timing import span
 
 logging.basicConfig(
     level=logging.DEBUG, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s"
@@ -26,15 +35,38 @@ class LloreState(AppState):
         port_seek: PortSeekStrategy | None = None,
         debug: bool = False,
         root: str | Path | None = None,
+        config_path: str | Path = "data/config.json",
+        profiling: bool = False,
+        log_timings: bool = False,
+        unix_socket: str | Path | None = None,
+        tcp: bool = True,
+        registry: MetricsRegistry = REGISTRY,
     ):
-        super().__init__(*app_services, port=port, port_seek=port_seek, debug=debug)
-        self.llore = Llore(root=root)
+        super().__init__(
+            *app_services,
+            port=port,
+            port_seek=port_seek,
+            debug=debug,
+            profiling=profiling,
+            log_timings=log_timings,
+            unix_socket=unix_socket,
+            tcp=tcp,
+            registry=registry,
+        )
+        self.llore = Llore(config_path, root=root, registry=self.registry)
 
 
 class LloreService(AppService[LloreState]):
-    """A service that returns ok"""
+    """Chat and model routes of the Llore API. At most `max_chats` chats are
+    handled at once and `max_queued_chats` more wait, others get 503. Chats
+    taking longer than `chat_timeout` seconds get 504."""
 
-    def __init__(self):
+    def __init__(
+        self,
+        max_chats: int | None = None,
+        max_queued_chats: int = 0,
+        chat_timeout: float | None = None,
+    ):
         super().__init__()
         self.add_periodic(60, self._process_files)
         self.add_periodic(2, lambda: None)  # to make it quit on ctrl-c quickly
@@ -45,17 +77,57 @@ class LloreService(AppService[LloreState]):
             async def post(self):
                 if service.app_state is None:
                     raise RuntimeError("App state not initialized")
-                request = ChatRequest.model_validate_json(self.request.body)
+                llore = service.app_state.llore
+                with span("validate"):
+                    request = ChatRequest.model_validate_json(self.request.body)
+                try:
+                    if request.stream:
+                        await self.stream(request, llore)
+                        return
+                    if request.bot_name is not None:
+                        result = await llore.query_bot(
+                            request.bot_name,
+                            request.messages,
+                            llm_name=request.llm_name,
+                            priority=request.priority,
+                        )
+                    else:
+                        assert request.llm_name is not None
+                        result = await llore.query_llm(
+                            request.llm_name, request.messages, priority=request.priority
+                        )
+                except ExecutorBusy as e:
+                    raise tornado.web.HTTPError(503, f"Retrieval is busy: {e}") from e
+                except DeadlineExceeded as e:
+                    raise tornado.web.HTTPError(504, f"Deadline exceeded: {e}") from e
+                except RateLimited as e:
+                    # not HTTPError, send_error() would drop the Retry-After header
+                    self.set_status(429)
+                    self.set_header("Retry-After", str(max(1, math.ceil(e.retry_after))))
+                    self.write({"error": f"Too many queued requests: {e}"})
+                    return
+                with span("serialize"):
+                    body = result.model_dump_json()
+                self.write(body)
+
+            async def stream(self, request: ChatRequest, llore: Llore):
+                """Write newline delimited `ChatChunk`s, flushing each one"""
                 if request.bot_name is not None:
-                    result = await service.app_state.llore.query_bot(
-                        request.bot_name, request.messages, llm_name=request.llm_name
+                    chunks = llore.stream_bot(
+                        request.bot_name,
+                        request.messages,
+                        llm_name=request.llm_name,
+                        priority=request.priority,
                     )
                 else:
                     assert request.llm_name is not None
-                    result = await service.app_state.llore.query_llm(
-                        request.llm_name, request.messages
+                    chunks = llore.stream_llm(
+                        request.llm_name, request.messages, priority=request.priority
                     )
-                self.write(result.model_dump_json())
+                self.set_header("Content-Type", "application/x-ndjson")
+                async for chunk in chunks:
+                    self.write(chunk.model_dump_json() + "\n")
+                    await self.flush()
 
         class ModelsHandler(tornado.web.RequestHandler):
             @override
@@ -65,15 +137,34 @@ class LloreService(AppService[LloreState]):
                 models: Models = service.app_state.llore.get_models()
                 self.write(models.model_dump_json())
 
+        class ModelStatsHandler(tornado.web.RequestHandler):
+            @override
+            def get(self):
+                if service.app_state is None:
+                    raise RuntimeError("App state not initialized")
+                models = service.app_state.llore.config.llm_models
+                self.write({name: llm.metrics.model_stats(name) for name, llm in models.items()})
+
         class MainHandler(tornado.web.RequestHandler):
             @override
             def get(self):
                 self.write("Welcome to Llore API")
 
-        self.add_route(r"/chats", ChatHandler)
+        self.add_route(
+            r"/chats",
+            ChatHandler,
+            max_concurrency=max_chats,
+            max_queue=max_queued_chats,
+            timeout=chat_timeout,
+        )
         self.add_route(r"/models", ModelsHandler)
+        self.add_route(r"/models/stats", ModelStatsHandler)
         self.add_route(r"/", MainHandler)
 
+    @override
+    async def warmup(self) -> None:
+        await self.get_app_state().llore.warmup()
+
     def _process_files(self):
         if self.app_state is None:
             raise RuntimeError("App state not initialized")
@@ -83,10 +174,110 @@ class LloreService(AppService[LloreState]):
         logger.info(f"Finished processing files: {moment.capture('finished')}")
 
 
-def run_server(port: int = 7532, debug: bool = False):
-    """Run the Tornado server"""
-    app = App("llore", LloreState(LloreService(), port=port, debug=debug))
-    asyncio.run(app.run())
+def run_server(
+    port: int = 7532,
+    debug: bool = False,
+    workers: int = 1,
+    reuse_port: bool = False,
+    drain_timeout: float = 30.0,
+    max_chats: int | None = None,
+    max_queued_chats: int = 0,
+    chat_timeout: float | None = None,
+    lag_threshold: float | None = 0.5,
+    profiling: bool = False,
+    log_timings: bool = False,
+    unix_socket: str | Path | None = None,
+    tcp: bool = True,
+):
+    """Run the Tornado server, in `workers` forked processes if more than one"""
+    service = LloreService(max_chats, max_queued_chats, chat_timeout)
+    state = LloreState(
+        service,
+        port=port,
+        debug=debug,
+        profiling=profiling,
+        log_timings=log_timings,
+        unix_socket=unix_socket,
+        tcp=tcp,
+    )
+    app = App("llore", state, drain_timeout=drain_timeout, lag_threshold=lag_threshold)
+    app.run_workers(workers, reuse_port=reuse_port)
+
+
+def main(argv: list[str] | None = None) -> None:
+    """`botglue [serve]` runs the server, `botglue batch` runs a JSONL file of
+    `ChatRequest`s offline"""
+    parser = argparse.ArgumentParser(prog="botglue")
+    commands = parser.add_subparsers(dest="command")
+    serve = commands.add_parser("serve", help="Run the Llore API server (default)")
+    serve.add_argument("--port", type=int, default=7532)
+    serve.add_argument("--debug", action="store_true")
+    serve.add_argument("--workers", type=int, default=1, help="Processes sharing the port")
+    serve.add_argument("--reuse-port", action="store_true", help="A SO_REUSEPORT socket per worker")
+    serve.add_argument(
+        "--drain-timeout", type=float, default=30.0, help="Seconds to finish requests on stop"
+    )
+    serve.add_argument("--max-chats", type=int, help="Chats handled at once per worker")
+    serve.add_argument(
+        "--max-queued-chats", type=int, default=0, help="Chats waiting beyond --max-chats"
+    )
+    serve.add_argument(
+        "--chat-timeout", type=float, help="Seconds before a chat gets 504, unless sooner asked"
+    )
+    serve.add_argument(
+        "--lag-threshold",
+        type=float,
+        default=0.5,
+        help="Log the stack of code blocking the event loop longer than that, 0 to disable",
+    )
+    serve.add_argument(
+        "--profiling", action="store_true", help="Serve /admin/profile?seconds=10&mode=sample"
+    )
+    serve.add_argument(
+        "--log-timings", action="store_true", help="Log Server-Timing spans of requests as JSON"
+    )
+    serve.add_argument(
+        "--unix-socket", type=Path, help="Also serve on a Unix socket, for clients on this host"
+    )
+    serve.add_argument(
+        "--no-tcp", action="store_true", help="Serve only on --unix-socket, not on --port"
+    )
+    batch = commands.add_parser("batch", help="Answer ChatRequest lines of a JSONL file")
+    batch.add_argument("input", type=Path, help="JSONL file of ChatRequest, optional `id`")
+    batch.add_argument("output", type=Path, help="JSONL file of results, appended to on resume")
+    batch.add_argument("--concurrency", type=int, default=8)
+    batch.add_argument("--config", type=Path, default=Path("data/config.json"))
+    args = parser.parse_args(argv)
+
+    if args.command == "batch":
+        llore = Llore(args.config)
+        summary = asyncio.run(run_batch(llore, args.input, args.output, args.concurrency))
+        print(summary.model_dump_json())
+        sys.exit(1 if summary.failed else 0)
+    elif args.command == "serve":
+        if args.debug and args.workers > 1:
+            parser.error(
+                "--debug reloads code in a single process, it can't be used with --workers"
+            )
+        if args.no_tcp and args.unix_socket is None:
+            parser.error("--no-tcp needs --unix-socket")
+        run_server(
+            port=args.port,
+            debug=args.debug,
+            workers=args.workers,
+            reuse_port=args.reuse_port,
+            drain_timeout=args.drain_timeout,
+            max_chats=args.max_chats,
+            max_queued_chats=args.max_queued_chats,
+            chat_timeout=args.chat_timeout,
+            lag_threshold=args.lag_threshold or None,
+            profiling=args.profiling,
+            log_timings=args.log_timings,
+            unix_socket=args.unix_socket,
+            tcp=not args.no_tcp,
+        )
+    else:
+        run_server()
 
 
 if __name__ == "__main__":
@@ -2,7 +2,7 @@ import logging
 import sqlite3
 from datetime import UTC, datetime
 from pathlib import Path
-from typing import Literal, cast
+from typing import Any, Literal, cast
 
 from pydantic import BaseModel, Field
 
@@ -69,19 +69,34 @@ class ConvoSession(DbModel["ConvoSession"]):
     session_type: Literal["active", "completed", "failed", "archived"] = "active"
 
 
-tables = [RagSource, RagAction, RagActionCollection, ConvoMessage, ConvoSession]
+class LlmResponse(DbModel["LlmResponse"]):
+    cache_key: str = Field(description="(PK) SHA256 of the canonical request url and body")
+    model: str = Field(description="Name of the llm model that produced the response")
+    created: datetime = Field(default_factory=utc_now)
+    accessed: datetime = Field(default_factory=utc_now)
+    expires: datetime = Field(description="When the response should no longer be served")
+    hits: int = Field(default=0, ge=0, description="Times served from the cache")
+    body: str = Field(description="Raw response body")
 
 
-def check_all_tables_exist(conn: sqlite3.Connection):
+tables = [RagSource, RagAction, RagActionCollection, ConvoMessage, ConvoSession, LlmResponse]
+
+
+def missing_tables(conn: sqlite3.Connection) -> list[type[DbModel[Any]]]:
     cursor = conn.cursor()
     execute_sql(cursor, "SELECT name FROM sqlite_master WHERE type='table' ")
     all_tables = set(r[0] for r in cursor.fetchall())
-    return all(t.get_table_name() in all_tables for t in tables)
+    return [t for t in tables if t.get_table_name() not in all_tables]
+
+
+def check_all_tables_exist(conn: sqlite3.Connection):
+    return len(missing_tables(conn)) == 0
 
 
 def create_tables(conn: sqlite3.Connection):
+    """Create tables that are missing, so databases of older versions get the new ones"""
     cursor = conn.cursor()
-    for table in tables:
+    for table in missing_tables(conn):
         execute_sql(cursor, table.create_ddl())
     conn.commit()
 
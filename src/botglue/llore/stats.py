@@ -0,0 +1,89 @@
+import asyncio
+from typing import Any
+
+from tornado.httpclient import HTTPClientError
+
+from botglue.metrics import REGISTRY, Counter, Histogram, MetricsRegistry
+from botglue.ratelimit import RateLimited
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.0, 4.0, 8.0, 15.0, 30.0, 60.0, 120.0, 300.0)
+
+
+def error_type(e: BaseException) -> str:
+    """
+    >>> error_type(HTTPClientError(599)), error_type(HTTPClientError(429))
+    ('timeout', 'http_429')
+    >>> error_type(HTTPClientError(502)), error_type(ConnectionRefusedError())
+    ('http_5xx', 'connection')
+    >>> error_type(KeyError("x"))
+    'KeyError'
+    """
+    if isinstance(e, HTTPClientError):
+        if e.code == 599:
+            return "timeout"
+        if e.code in (429, 400, 401, 403, 404):
+            return f"http_{e.code}"
+        return f"http_{e.code // 100}xx"
+    if isinstance(e, RateLimited):
+        return "rate_limited"
+    if isinstance(e, asyncio.TimeoutError):
+        return "timeout"
+    if isinstance(e, OSError):
+        return "connection"
+    return type(e).__name__
+
+
+class LlmMetrics:
+    """Per model request metrics, labeled with the `llm_models` key.
+
+    Latency covers the whole call: rate limit and pool waits, retries and
+    the upstream request. TTFT is recorded for streamed generations only,
+    for the others it is the latency.
+    """
+
+    registry: MetricsRegistry
+    requests: Counter
+    errors: Counter
+    latency: Histogram
+    ttft: Histogram
+    tokens: Counter
+
+    def __init__(self, registry: MetricsRegistry = REGISTRY):
+        self.registry = registry
+        self.requests = registry.counter("llm_requests_total", "Upstream LLM requests")
+        self.errors = registry.counter("llm_errors_total", "Failed LLM requests by type")
+        self.latency = registry.histogram(
+            "llm_latency_seconds", "Total LLM request latency", LATENCY_BUCKETS
+        )
+        self.ttft = registry.histogram(
+            "llm_ttft_seconds", "Time to the first streamed token", LATENCY_BUCKETS
+        )
+        self.tokens = registry.counter("llm_tokens_total", "Tokens reported in usage")
+
+    def failed(self, model: str, e: BaseException) -> None:
+        self.errors.inc(model=model, type=error_type(e))
+
+    def usage(self, model: str, prompt: int, completion: int) -> None:
+        self.tokens.inc(prompt, model=model, kind="prompt")
+        self.tokens.inc(completion, model=model, kind="completion")
+
+    def model_stats(self, model: str) -> dict[str, Any]:
+        """Summary of the model's metrics, including the ones of its http pool
+        and rate limiter"""
+        latency = self.latency.merged(model=model)
+        tokens = self.tokens.by("kind", model=model)
+        completion = tokens.get("completion", 0)
+        pool_wait = self.registry.histogram("http_pool_queue_wait_seconds")
+        ttfb = self.registry.histogram("http_pool_ttfb_seconds")
+        rate_limit_wait = self.registry.histogram("rate_limit_wait_seconds")
+        return {
+            "requests": self.requests.get(model=model),
+            "errors": self.errors.by("type", model=model),
+            "latency": latency.summary(),
+            "ttfb": ttfb.merged(pool=model).summary(),
+            "ttft": self.ttft.merged(model=model).summary(),
+            "pool_wait": pool_wait.merged(pool=model).summary(),
+            "rate_limit_wait": rate_limit_wait.merged(limiter=model).summary(),
+            "tokens": {"prompt": tokens.get("prompt", 0), "completion": completion},
+            "completion_tokens_per_second": completion / latency.sum if latency.sum else 0.0,
+        }
@@ -1,15 +1,26 @@
+import hashlib
+import heapq
 import logging
 import os
-from collections.abc import Generator
+from collections.abc import Generator, Iterable
 from pathlib import Path
+from typing import Any
 
 import chromadb.config
+import numpy as np
+from chromadb.api.shared_system_client import SharedSystemClient
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain_chroma import Chroma
 from langchain_community.document_loaders import PyPDFLoader
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.retrievers import BaseRetriever
 from langchain_huggingface import HuggingFaceEmbeddings
+from typing_extensions import override
 
-from botglue.llore.config import Config
+from botglue.llore.config import Config, RagConfig
+from botglue.llore.quant import DistanceSpace, QuantizedIndex, distances
 from botglue.misc import ensure_dir
 
 os.environ["TOKENIZERS_PARALLELISM"] = "false"
@@ -33,7 +44,28 @@ def gen_matching_snapshots(cache_dir: Path, model_name: str) -> Generator[str, N
                     yield f"{model_dir.name}/snapshots/{snapshot_dir.name}"
 
 
-def get_vector_collection(config: Config, collection: str) -> Chroma:
+def shard_names(config: Config, collection: str) -> list[str]:
+    """Physical collections behind the logical `collection`"""
+    n = config.vector_db.shards
+    if n == 1:
+        return [collection]
+    return [f"{collection}_s{i}of{n}" for i in range(n)]
+
+
+def shard_for_source(config: Config, collection: str, source: Path | str) -> str:
+    """Physical collection that holds all chunks of the `source` file. Uses a
+    stable hash, so the same file is routed to the same shard across restarts"""
+    names = shard_names(config, collection)
+    if len(names) == 1:
+        return names[0]
+    digest = hashlib.sha256(str(source).encode()).digest()
+    return names[int.from_bytes(digest[:8], "big") % len(names)]
+
+
+def get_vector_collection(
+    config: Config, collection: str, embeddings: Embeddings | None = None
+) -> Chroma:
+    """Open `collection`, with the configured embeddings model unless given"""
     db_cfg = config.vector_db
     emb_cfg = db_cfg.embeddings
 
@@ -44,7 +76,9 @@ def get_vector_collection(config: Config, collection: str) -> Chroma:
             encode_kwargs=emb_cfg.encode_params,  # {'normalize_embeddings': True}
         )
 
-    if emb_cfg.cache_model:
+    if embeddings is not None:
+        pass
+    elif emb_cfg.cache_model:
         os.environ["SENTENCE_TRANSFORMERS_HOME"] = str(ensure_dir(config.hf_hub_dir).absolute())
         if emb_cfg.cache_path is None:
             embeddings = load_embeddings()
@@ -78,7 +112,200 @@ def load_document_into_chunks(file_path: Path):
     loader = get_document_loader(file_path)
     documents = loader.load()
     text_splitter = RecursiveCharacterTextSplitter(
-        chunk_size=1000, chunk_overlap=200, length_function=len
+        chunk_size=1000, chunk_overlap=200, length_function=len, add_start_index=True
     )
     splits = text_splitter.split_documents(documents)
     return splits
+
+
+def get_distance_space(db: Chroma) -> DistanceSpace:
+    metadata = db._collection.metadata  # pyright: ignore[reportPrivateUsage]
+    return (metadata or {}).get("hnsw:space", "l2")
+
+
+def quantized_index_path(config: Config, collection: str) -> Path:
+    return config.vector_db.dir / "quantized" / f"{collection}.{config.vector_db.quantization}.npz"
+
+
+_quantized_indexes: dict[Path, QuantizedIndex] = {}
+
+
+def get_quantized_index(config: Config, collection: str, db: Chroma) -> QuantizedIndex | None:
+    """Quantized copy of collection embeddings, loaded once per process.
+    Built from Chroma on first use if the collection predates quantization.
+    Chroma keeps its float32 embeddings, they are needed for rescoring."""
+    if config.vector_db.quantization == "none":
+        return None
+    path = quantized_index_path(config, collection)
+    if path not in _quantized_indexes:
+        if path.exists():
+            index = QuantizedIndex.load(path)
+        else:
+            index = QuantizedIndex(config.vector_db.quantization, get_distance_space(db))
+            existing = db.get(include=["embeddings"])
+            if len(existing["ids"]) > 0:
+                logger.info(f"Quantizing {len(existing['ids'])} embeddings of {collection}")
+                index.add(existing["ids"], existing["embeddings"])
+                index.save(path)
+        _quantized_indexes[path] = index
+    return _quantized_indexes[path]
+
+
+def ingest_version(config: Config) -> int:
+    """Changes whenever `mark_ingested` is called, by any process"""
+    try:
+        return (config.vector_db.dir / "ingested").stat().st_mtime_ns
+    except FileNotFoundError:
+        return 0
+
+
+def mark_ingested(config: Config) -> int:
+    """Let other processes serving the collections know they changed"""
+    stamp = ensure_dir(config.vector_db.dir) / "ingested"
+    stamp.touch()
+    return stamp.stat().st_mtime_ns
+
+
+def forget_collections(config: Config) -> None:
+    """Drop what this process cached of the collections, so they are opened
+    again with changes made by other processes. Chroma clients and collections
+    opened before keep working on the old data."""
+    SharedSystemClient.clear_system_cache()
+    for path in list(_quantized_indexes):
+        if path.is_relative_to(config.vector_db.dir):
+            del _quantized_indexes[path]
+
+
+def add_chunks(config: Config, collection: str, db: Chroma, chunks: list[Document]) -> list[str]:
+    """Add chunks to the collection, keeping the quantized index in sync"""
+    ids = db.add_documents(chunks)
+    index = get_quantized_index(config, collection, db)
+    if index is not None:
+        added = db.get(ids=ids, include=["embeddings"])
+        index.add(added["ids"], added["embeddings"])
+        index.save(quantized_index_path(config, collection))
+    return ids
+
+
+def delete_source(config: Config, collection: str, db: Chroma, path: Path) -> None:
+    """Delete all chunks of the source file from the collection"""
+    index = get_quantized_index(config, collection, db)
+    if index is None:
+        db.delete(where={"source": str(path)})
+        return
+    ids = db.get(where={"source": str(path)}, include=[])["ids"]
+    if ids:
+        db.delete(ids=ids)
+        index.remove(ids)
+        index.save(quantized_index_path(config, collection))
+
+
+class QuantizedRetriever(BaseRetriever):
+    """Retriever that searches the quantized index and loads documents from Chroma"""
+
+    vectorstore: Chroma
+    index: QuantizedIndex
+    k: int = 4
+    rescore_candidates: int = 0
+    score_threshold: float | None = None
+
+    def search(self, query: str) -> list[tuple[str, float]]:
+        return self.search_by_vector(self.vectorstore.embeddings.embed_query(query))  # pyright: ignore[reportOptionalMemberAccess]
+
+    def search_by_vector(self, vector: list[float]) -> list[tuple[str, float]]:
+        """`(id, distance)` pairs of the closest chunks"""
+        q = np.asarray(vector, dtype=np.float32)
+        if self.rescore_candidates <= self.k:
+            found = self.index.search(q, self.k)
+        else:
+            candidates = [i for i, _ in self.index.search(q, self.rescore_candidates)]
+            exact = self.vectorstore.get(ids=candidates, include=["embeddings"])
+            vectors = np.asarray(exact["embeddings"], dtype=np.float32)
+            dist = distances(vectors, q, self.index.space)
+            order = np.argsort(dist)[: self.k]
+            found = [(exact["ids"][i], float(dist[i])) for i in order]
+        if self.score_threshold is not None:
+            relevance = self.vectorstore._select_relevance_score_fn()  # pyright: ignore[reportPrivateUsage]
+            found = [(i, d) for i, d in found if relevance(d) >= self.score_threshold]
+        return found
+
+    def load_documents(self, found: list[tuple[str, float]]) -> list[tuple[Document, float]]:
+        if not found:
+            return []
+        ids = [i for i, _ in found]
+        got: dict[str, Any] = self.vectorstore.get(ids=ids, include=["documents", "metadatas"])
+        by_id = {
+            i: Document(id=i, page_content=d, metadata=m or {})
+            for i, d, m in zip(got["ids"], got["documents"], got["metadatas"], strict=True)
+        }
+        return [(by_id[i], d) for i, d in found if i in by_id]
+
+    @override
+    def _get_relevant_documents(
+        self,
+        query: str,
+        *,
+        run_manager: CallbackManagerForRetrieverRun,  # pyright: ignore[reportUnusedParameter]
+    ) -> list[Document]:
+        return [doc for doc, _ in self.load_documents(self.search(query))]
+
+
+def _quantized_retriever(
+    config: Config, db: Chroma, index: QuantizedIndex, rag: RagConfig | None
+) -> QuantizedRetriever:
+    thresholded = rag is not None and rag.search_type == "similarity_score_threshold"
+    return QuantizedRetriever(
+        vectorstore=db,
+        index=index,
+        rescore_candidates=config.vector_db.rescore_candidates,
+        k=4 if rag is None else rag.k,
+        score_threshold=rag.score_threshold if thresholded and rag is not None else None,
+    )
+
+
+def get_retriever(
+    config: Config, collection: str, db: Chroma, rag: RagConfig | None = None
+) -> BaseRetriever:
+    """Retriever configured by `rag` search settings. Quantized collections
+    support only similarity search, "mmr" falls back to it."""
+    index = get_quantized_index(config, collection, db)
+    if index is None:
+        if rag is None:
+            return db.as_retriever()
+        return db.as_retriever(search_type=rag.search_type, search_kwargs=rag.search_kwargs())
+    return _quantized_retriever(config, db, index, rag)
+
+
+def search_by_vector(
+    config: Config, collection: str, db: Chroma, rag: RagConfig, vector: list[float]
+) -> list[tuple[Document, float]]:
+    """Top `rag.k` chunks of one collection with relevance scores, higher is
+    better, so results of several collections can be merged. "mmr" results
+    carry no similarity, they are scored by rank."""
+    relevance = db._select_relevance_score_fn()  # pyright: ignore[reportPrivateUsage]
+    index = get_quantized_index(config, collection, db)
+    if index is not None:
+        retriever = _quantized_retriever(config, db, index, rag)
+        found = retriever.load_documents(retriever.search_by_vector(vector))
+        return [(doc, relevance(d)) for doc, d in found]
+    if rag.search_type == "mmr":
+        docs = db.max_marginal_relevance_search_by_vector(vector, **rag.search_kwargs())
+        return [(doc, 1.0 / (1 + rank)) for rank, doc in enumerate(docs)]
+    found = db.similarity_search_by_vector_with_relevance_scores(vector, k=rag.k)
+    scored = [(doc, relevance(d)) for doc, d in found]
+    if rag.search_type == "similarity_score_threshold" and rag.score_threshold is not None:
+        scored = [(doc, r) for doc, r in scored if r >= rag.score_threshold]
+    return scored
+
+
+def merge_top_k(
+    results: Iterable[list[tuple[Document, float]]], k: int
+) -> list[tuple[Document, float]]:
+    """Global top `k` across per-collection results
+
+    >>> a = [(Document(page_content="a1"), 0.9), (Document(page_content="a2"), 0.5)]
+    >>> b = [(Document(page_content="b1"), 0.7)]
+    >>> [d.page_content for d, _ in merge_top_k([a, b], 2)]
+    ['a1', 'b1']
+    """
+    return heapq.nlargest(k, (r for rs in results for r in rs), key=lambda r: r[1])
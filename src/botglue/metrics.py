@@ -0,0 +1,290 @@
+import math
+import threading
+from collections.abc import Iterable
+from typing import Any
+
+from typing_extensions import override
+
+LabelKey = tuple[tuple[str, str], ...]
+
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _key(labels: dict[str, Any]) -> LabelKey:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _format_labels(key: LabelKey, extra: Iterable[tuple[str, str]] = ()) -> str:
+    """
+    >>> _format_labels((("model", "4o"),), [("le", "0.5")])
+    '{model="4o",le="0.5"}'
+    >>> _format_labels(())
+    ''
+    """
+    pairs = [*key, *extra]
+    if not pairs:
+        return ""
+    escaped = (v.replace("\\", "\\\\").replace('"', '\\"') for _, v in pairs)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped, strict=True)) + "}"
+
+
+def _format_value(v: float) -> str:
+    if math.isinf(v):
+        return "+Inf" if v > 0 else "-Inf"
+    return repr(float(v)) if v != int(v) else str(int(v))
+
+
+class Metric:
+    kind: str = "untyped"
+    name: str
+    help: str
+    _lock: threading.Lock
+    _values: dict[LabelKey, Any]
+
+    def __init__(self, name: str, help: str = ""):
+        self.name = name
+        self.help = help
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            for key, v in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(key)} {_format_value(v)}")
+        return lines
+
+    def snapshot(self) -> dict[LabelKey, Any]:
+        with self._lock:
+            return dict(self._values)
+
+    def get(self, **labels: Any) -> Any:
+        with self._lock:
+            return self._values.get(_key(labels), 0)
+
+    def matching(self, **labels: Any) -> dict[LabelKey, Any]:
+        """Series whose labels include all of `labels`"""
+        wanted = set(_key(labels))
+        with self._lock:
+            return {k: v for k, v in self._values.items() if wanted.issubset(k)}
+
+    def by(self, label: str, **labels: Any) -> dict[str, Any]:
+        """Sum of matching series grouped by the value of `label`
+
+        >>> c = Counter("errors_total")
+        >>> c.inc(model="a", type="timeout"); c.inc(model="a", type="http_500")
+        >>> c.inc(model="b", type="timeout")
+        >>> c.by("type", model="a")
+        {'http_500': 1, 'timeout': 1}
+        """
+        grouped: dict[str, Any] = {}
+        for key, v in sorted(self.matching(**labels).items()):
+            group = dict(key).get(label)
+            if group is not None:
+                grouped[group] = grouped.get(group, 0) + v
+        return grouped
+
+    @override
+    def __repr__(self):
+        return f"{self.__class__.__name__}({self.name!r})"
+
+
+class Counter(Metric):
+    """
+    >>> c = Counter("requests_total")
+    >>> c.inc(route="/chats"); c.inc(2, route="/chats")
+    >>> c.get(route="/chats")
+    3
+    """
+
+    kind: str = "counter"
+
+    def inc(self, amount: float = 1, **labels: Any) -> None:
+        key = _key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """
+    >>> g = Gauge("in_flight")
+    >>> g.inc(); g.inc(); g.dec()
+    >>> g.get()
+    1
+    >>> g.set(5); g.get()
+    5
+    """
+
+    kind: str = "gauge"
+
+    def set(self, value: float, **labels: Any) -> None:
+        with self._lock:
+            self._values[_key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels: Any) -> None:
+        key = _key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels: Any) -> None:
+        self.inc(-amount, **labels)
+
+
+class HistogramValue:
+    buckets: tuple[float, ...]
+    counts: list[int]
+    sum: float
+    count: int
+
+    def __init__(self, buckets: tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        for i, b in enumerate(self.buckets):
+            if value <= b:
+                self.counts[i] += 1
+                break
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        """Upper bound of the bucket that holds the `q` quantile"""
+        if self.count == 0:
+            return 0.0
+        rank, seen = q * self.count, 0
+        for b, n in zip(self.buckets, self.counts, strict=True):
+            seen += n
+            if seen >= rank:
+                return b
+        return math.inf
+
+    def merge(self, other: "HistogramValue") -> "HistogramValue":
+        assert self.buckets == other.buckets
+        merged = HistogramValue(self.buckets)
+        merged.counts = [a + b for a, b in zip(self.counts, other.counts, strict=True)]
+        merged.sum, merged.count = self.sum + other.sum, self.count + other.count
+        return merged
+
+    def summary(self) -> dict[str, float]:
+        """Count, mean and bucket bound percentiles
+
+        >>> h = HistogramValue((0.1, 1.0))
+        >>> for v in (0.05, 0.05, 0.5, 2.0): h.observe(v)
+        >>> h.summary()
+        {'count': 4, 'mean': 0.65, 'p50': 0.1, 'p95': inf, 'p99': inf}
+        """
+        mean = self.sum / self.count if self.count else 0.0
+        return {
+            "count": self.count,
+            "mean": mean,
+            "p50": self.quantile(0.5),
+            "p95": self.quantile(0.95),
+            "p99": self.quantile(0.99),
+        }
+
+    def to_dict(self) -> dict[str, Any]:
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "buckets": dict(zip(map(str, self.buckets), self.counts, strict=True)),
+        }
+
+
+class Histogram(Metric):
+    """
+    >>> h = Histogram("latency_seconds", buckets=(0.1, 1.0))
+    >>> for v in (0.05, 0.5, 5.0): h.observe(v, route="/")
+    >>> h.get(route="/").count, h.get(route="/").quantile(0.5)
+    (3, 1.0)
+    >>> print("\\n".join(h.render()[2:]))
+    latency_seconds_bucket{route="/",le="0.1"} 1
+    latency_seconds_bucket{route="/",le="1.0"} 2
+    latency_seconds_bucket{route="/",le="+Inf"} 3
+    latency_seconds_sum{route="/"} 5.55
+    latency_seconds_count{route="/"} 3
+    """
+
+    kind: str = "histogram"
+    buckets: tuple[float, ...]
+
+    def __init__(self, name: str, help: str = "", buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, help)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels: Any) -> None:
+        key = _key(labels)
+        with self._lock:
+            if key not in self._values:
+                self._values[key] = HistogramValue(self.buckets)
+            self._values[key].observe(value)
+
+    @override
+    def get(self, **labels: Any) -> HistogramValue:
+        with self._lock:
+            return self._values.get(_key(labels), HistogramValue(self.buckets))
+
+    def merged(self, **labels: Any) -> HistogramValue:
+        """All series whose labels include `labels` merged into one"""
+        merged = HistogramValue(self.buckets)
+        for v in self.matching(**labels).values():
+            merged = merged.merge(v)
+        return merged
+
+    @override
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            for key, v in sorted(self._values.items()):
+                cumulative = 0
+                for b, n in zip(v.buckets, v.counts, strict=True):
+                    cumulative += n
+                    le = _format_labels(key, [("le", str(b))])
+                    lines.append(f"{self.name}_bucket{le} {cumulative}")
+                lines.append(f"{self.name}_bucket{_format_labels(key, [('le', '+Inf')])} {v.count}")
+                lines.append(f"{self.name}_sum{_format_labels(key)} {_format_value(v.sum)}")
+                lines.append(f"{self.name}_count{_format_labels(key)} {v.count}")
+        return lines
+
+
+class MetricsRegistry:
+    """Process wide collection of metrics, rendered in Prometheus text format"""
+
+    _lock: threading.Lock
+    _metrics: dict[str, Metric]
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}
+
+    def _get_or_create(self, cls: type[Metric], name: str, **kwargs: Any) -> Any:
+        with self._lock:
+            if name not in self._metrics:
+                self._metrics[name] = cls(name, **kwargs)
+            metric = self._metrics[name]
+        assert type(metric) is cls, f"{name} is already registered as {metric!r}"
+        return metric
+
+    def counter(self, name: str, help: str = "") -> Counter:
+        return self._get_or_create(Counter, name, help=help)
+
+    def gauge(self, name: str, help: str = "") -> Gauge:
+        return self._get_or_create(Gauge, name, help=help)
+
+    def histogram(
+        self, name: str, help: str = "", buckets: tuple[float, ...] = DEFAULT_BUCKETS
+    ) -> Histogram:
+        return self._get_or_create(Histogram, name, help=help, buckets=buckets)
+
+    def metrics(self) -> list[Metric]:
+        with self._lock:
+            return list(self._metrics.values())
+
+    def render(self) -> str:
+        return "\n".join(line for m in self.metrics() for line in m.render()) + "\n"
+
+
+REGISTRY = MetricsRegistry()
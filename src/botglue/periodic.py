@@ -367,7 +367,12 @@ async def run_all(
             if shutdown_event.is_set():
                 return
         elapsed = stime.time() - start
-        await asyncio.sleep(tick - elapsed if elapsed < tick else 0)
+        try:
+            # wake up on shutdown instead of running the next due tasks
+            await asyncio.wait_for(shutdown_event.wait(), tick - elapsed if elapsed < tick else 0)
+            return
+        except TimeoutError:
+            pass
 
 
 def adjust_as_of_date(as_of_date: date | None) -> date:
@@ -0,0 +1,79 @@
+import asyncio
+import cProfile
+import io
+import pstats
+import sys
+import threading
+import time
+from collections import Counter
+from types import FrameType
+
+# one profile at a time, they would skew each other
+_PROFILING = threading.Lock()
+
+
+class ProfilerBusy(Exception):
+    """Raised when another profile of the process is running"""
+
+
+def _frame_name(frame: FrameType) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({code.co_filename}:{code.co_firstlineno})"
+
+
+def collapse(frame: FrameType | None, root: str) -> str:
+    """Stack from `root` down to `frame`, separated by `;`"""
+    names: list[str] = []
+    while frame is not None:
+        names.append(_frame_name(frame))
+        frame = frame.f_back
+    return ";".join([root, *reversed(names)])
+
+
+def sample_stacks(seconds: float, interval: float = 0.005) -> Counter[str]:
+    """Collapsed stacks of all threads but the sampling one, sampled every
+    `interval` for `seconds`. Blocks, run it in a thread."""
+    if not _PROFILING.acquire(blocking=False):
+        raise ProfilerBusy()
+    try:
+        me = threading.get_ident()
+        stacks: Counter[str] = Counter()
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():  # pyright: ignore [reportPrivateUsage]
+                if ident != me:
+                    stacks[collapse(frame, names.get(ident, str(ident)))] += 1
+            time.sleep(interval)
+        return stacks
+    finally:
+        _PROFILING.release()
+
+
+def format_collapsed(stacks: Counter[str]) -> str:
+    """Input of flamegraph.pl, speedscope and similar
+
+    >>> format_collapsed(Counter({"main;f": 3, "main;g": 1}))
+    'main;f 3\\nmain;g 1\\n'
+    """
+    return "".join(f"{stack} {n}\n" for stack, n in stacks.most_common())
+
+
+async def profile_loop(seconds: float, sort: str = "cumulative", limit: int = 100) -> str:
+    """cProfile of the event loop thread for `seconds`, as pstats text. Calls
+    run on other threads (executors, sync periodic tasks) are not seen, use
+    `sample_stacks` for them."""
+    if not _PROFILING.acquire(blocking=False):
+        raise ProfilerBusy()
+    try:
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            profile.disable()
+        out = io.StringIO()
+        pstats.Stats(profile, stream=out).sort_stats(sort).print_stats(limit)
+        return out.getvalue()
+    finally:
+        _PROFILING.release()
@@ -0,0 +1,248 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from email.utils import parsedate_to_datetime
+from typing import Literal
+
+from botglue.metrics import REGISTRY, Counter, Gauge, Histogram, MetricsRegistry
+from botglue.timing import record
+
+log = logging.getLogger(__name__)
+
+Priority = Literal["interactive", "batch"]
+PRIORITIES: dict[Priority, int] = {"interactive": 0, "batch": 1}
+
+# multiplicative decrease on throttling, additive increase on success
+DECREASE_FACTOR = 0.5
+INCREASE_SHARE = 0.05
+
+
+class RateLimited(Exception):
+    """Raised when the queue of a `RateLimiter` is full. `retry_after` is the
+    time until the buckets refill for the queued requests and this one."""
+
+    retry_after: float
+
+    def __init__(self, name: str, queued: int, retry_after: float):
+        super().__init__(name, queued)
+        self.retry_after = retry_after
+
+
+def parse_retry_after(value: str | None, now: float | None = None) -> float | None:
+    """Seconds to wait from a `Retry-After` header, delay or HTTP date
+
+    >>> parse_retry_after("1.5"), parse_retry_after(None), parse_retry_after("soon")
+    (1.5, None, None)
+    >>> parse_retry_after("Wed, 21 Oct 2015 07:28:10 GMT", now=1445412480.0)
+    10.0
+    """
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, when - (time.time() if now is None else now))
+
+
+class TokenBucket:
+    """Refills at `rate` per second up to `capacity`. A take larger than the
+    capacity waits for a full bucket and leaves it in debt, so the long run
+    rate holds for large requests too.
+
+    >>> b = TokenBucket(rate=10, capacity=5, now=0)
+    >>> b.wait_time(5, now=0), b.take(5), b.wait_time(1, now=0)
+    (0.0, None, 0.1)
+    >>> b.take(20); b.wait_time(1, now=1.0)
+    1.1
+    """
+
+    base_rate: float
+    rate: float
+    capacity: float
+    level: float
+    _updated: float
+
+    def __init__(self, rate: float, capacity: float, now: float | None = None):
+        self.base_rate = self.rate = rate
+        self.capacity = capacity
+        self.level = capacity
+        self._updated = time.monotonic() if now is None else now
+
+    def _refill(self, now: float) -> None:
+        self.level = min(self.capacity, self.level + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def wait_time(self, n: float, now: float | None = None) -> float:
+        self._refill(time.monotonic() if now is None else now)
+        need = min(n, self.capacity)
+        return 0.0 if self.level >= need else round((need - self.level) / self.rate, 9)
+
+    def refill_time(self, n: float, now: float | None = None) -> float:
+        """Seconds until `n` tokens are in the bucket, more than the capacity
+        counts as several refills
+
+        >>> TokenBucket(rate=10, capacity=5, now=0).refill_time(25, now=0)
+        2.0
+        """
+        self._refill(time.monotonic() if now is None else now)
+        return max(0.0, round((n - self.level) / self.rate, 9))
+
+    def take(self, n: float) -> None:
+        self.level -= n
+
+
+class RateLimiter:
+    """Token bucket limits on requests per second and tokens per minute, with
+    waiting callers served in priority order (lower first, FIFO within one).
+
+    `throttled()` reports a 429 from upstream: the limiter pauses for
+    `Retry-After` and halves its rates, `succeeded()` brings them back
+    gradually (AIMD). At most `max_queue` callers wait, others get
+    `RateLimited`.
+    """
+
+    name: str
+    max_queue: int
+    min_rate_share: float
+    requests: TokenBucket | None
+    tokens: TokenBucket | None
+    _paused_until: float
+    # heap of (priority, arrival order, tokens, future)
+    _waiters: list[tuple[int, int, float, asyncio.Future[None]]]
+    _seq: "itertools.count[int]"
+    _timer: asyncio.TimerHandle | None
+    _queued: Gauge
+    _wait: Histogram
+    _throttled: Counter
+    _rejected: Counter
+
+    def __init__(
+        self,
+        name: str,
+        requests_per_second: float | None = None,
+        tokens_per_minute: float | None = None,
+        burst_seconds: float = 1.0,
+        max_queue: int = 1000,
+        min_rate_share: float = 0.1,
+        registry: MetricsRegistry = REGISTRY,
+    ):
+        self.name = name
+        self.max_queue = max_queue
+        self.min_rate_share = min_rate_share
+        self.requests = None
+        self.tokens = None
+        if requests_per_second is not None:
+            self.requests = TokenBucket(
+                requests_per_second, max(1.0, requests_per_second * burst_seconds)
+            )
+        if tokens_per_minute is not None:
+            self.tokens = TokenBucket(
+                tokens_per_minute / 60, tokens_per_minute * burst_seconds / 60
+            )
+        self._paused_until = 0.0
+        self._waiters = []
+        self._seq = itertools.count()
+        self._timer = None
+        self._queued = registry.gauge("rate_limit_queued", "Requests waiting for rate limit")
+        self._wait = registry.histogram("rate_limit_wait_seconds", "Wait for rate limit")
+        self._throttled = registry.counter("rate_limit_throttled_total", "Upstream 429 responses")
+        self._rejected = registry.counter("rate_limit_rejected_total", "Requests over max_queue")
+
+    def _buckets(self, tokens: float) -> list[tuple[TokenBucket, float]]:
+        buckets: list[tuple[TokenBucket, float]] = []
+        if self.requests is not None:
+            buckets.append((self.requests, 1))
+        if self.tokens is not None:
+            buckets.append((self.tokens, tokens))
+        return buckets
+
+    def _dispatch(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        while self._waiters:
+            _, _, tokens, future = self._waiters[0]
+            if future.done():  # cancelled while waiting
+                heapq.heappop(self._waiters)
+                continue
+            now = time.monotonic()
+            buckets = self._buckets(tokens)
+            wait = max([self._paused_until - now, *(b.wait_time(n, now) for b, n in buckets)])
+            if wait > 0:
+                self._timer = asyncio.get_running_loop().call_later(wait, self._dispatch)
+                return
+            heapq.heappop(self._waiters)
+            for b, n in buckets:
+                b.take(n)
+            future.set_result(None)
+
+    async def acquire(self, tokens: float = 0, priority: Priority = "interactive") -> None:
+        """Wait until a request estimated at `tokens` may be sent"""
+        if not self._waiters and self._try_take(tokens):
+            self._wait.observe(0.0, limiter=self.name, priority=priority)
+            return
+        if len(self._waiters) >= self.max_queue:
+            self._rejected.inc(limiter=self.name)
+            raise RateLimited(self.name, len(self._waiters), self.retry_after(tokens))
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (PRIORITIES[priority], next(self._seq), tokens, future))
+        start = time.monotonic()
+        self._queued.inc(limiter=self.name)
+        try:
+            self._dispatch()
+            await future
+        finally:
+            self._queued.dec(limiter=self.name)
+            if future.cancelled() or not future.done():
+                future.cancel()
+                self._dispatch()  # let the next one through
+        self._wait.observe(time.monotonic() - start, limiter=self.name, priority=priority)
+        record("rate_limit", time.monotonic() - start)
+
+    def _try_take(self, tokens: float) -> bool:
+        """Take from the buckets if the request can go right away"""
+        now = time.monotonic()
+        buckets = self._buckets(tokens)
+        if self._paused_until > now or any(b.wait_time(n, now) > 0 for b, n in buckets):
+            return False
+        for b, n in buckets:
+            b.take(n)
+        return True
+
+    def retry_after(self, tokens: float = 0) -> float:
+        """Seconds until the buckets refill for the queued requests and one
+        more estimated at `tokens`"""
+        now = time.monotonic()
+        queued = [n for _, _, n, future in self._waiters if not future.done()]
+        waits = [self._paused_until - now, 0.0]
+        if self.requests is not None:
+            waits.append(self.requests.refill_time(len(queued) + 1, now))
+        if self.tokens is not None:
+            waits.append(self.tokens.refill_time(sum(queued) + tokens, now))
+        return max(waits)
+
+    def settle(self, estimated: float, actual: float) -> None:
+        """Correct the token bucket once real usage is known"""
+        if self.tokens is not None:
+            self.tokens.take(actual - estimated)
+
+    def throttled(self, retry_after: float | None = None) -> None:
+        self._throttled.inc(limiter=self.name)
+        for b, _ in self._buckets(0):
+            b.rate = max(b.base_rate * self.min_rate_share, b.rate * DECREASE_FACTOR)
+        pause = retry_after
+        if pause is None:
+            pause = 1.0 / self.requests.rate if self.requests is not None else 1.0
+        self._paused_until = max(self._paused_until, time.monotonic() + pause)
+        log.warning(f"{self.name}: throttled upstream, pausing {pause:.2f}s")
+
+    def succeeded(self) -> None:
+        for b, _ in self._buckets(0):
+            b.rate = min(b.base_rate, b.rate + b.base_rate * INCREASE_SHARE)
@@ -0,0 +1,167 @@
+import asyncio
+import logging
+import random
+import time
+from collections.abc import Awaitable, Callable
+from typing import TypeVar
+
+from tornado.httpclient import HTTPClientError
+from typing_extensions import override
+
+from botglue.deadline import DeadlineExceeded
+from botglue.metrics import REGISTRY, Counter, Gauge, MetricsRegistry
+
+log = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+def is_retryable(e: BaseException) -> bool:
+    """Connection failures, timeouts (599) and 5xx responses
+
+    >>> is_retryable(HTTPClientError(503)), is_retryable(HTTPClientError(404))
+    (True, False)
+    >>> is_retryable(ConnectionRefusedError()), is_retryable(ValueError())
+    (True, False)
+    >>> is_retryable(DeadlineExceeded())
+    False
+    """
+    if isinstance(e, HTTPClientError):
+        return e.code >= 500
+    if isinstance(e, DeadlineExceeded):
+        return False
+    return isinstance(e, OSError | asyncio.TimeoutError)
+
+
+class Replica:
+    url: str
+    outstanding: int
+    failures: int
+    ejected_until: float
+
+    def __init__(self, url: str):
+        self.url = url
+        self.outstanding = 0
+        self.failures = 0
+        self.ejected_until = 0.0
+
+    @override
+    def __repr__(self):
+        return f"Replica({self.url!r}, outstanding={self.outstanding}, failures={self.failures})"
+
+
+class ReplicaSet:
+    """Endpoints serving the same backend, picked by least outstanding requests.
+
+    Retryable failures (see `is_retryable`) are retried on the best replica
+    with exponential backoff. A replica failing `failure_threshold` times in a
+    row is ejected for `cooldown` seconds, after which it takes requests
+    again, and is ejected again by its next failure. There is no half-open
+    state, concurrent requests may reach a replica that is still failing. When
+    every replica is ejected the one that comes back soonest is used anyway.
+    Cancelled requests only lower the outstanding count.
+    """
+
+    name: str
+    replicas: list[Replica]
+    retries: int
+    backoff: float
+    max_backoff: float
+    failure_threshold: int
+    cooldown: float
+    _outstanding: Gauge
+    _failures: Counter
+    _ejections: Counter
+    _retries: Counter
+
+    def __init__(
+        self,
+        name: str,
+        urls: list[str],
+        retries: int = 2,
+        backoff: float = 0.1,
+        max_backoff: float = 2.0,
+        failure_threshold: int = 3,
+        cooldown: float = 30.0,
+        registry: MetricsRegistry = REGISTRY,
+    ):
+        assert len(urls) > 0, "At least one url is required"
+        self.name = name
+        self.replicas = [Replica(url) for url in urls]
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self._outstanding = registry.gauge("replica_outstanding", "Requests sent to a replica")
+        self._failures = registry.counter("replica_failures_total", "Retryable replica failures")
+        self._ejections = registry.counter("replica_ejections_total", "Replicas ejected")
+        self._retries = registry.counter("replica_retries_total", "Requests retried")
+
+    def acquire(self) -> Replica:
+        now = time.monotonic()
+        healthy = [r for r in self.replicas if r.ejected_until <= now]
+        if healthy:
+            replica = min(healthy, key=lambda r: r.outstanding)
+        else:
+            replica = min(self.replicas, key=lambda r: r.ejected_until)
+        replica.outstanding += 1
+        self._outstanding.inc(backend=self.name, replica=replica.url)
+        return replica
+
+    def release(self, replica: Replica, error: BaseException | None = None) -> None:
+        """Count a request to `replica` as done, `error` is what it raised,
+        if anything. Only a success resets the failures of the replica and
+        only a retryable error adds to them."""
+        replica.outstanding -= 1
+        self._outstanding.dec(backend=self.name, replica=replica.url)
+        if error is None:
+            replica.failures = 0
+            return
+        if not is_retryable(error):
+            return
+        replica.failures += 1
+        self._failures.inc(backend=self.name, replica=replica.url)
+        if replica.failures >= self.failure_threshold:
+            # ejected again right away if it fails after cooldown
+            replica.failures = self.failure_threshold - 1
+            replica.ejected_until = time.monotonic() + self.cooldown
+            self._ejections.inc(backend=self.name, replica=replica.url)
+            log.warning(f"{self.name}: ejecting {replica.url} for {self.cooldown}s after {error!r}")
+
+    def delay(self, attempt: int) -> float:
+        """Backoff before retry `attempt` (0 based), with full jitter
+
+        >>> rs = ReplicaSet("x", ["u"], backoff=0.1, max_backoff=0.3)
+        >>> all(0 <= rs.delay(a) <= min(0.3, 0.1 * 2**a) for a in range(5))
+        True
+        """
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2**attempt))
+
+    async def retry(self, attempt: int, error: Exception, replica: Replica) -> bool:
+        """Sleep before retry `attempt` if `error` deserves one"""
+        if attempt >= self.retries or not is_retryable(error):
+            return False
+        self._retries.inc(backend=self.name)
+        log.info(f"{self.name}: retrying after {error!r} from {replica.url}")
+        await asyncio.sleep(self.delay(attempt))
+        return True
+
+    async def call(self, fn: Callable[[str], Awaitable[T]]) -> T:
+        """Call `fn(url)` on replicas until it succeeds or retries run out"""
+        attempt = 0
+        while True:
+            replica = self.acquire()
+            try:
+                result = await fn(replica.url)
+            except Exception as e:
+                self.release(replica, e)
+                if not await self.retry(attempt, e, replica):
+                    raise
+                attempt += 1
+                continue
+            except BaseException as e:
+                self.release(replica, e)
+                raise
+            self.release(replica)
+            return result
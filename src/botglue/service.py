@@ -1,30 +1,43 @@
 import asyncio
+import inspect
 import json
 import logging
+import math
+import os
 import platform
+import pstats
+import random
 import signal
+import socket
+import time
 from collections.abc import Callable, Generator
 from enum import Enum
+from pathlib import Path
 from typing import Any, Generic, TypeVar, cast
 
 import tornado.web
-from tornado.httpclient import AsyncHTTPClient, HTTPRequest
+from tornado.httpserver import HTTPServer
+from tornado.netutil import bind_sockets, bind_unix_socket
 from typing_extensions import override
 
 from botglue import random_port
-from botglue.periodic import Moment, PeriodicTask, run_all
+from botglue.concurrency import RouteLimit
+from botglue.deadline import deadline
+from botglue.metrics import (
+    PROMETHEUS_CONTENT_TYPE,
+    REGISTRY,
+    Counter,
+    Gauge,
+    Histogram,
+    MetricsRegistry,
+)
+from botglue.periodic import PeriodicTask, run_all
+from botglue.profiling import ProfilerBusy, format_collapsed, profile_loop, sample_stacks
+from botglue.timing import Timings, record, timings
+from botglue.watchdog import LoopMonitor
 
 log = logging.getLogger(__name__)
-
-
-async def get_json(
-    url: str | HTTPRequest, to_json: Callable[[str | bytes | bytearray], Any] = json.loads
-) -> Any:
-    moment = Moment.start()
-    response = await AsyncHTTPClient().fetch(url)
-    log.info(f"Request took {moment.elapsed()}s")
-    log.debug(f"Response: {response.body}")
-    return to_json(response.body)
+timing_log = logging.getLogger("botglue.timing")
 
 
 StateType = TypeVar("StateType", bound="AppState")  # pyright: ignore [reportMissingTypeArgument]
@@ -38,6 +51,8 @@ class AppService(Generic[StateType]):
 
     def __init__(self):
         self._routes: list[tuple[str, type[tornado.web.RequestHandler]]] = []
+        self._route_limits: dict[str, RouteLimit] = {}
+        self._route_timeouts: dict[str, float] = {}
         self._periodic_tasks: list[PeriodicTask] = []
         self.app_state = None
         self.app = None
@@ -52,9 +67,24 @@ class AppService(Generic[StateType]):
         self.app_state = app_state
         self.app = app
 
-    def add_route(self, pattern: str, handler: type[tornado.web.RequestHandler]) -> None:
-        """Add a route pattern and handler"""
+    def add_route(
+        self,
+        pattern: str,
+        handler: type[tornado.web.RequestHandler],
+        max_concurrency: int | None = None,
+        max_queue: int = 0,
+        retry_after: float = 1.0,
+        timeout: float | None = None,
+    ) -> None:
+        """Add a route pattern and handler, with admission control if
+        `max_concurrency` is set (see `RouteLimit`). Requests are answered
+        with 504 after `timeout` seconds, or earlier if they ask for it in the
+        `X-Request-Timeout` header."""
         self._routes.append((pattern, handler))
+        if max_concurrency is not None:
+            self._route_limits[pattern] = RouteLimit(max_concurrency, max_queue, retry_after)
+        if timeout is not None:
+            self._route_timeouts[pattern] = timeout
 
     def add_periodic(self, interval: int, fn: Callable[[], Any]) -> None:
         """Add a periodic task that runs at the specified interval"""
@@ -65,6 +95,12 @@ class AppService(Generic[StateType]):
         """Get all registered routes"""
         return self._routes
 
+    def get_route_limit(self, pattern: str) -> RouteLimit | None:
+        return self._route_limits.get(pattern)
+
+    def get_route_timeout(self, pattern: str) -> float | None:
+        return self._route_timeouts.get(pattern)
+
     def get_periodic_tasks(self) -> list[PeriodicTask]:
         """Get all registered periodic tasks"""
         return self._periodic_tasks
@@ -73,6 +109,12 @@ class AppService(Generic[StateType]):
         """Start the service"""
         pass
 
+    async def warmup(self) -> None:
+        """Preload what the first requests would wait for. Runs after
+        `on_start` while the app already listens, it is reported ready on
+        `/readyz` once the warmups of all services complete."""
+        pass
+
     def on_stop(self) -> None:
         """Stop the service"""
         pass
@@ -131,16 +173,294 @@ def _get_bind_errno() -> int:
 
 
 BIND_ERRNO = _get_bind_errno()
+DRAIN_POLL_SECONDS = 0.05
+METRICS_ROUTE = r"/metrics"
+HEALTH_ROUTE = r"/healthz"
+READY_ROUTE = r"/readyz"
+TIMEOUT_HEADER = "X-Request-Timeout"
+PROFILE_ROUTE = r"/admin/profile"
+MAX_PROFILE_SECONDS = 120.0
+MIN_PROFILE_INTERVAL = 0.001
+PROFILE_SORT_KEYS = sorted(k.value for k in pstats.SortKey)
+
+
+def _request_timeout(header: str | None, default: float | None) -> float | None:
+    """Timeout asked for in the header, capped by the route's default
+
+    >>> _request_timeout("2.5", 10), _request_timeout(None, 10), _request_timeout("x", None)
+    (2.5, 10, None)
+    """
+    try:
+        asked = float(header) if header is not None else None
+    except ValueError:
+        asked = None
+    if asked is None or asked <= 0:
+        return default
+    return asked if default is None else min(asked, default)
+
+
+def _instrumented(
+    handler: type[tornado.web.RequestHandler],
+    state: "AppState",
+    route: str,
+    limit: RouteLimit | None = None,
+    timeout: float | None = None,
+) -> type[tornado.web.RequestHandler]:
+    """Subclass of `handler` that counts its requests in `state` for draining,
+    records them in the metrics labeled with the route pattern, applies the
+    route's admission `limit` and the request deadline. `prepare` and the
+    HTTP verb methods run in a task of their own, cancelled when the deadline
+    passes (504) or the client goes away (499)."""
+
+    class Instrumented(handler):  # pyright: ignore [reportUntypedBaseClass]
+        _started: float | None = None
+        _seconds: float | None = None
+        _deadline: float | None = None
+        _admitted: bool = False
+        _task: "asyncio.Task[Any] | None" = None
+        _client_gone: bool = False
+        _flushed: bool = False
+        _settled: bool = False
+        _timings: Timings | None = None
+
+        @override
+        async def prepare(self) -> None:
+            self._started = time.monotonic()
+            self._timings = Timings()
+            state.in_flight += 1
+            state.requests_in_flight.inc(route=route)
+            if state.app is not None and state.app.is_draining:
+                self.set_header("Connection", "close")
+            self._seconds = _request_timeout(self.request.headers.get(TIMEOUT_HEADER), timeout)
+            if self._seconds is not None:
+                self._deadline = self._started + self._seconds
+            if limit is not None:
+                if not await self._guarded(self._admit, limit):
+                    return
+                if not self._admitted:
+                    self.set_status(503)
+                    self.set_header("Retry-After", f"{math.ceil(limit.retry_after)}")
+                    self.finish({"error": f"Too many requests for {route}, try again later"})
+                    return
+            await self._guarded(super().prepare)
+
+        async def _guarded(self, method: Callable[..., Any], *args: Any, **kwargs: Any) -> bool:
+            """Run `method` in its own task with the request's timings and
+            deadline, False if it was cut short and the response finished"""
+            remaining = None if self._deadline is None else self._deadline - time.monotonic()
+            with timings(self._timings), deadline(remaining):
+                result = method(*args, **kwargs)
+                if not inspect.isawaitable(result):
+                    return True
+                self._task = asyncio.ensure_future(result)
+            expiry = asyncio.timeout(remaining)
+            try:
+                async with expiry:
+                    await self._task
+            except TimeoutError:
+                if not expiry.expired():
+                    raise  # raised by the handler itself
+                self._abort(504, f"Deadline of {self._seconds}s exceeded")
+                return False
+            except asyncio.CancelledError:
+                current = asyncio.current_task()
+                if not self._client_gone or (current is not None and current.cancelling()):
+                    self._settle()
+                    raise
+                self._abort(499, "Client closed request")
+                return False
+            finally:
+                self._task = None
+            return True
+
+        @override
+        def flush(self, include_footers: bool = False) -> "asyncio.Future[None]":
+            if not self._flushed and self._timings is not None:
+                # spans until the first byte, for a streamed response
+                self.set_header("Server-Timing", self._timings.server_timing())
+            self._flushed = True
+            return super().flush(include_footers)
+
+        def _abort(self, status: int, message: str) -> None:
+            if self._settled:
+                return
+            try:
+                if not self._flushed:
+                    self.clear()
+                    self.set_status(status)
+                    self.write({"error": message})
+                self.finish()  # ends a streamed response early
+            except Exception as e:
+                log.debug(f"Can't finish {route} request: {e!r}")
+
+        @override
+        def on_connection_close(self) -> None:
+            super().on_connection_close()
+            if not self._settled and self._task is not None:
+                self._client_gone = True
+                self._task.cancel()
+
+        async def _admit(self, limit: RouteLimit) -> None:
+            start = time.monotonic()
+            state.route_queued.inc(route=route)
+            try:
+                self._admitted = await limit.acquire()
+            finally:
+                state.route_queued.dec(route=route)
+            if self._admitted:
+                state.route_queue_seconds.observe(time.monotonic() - start, route=route)
+                record("queue", time.monotonic() - start)
+            else:
+                state.route_rejected.inc(route=route)
+
+        @override
+        def on_finish(self) -> None:
+            self._settle()
+            super().on_finish()
+
+        def _settle(self) -> None:
+            """Account for the request once it is done, also for requests
+            rejected before `prepare`"""
+            if self._settled:
+                return
+            self._settled = True
+            if self._admitted:
+                self._admitted = False
+                limit.release()  # pyright: ignore [reportOptionalMemberAccess]
+            method = self.request.method
+            if self._started is not None:
+                state.in_flight -= 1
+                state.completed += 1
+                state.requests_in_flight.dec(route=route)
+            state.requests.inc(route=route, method=method, status=self.get_status())
+            state.request_seconds.observe(self.request.request_time(), route=route, method=method)
+            if state.log_timings and self._timings is not None:
+                entry = {"route": route, "method": method, "status": self.get_status()}
+                timing_log.info(json.dumps(entry | self._timings.to_dict()))
+
+        @staticmethod
+        def _verb(name: str) -> Callable[..., Any]:
+            """HTTP verb method `name` of the handler, run by `_guarded`"""
+
+            async def method(self: Instrumented, *args: Any, **kwargs: Any) -> None:
+                await self._guarded(getattr(super(), name), *args, **kwargs)
+
+            method.__name__ = name
+            return method
+
+    # only the verbs the handler implements, the others answer 405 as usual
+    for name in (m.lower() for m in handler.SUPPORTED_METHODS):
+        if getattr(handler, name) is not getattr(tornado.web.RequestHandler, name):
+            setattr(Instrumented, name, Instrumented._verb(name))  # pyright: ignore [reportPrivateUsage]
+
+    Instrumented.__name__ = Instrumented.__qualname__ = handler.__name__
+    return Instrumented
+
+
+class HealthHandler(tornado.web.RequestHandler):
+    """Liveness, ok as long as the loop serves requests"""
+
+    @override
+    def get(self):
+        self.write({"ok": True})
+
+
+def _ready_handler(state: "AppState") -> type[tornado.web.RequestHandler]:
+    class ReadyHandler(tornado.web.RequestHandler):
+        """Readiness, 503 while warming up and draining"""
+
+        @override
+        def get(self):
+            ready = state.app is not None and state.app.is_ready
+            if not ready:
+                self.set_status(503)
+            self.write({"ready": ready})
+
+    return ReadyHandler
+
+
+class ProfileHandler(tornado.web.RequestHandler):
+    """Profile of the live process for `seconds`, up to `MAX_PROFILE_SECONDS`.
+    `mode=sample` (default) gives collapsed stacks of all threads for
+    flamegraphs, `mode=cprofile` gives pstats text of the event loop thread
+    sorted by `sort`, one of `pstats.SortKey`. Bad arguments get 400."""
+
+    @override
+    async def get(self):
+        try:
+            seconds = float(self.get_argument("seconds", "10"))
+            interval = float(self.get_argument("interval", "0.005"))
+        except ValueError as e:
+            raise tornado.web.HTTPError(400, f"Bad profile argument: {e}") from e
+        if not 0 < seconds <= MAX_PROFILE_SECONDS:
+            raise tornado.web.HTTPError(400, f"seconds must be in (0, {MAX_PROFILE_SECONDS}]")
+        if not MIN_PROFILE_INTERVAL <= interval <= seconds:
+            raise tornado.web.HTTPError(
+                400, f"interval must be in [{MIN_PROFILE_INTERVAL}, seconds]"
+            )
+        sort = self.get_argument("sort", pstats.SortKey.CUMULATIVE.value)
+        if sort not in PROFILE_SORT_KEYS:
+            raise tornado.web.HTTPError(400, f"sort must be one of {', '.join(PROFILE_SORT_KEYS)}")
+        mode = self.get_argument("mode", "sample")
+        try:
+            if mode == "sample":
+                stacks = await asyncio.to_thread(sample_stacks, seconds, interval)
+                text = format_collapsed(stacks)
+            elif mode == "cprofile":
+                text = await profile_loop(seconds, sort)
+            else:
+                raise tornado.web.HTTPError(400, f"Unknown profile mode {mode}")
+        except ProfilerBusy as e:
+            raise tornado.web.HTTPError(409, "Another profile is running") from e
+        self.set_header("Content-Type", "text/plain; charset=utf-8")
+        self.write(text)
+
+
+def _metrics_handler(registry: MetricsRegistry) -> type[tornado.web.RequestHandler]:
+    class MetricsHandler(tornado.web.RequestHandler):
+        """Prometheus text format of the registry"""
+
+        @override
+        def get(self):
+            self.set_header("Content-Type", PROMETHEUS_CONTENT_TYPE)
+            self.write(registry.render())
+
+    return MetricsHandler
 
 
 class AppState:
-    """Base application state that maintains services"""
+    """Base application state that maintains services.
+
+    Served on `port` and, if given, on the Unix socket at `unix_socket` too,
+    for clients on the same host. With `tcp=False` only the Unix socket is.
+    """
 
     app_services: list[AppService]  # pyright: ignore [reportMissingTypeArgument]
     app: "App | None"
     port_seek: PortSeekStrategy
     port: int | None
+    # path of a Unix domain socket to serve on
+    unix_socket: str | None
+    # serve on `port`, can be off if `unix_socket` is set
+    tcp: bool
     debug: bool
+    # opt-in admin route profiling the live process
+    profiling: bool
+    # log `Server-Timing` spans of every request as JSON
+    log_timings: bool
+    sockets: list[socket.socket]
+    unix_listener: socket.socket | None
+    server: HTTPServer | None
+    # requests being handled and handled so far
+    in_flight: int
+    completed: int
+    registry: MetricsRegistry
+    requests: Counter
+    requests_in_flight: Gauge
+    request_seconds: Histogram
+    route_queued: Gauge
+    route_queue_seconds: Histogram
+    route_rejected: Counter
 
     def __init__(
         self,
@@ -148,36 +468,87 @@ class AppState:
         port: int | None = None,
         port_seek: PortSeekStrategy | None = None,
         debug: bool = False,
+        profiling: bool = False,
+        log_timings: bool = False,
+        unix_socket: str | Path | None = None,
+        tcp: bool = True,
+        registry: MetricsRegistry = REGISTRY,
     ):
+        assert tcp or unix_socket is not None, "Nothing to listen on"
         self.app_services = list(app_services)
         self.port = port
+        self.unix_socket = None if unix_socket is None else str(unix_socket)
+        self.tcp = tcp
         self.port_seek = (
             port_seek
             if port_seek is not None
             else (PortSeekStrategy.RANDOM if port is None else PortSeekStrategy.SEQUENTIAL)
         )
         self.debug = debug
+        self.profiling = profiling
+        self.log_timings = log_timings
         self.app = None
+        self.sockets = []
+        self.unix_listener = None
+        self.server = None
+        self.in_flight = 0
+        self.completed = 0
+        self.registry = registry
+        self.requests = registry.counter("http_requests_total", "Requests by route and status")
+        self.requests_in_flight = registry.gauge(
+            "http_requests_in_flight", "Requests being handled"
+        )
+        self.request_seconds = registry.histogram("http_request_seconds", "Request latency")
+        self.route_queued = registry.gauge("http_route_queued", "Requests waiting for a slot")
+        self.route_queue_seconds = registry.histogram(
+            "http_route_queue_seconds", "Wait for a slot of a limited route"
+        )
+        self.route_rejected = registry.counter(
+            "http_route_rejected_total", "Requests shed by route limits"
+        )
 
     def tornado_app(self) -> tornado.web.Application:
+        """Routes of all services, instrumented, and `/metrics`, `/healthz`,
+        `/readyz` and, if `profiling` is on, `/admin/profile` unless a service
+        serves them"""
         routes: tornado.routing._RuleList = []  # pyright: ignore [reportPrivateUsage]
+        patterns: set[str] = set()
         for service in self.app_services:
-            routes.extend(service.get_routes())
+            for pattern, handler in service.get_routes():
+                patterns.add(pattern)
+                limit = service.get_route_limit(pattern)
+                timeout = service.get_route_timeout(pattern)
+                routes.append((pattern, _instrumented(handler, self, pattern, limit, timeout)))
+        builtin: list[tuple[str, type[tornado.web.RequestHandler], dict[str, Any]]] = [
+            (METRICS_ROUTE, _metrics_handler(self.registry), {}),
+            (HEALTH_ROUTE, HealthHandler, {}),
+            (READY_ROUTE, _ready_handler(self), {}),
+        ]
+        if self.profiling:
+            builtin.append((PROFILE_ROUTE, ProfileHandler, {}))
+        routes.extend(route for route in builtin if route[0] not in patterns)
         return tornado.web.Application(routes, debug=self.debug)
 
     def periodic_tasks(self) -> Generator[PeriodicTask, None, None]:
         for service in self.app_services:
             yield from service.get_periodic_tasks()
 
-    def listen(self, max_attempts: int = 10):
-        tornado_app = self.tornado_app()
+    def bind(self, max_attempts: int = 10, reuse_port: bool = False):
+        """Bind the listening sockets, seeking a free port with `port_seek`.
+        The Unix socket is bound once and kept, it can't be shared with
+        `reuse_port`."""
+        if self.unix_socket is not None and self.unix_listener is None:
+            log.debug(f"Listening on {self.unix_socket}")
+            self.unix_listener = bind_unix_socket(self.unix_socket)
+        if not self.tcp:
+            return
         reset_port = self.port is None
         for _ in range(max_attempts):
             if reset_port:
                 self.port = self.port_seek.next_port(self.port)
             try:
                 log.debug(f"Trying to listen on port {self.port}")
-                tornado_app.listen(cast(int, self.port))
+                self.sockets = bind_sockets(cast(int, self.port), reuse_port=reuse_port)
                 return
             except OSError as e:
                 if self.port_seek == PortSeekStrategy.BAILOUT or e.errno != BIND_ERRNO:
@@ -187,6 +558,27 @@ class AppState:
                     reset_port = True
         raise ValueError("Failed to find an available port after max_attempts", max_attempts)
 
+    def listen(self, max_attempts: int = 10):
+        """Serve on the sockets bound before forking, or bind them now"""
+        if not self.sockets and self.unix_listener is None:
+            self.bind(max_attempts)
+        server = HTTPServer(self.tornado_app())
+        server.add_sockets(self.sockets)
+        if self.unix_listener is not None:
+            server.add_socket(self.unix_listener)
+        self.server = server
+
+    def remove_unix_socket(self):
+        """Close the Unix socket and remove its file, once no process serves on it"""
+        if self.unix_listener is None:
+            return
+        self.unix_listener.close()
+        self.unix_listener = None
+        try:
+            os.unlink(cast(str, self.unix_socket))
+        except FileNotFoundError:
+            pass
+
     def get_app(self) -> "App":
         assert self.app is not None, "App is not set"
         return self.app
@@ -200,20 +592,55 @@ class AppState:
         for service in self.app_services:
             service.on_stop()
 
+    async def warmup(self):
+        await asyncio.gather(*(service.warmup() for service in self.app_services))
+
     @override
     def __repr__(self):
-        return f"AppState(port={self.port}, port_seek={self.port_seek}, app_services={self.app_services})"
+        return (
+            f"AppState(port={self.port}, port_seek={self.port_seek}, "
+            f"unix_socket={self.unix_socket}, app_services={self.app_services})"
+        )
 
 
 class App:
     def __init__(
-        self, name: str, *app_states: AppState, shutdown_event: asyncio.Event | None = None
+        self,
+        name: str,
+        *app_states: AppState,
+        shutdown_event: asyncio.Event | None = None,
+        drain_timeout: float = 30.0,
+        lag_threshold: float | None = None,
+        registry: MetricsRegistry = REGISTRY,
     ):
         self.name: str = name
         self.app_states: list[AppState] = list(app_states)
         self.shutdown_event: asyncio.Event | None = shutdown_event
+        # seconds given to requests in flight on shutdown
+        self.drain_timeout: float = drain_timeout
+        # worker number when forked by `run_workers`
+        self.task_id: int | None = None
+        # captures stacks of code blocking the loop longer than `lag_threshold`
+        self.loop_monitor: LoopMonitor | None = None
+        if lag_threshold is not None:
+            interval = min(0.1, lag_threshold)
+            self.loop_monitor = LoopMonitor(name, interval, lag_threshold, registry=registry)
         self._started: bool = False
         self._stopping: bool | None = None
+        self._draining: bool = False
+        self._warmed_up: bool = False
+        self._drained: Counter = registry.counter(
+            "app_drained_requests_total", "Requests completed while draining"
+        )
+        self._aborted: Counter = registry.counter(
+            "app_aborted_requests_total", "Requests still in flight at the drain deadline"
+        )
+        self._warmup_seconds: Gauge = registry.gauge("app_warmup_seconds", "Duration of the warmup")
+
+    @property
+    def is_leader(self) -> bool:
+        """Only the leader runs periodic tasks, the first worker or the only process"""
+        return self.task_id in (None, 0)
 
     def periodic_tasks(self) -> list[PeriodicTask]:
         """Return a list of tuples where the first element is the frequency in seconds
@@ -246,6 +673,52 @@ class App:
         """Check if app is currently running"""
         return self._started and not self._stopping
 
+    @property
+    def is_draining(self) -> bool:
+        return self._draining
+
+    @property
+    def is_ready(self) -> bool:
+        """Warmed up and accepting new requests"""
+        return self.is_running and self._warmed_up and not self._draining
+
+    async def warmup(self) -> None:
+        """Warm up all app states, the app is ready even if that fails"""
+        start = time.monotonic()
+        try:
+            await asyncio.gather(*(app_state.warmup() for app_state in self.app_states))
+        except Exception:
+            log.exception(f"Warmup of {self.name} failed")
+        self._warmup_seconds.set(time.monotonic() - start, app=self.name)
+        self._warmed_up = True
+
+    @property
+    def in_flight(self) -> int:
+        return sum(app_state.in_flight for app_state in self.app_states)
+
+    async def drain(self, periodic: "asyncio.Task[None] | None" = None) -> None:
+        """Stop accepting connections, then wait up to `drain_timeout` for
+        requests in flight and the running periodic task to complete"""
+        self._draining = True
+        for app_state in self.app_states:
+            if app_state.server is not None:
+                app_state.server.stop()
+        completed = sum(app_state.completed for app_state in self.app_states)
+        log.info(f"Draining {self.name}: {self.in_flight} requests in flight")
+        deadline = time.monotonic() + self.drain_timeout
+        while self.in_flight or (periodic is not None and not periodic.done()):
+            if time.monotonic() >= deadline:
+                break
+            await asyncio.sleep(DRAIN_POLL_SECONDS)
+        drained = sum(app_state.completed for app_state in self.app_states) - completed
+        self._drained.inc(drained, app=self.name)
+        if aborted := self.in_flight:
+            self._aborted.inc(aborted, app=self.name)
+        if periodic is not None and not periodic.done():
+            log.warning(f"{self.name}: periodic task did not finish in time")
+            periodic.cancel()
+        log.info(f"Drained {self.name}: {drained} requests completed, {aborted} aborted")
+
     def shutdown(self, *args: Any, **kwargs: Any):
         log.warning(f"Stopping {self.name} {args} {kwargs}")
         if self.shutdown_event is not None:
@@ -261,13 +734,122 @@ class App:
             app_state.listen(max_attempts=max_attempts_to_listen)
 
         self.on_start()
+        if self.loop_monitor is not None:
+            self.loop_monitor.start()
         try:
-            asyncio.get_event_loop()
-            signal.signal(signal.SIGINT, self.shutdown)
-            signal.signal(signal.SIGTERM, self.shutdown)
-            tasks = self.periodic_tasks()
+            loop = asyncio.get_running_loop()
+            for sig in (signal.SIGINT, signal.SIGTERM):
+                try:
+                    # wakes up the loop, unlike a plain signal handler
+                    loop.add_signal_handler(sig, self.shutdown, sig)
+                except NotImplementedError:  # windows
+                    signal.signal(sig, self.shutdown)
+            tasks = self.periodic_tasks() if self.is_leader else []
+            periodic = None
             if len(tasks):
-                asyncio.create_task(run_all(*tasks, shutdown_event=self.shutdown_event))
+                periodic = asyncio.create_task(run_all(*tasks, shutdown_event=self.shutdown_event))
+            warmup = asyncio.create_task(self.warmup())
             await self.shutdown_event.wait()
+            warmup.cancel()
+            await self.drain(periodic)
         finally:
+            if self.loop_monitor is not None:
+                self.loop_monitor.stop()
             self.on_stop()
+            if self.task_id is None:
+                for app_state in self.app_states:
+                    app_state.remove_unix_socket()
+
+    def run_workers(
+        self,
+        workers: int,
+        max_attempts_to_listen: int = 10,
+        reuse_port: bool = False,
+        max_restarts: int = 100,
+    ) -> None:
+        """Serve from `workers` forked processes, blocking until they all exit.
+
+        Ports are bound before forking and the workers accept from the shared
+        sockets. With `reuse_port` every worker binds its own SO_REUSEPORT
+        socket instead, and the kernel balances connections between them.
+        The Unix socket is always shared and removed once all workers exit.
+        Worker 0 is the leader that runs periodic tasks. Workers that crash
+        are restarted with the same number, SIGINT and SIGTERM are passed on
+        to them. Metrics and caches are per worker.
+
+        Must be called before an event loop runs, app states should not hold
+        threads or open connections before the fork.
+        """
+        if workers <= 1:
+            asyncio.run(self.run(max_attempts_to_listen))
+            return
+        for app_state in self.app_states:
+            app_state.bind(max_attempts_to_listen, reuse_port=reuse_port)
+        task_id = self._fork_workers(workers, reuse_port, max_restarts)
+        if task_id is None:
+            for app_state in self.app_states:
+                app_state.remove_unix_socket()
+            return
+        try:
+            self.task_id = task_id
+            if reuse_port:
+                inherited = [s for app_state in self.app_states for s in app_state.sockets]
+                for app_state in self.app_states:
+                    app_state.bind(1, reuse_port=True)
+                for s in inherited:
+                    s.close()
+            asyncio.run(self.run(max_attempts_to_listen))
+        except BaseException:
+            log.exception(f"Worker {task_id} of {self.name} failed")
+            os._exit(1)
+        os._exit(0)
+
+    def _fork_workers(self, workers: int, reuse_port: bool, max_restarts: int) -> int | None:
+        """Fork and supervise the workers. Returns the worker number in the
+        forked process and None in the supervisor once all workers exit."""
+        children: dict[int, int] = {}
+        stopping = False
+
+        def fork(task_id: int) -> bool:
+            pid = os.fork()
+            if pid == 0:
+                signal.signal(signal.SIGINT, signal.default_int_handler)
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                random.seed()
+                return True
+            log.info(f"Started worker {task_id} of {self.name}, pid {pid}")
+            children[pid] = task_id
+            return False
+
+        def stop(signum: int, _frame: Any) -> None:
+            nonlocal stopping
+            stopping = True
+            for pid in children:
+                os.kill(pid, signum)
+
+        for task_id in range(workers):
+            if fork(task_id):
+                return task_id
+        if reuse_port:
+            # an idle listener here would still get its share of connections
+            for app_state in self.app_states:
+                for s in app_state.sockets:
+                    s.close()
+        signal.signal(signal.SIGINT, stop)
+        signal.signal(signal.SIGTERM, stop)
+        restarts = 0
+        while children:
+            pid, status = os.wait()
+            task_id = children.pop(pid)
+            code = os.waitstatus_to_exitcode(status)
+            if code == 0 or stopping:
+                log.info(f"Worker {task_id} of {self.name} exited with {code}")
+                continue
+            if restarts >= max_restarts:
+                log.error(f"Worker {task_id} of {self.name} exited with {code}, not restarted")
+                continue
+            restarts += 1
+            log.warning(f"Worker {task_id} of {self.name} exited with {code}, restarting")
+            if fork(task_id):
+                return task_id
+        return None
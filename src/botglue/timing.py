@@ -0,0 +1,82 @@
+import time
+from collections.abc import Generator
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any
+
+_TIMINGS: ContextVar["Timings | None"] = ContextVar("timings", default=None)
+
+
+class Timings:
+    """Named spans of one request. Spans of the same name add up, so work
+    done concurrently (hedged upstream calls) can sum to more than the total.
+
+    >>> t = Timings()
+    >>> t.add("search", 0.0123); t.add("llm", 1.5); t.add("search", 0.001)
+    >>> t.server_timing(total=False)
+    'search;dur=13.3, llm;dur=1500.0'
+    """
+
+    started: float
+    spans: dict[str, float]
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.spans = {}
+
+    def add(self, name: str, seconds: float) -> None:
+        self.spans[name] = self.spans.get(name, 0.0) + seconds
+
+    def total(self) -> float:
+        return time.monotonic() - self.started
+
+    def server_timing(self, total: bool = True) -> str:
+        """`Server-Timing` header value, durations in milliseconds"""
+        spans = dict(self.spans)
+        if total:
+            spans["total"] = self.total()
+        return ", ".join(f"{name};dur={seconds * 1000:.1f}" for name, seconds in spans.items())
+
+    def to_dict(self) -> dict[str, Any]:
+        return {
+            "total": round(self.total(), 6),
+            "spans": {k: round(v, 6) for k, v in self.spans.items()},
+        }
+
+
+def current_timings() -> Timings | None:
+    return _TIMINGS.get()
+
+
+@contextmanager
+def timings(t: Timings | None = None) -> Generator[Timings, None, None]:
+    """New timings, or `t`, for the code within and the tasks it creates"""
+    t = Timings() if t is None else t
+    token = _TIMINGS.set(t)
+    try:
+        yield t
+    finally:
+        _TIMINGS.reset(token)
+
+
+def record(name: str, seconds: float) -> None:
+    """Add to the current request's timings, if there are any"""
+    if (t := _TIMINGS.get()) is not None:
+        t.add(name, seconds)
+
+
+@contextmanager
+def span(name: str) -> Generator[None, None, None]:
+    """Time the code within as `name` in the current request's timings
+
+    >>> with timings() as t:
+    ...     with span("prompt"):
+    ...         pass
+    >>> list(t.spans)
+    ['prompt']
+    """
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        record(name, time.monotonic() - start)
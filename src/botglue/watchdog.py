@@ -0,0 +1,134 @@
+import asyncio
+import logging
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+
+from botglue.metrics import REGISTRY, Counter, Histogram, MetricsRegistry
+
+log = logging.getLogger(__name__)
+
+LAG_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class BlockedLoop:
+    """Stack of the loop thread captured while it was blocked"""
+
+    started: float
+    stack: str
+    # known once the loop runs again
+    seconds: float | None
+
+    def __init__(self, started: float, stack: str):
+        self.started = started
+        self.stack = stack
+        self.seconds = None
+
+    def to_dict(self) -> dict[str, object]:
+        return {"started": self.started, "seconds": self.seconds, "stack": self.stack}
+
+
+class LoopMonitor:
+    """Measures the lag of the event loop: a heartbeat is scheduled every
+    `interval` and the delay past its due time is the lag.
+
+    A watchdog thread checks on the heartbeat. Once the loop has not run it
+    for `threshold` seconds, the stack of the loop thread is captured, which
+    points at the synchronous code blocking it. The last `keep` captures are
+    kept in `blocked` and each is logged.
+    """
+
+    name: str
+    interval: float
+    threshold: float
+    blocked: deque[BlockedLoop]
+    _lock: threading.Lock
+    _loop: asyncio.AbstractEventLoop | None
+    _loop_thread: int | None
+    _timer: asyncio.TimerHandle | None
+    _watchdog: threading.Thread | None
+    _stopped: threading.Event
+    # monotonic time the next heartbeat is due and the last one ran
+    _due: float
+    _last_beat: float
+    _current: BlockedLoop | None
+    _lag: Histogram
+    _blocked: Counter
+
+    def __init__(
+        self,
+        name: str,
+        interval: float = 0.1,
+        threshold: float = 0.5,
+        keep: int = 20,
+        registry: MetricsRegistry = REGISTRY,
+    ):
+        assert 0 < interval <= threshold
+        self.name = name
+        self.interval = interval
+        self.threshold = threshold
+        self.blocked = deque(maxlen=keep)
+        self._lock = threading.Lock()
+        self._loop = None
+        self._loop_thread = None
+        self._timer = None
+        self._watchdog = None
+        self._stopped = threading.Event()
+        self._due = 0.0
+        self._last_beat = 0.0
+        self._current = None
+        self._lag = registry.histogram("event_loop_lag_seconds", "Event loop lag", LAG_BUCKETS)
+        self._blocked = registry.counter(
+            "event_loop_blocked_total", "Event loop blocked beyond the threshold"
+        )
+
+    def start(self) -> None:
+        """Start monitoring the running loop, call from its thread"""
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread = threading.get_ident()
+        self._stopped.clear()
+        self._last_beat = self._due = time.monotonic()
+        self._beat()
+        self._watchdog = threading.Thread(
+            target=self._watch, name=f"{self.name}-watchdog", daemon=True
+        )
+        self._watchdog.start()
+
+    def stop(self) -> None:
+        self._stopped.set()
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._watchdog is not None:
+            self._watchdog.join()
+            self._watchdog = None
+
+    def _beat(self) -> None:
+        now = time.monotonic()
+        self._lag.observe(max(0.0, now - self._due), app=self.name)
+        with self._lock:
+            self._last_beat = now
+            current, self._current = self._current, None
+        if current is not None:
+            current.seconds = now - current.started
+            log.warning(f"{self.name}: event loop was blocked for {current.seconds:.3f}s")
+        assert self._loop is not None
+        self._due = now + self.interval
+        self._timer = self._loop.call_later(self.interval, self._beat)
+
+    def _watch(self) -> None:
+        while not self._stopped.wait(self.interval):
+            with self._lock:
+                late = time.monotonic() - self._last_beat - self.interval
+                if late < self.threshold or self._current is not None:
+                    continue
+                frame = sys._current_frames().get(self._loop_thread)  # pyright: ignore [reportPrivateUsage, reportArgumentType]
+                if frame is None:
+                    continue
+                stack = "".join(traceback.format_stack(frame))
+                self._current = BlockedLoop(self._last_beat + self.interval, stack)
+                self.blocked.append(self._current)
+            self._blocked.inc(app=self.name)
+            log.warning(f"{self.name}: event loop blocked for {late:.3f}s in:\n{stack}")
@@ -1,7 +1,18 @@
+from collections.abc import AsyncIterator, Callable, Iterable
+from pathlib import Path
+from typing import Any
+
 import pytest
 from _pytest.config import Config
 from _pytest.config.argparsing import Parser
 from _pytest.nodes import Item
+from langchain_core.documents import Document
+
+from botglue.llore.config import LLMModelConfig
+from botglue.llore.pipeline import Llore
+from botglue.llore.vector import add_chunks, shard_for_source, shard_names
+from botglue.metrics import MetricsRegistry
+from tests.fakes import FakeLLM, fake_collection, write_llore_config
 
 
 def pytest_configure(config: Config) -> None:
@@ -28,3 +39,52 @@ def pytest_collection_modifyitems(config: Config, items: list[Item]) -> None:
         for item in items:
             if "integration" in item.keywords:
                 item.add_marker(skip_integration)
+
+
+@pytest.fixture
+def fake_llore(tmp_path: Path) -> Callable[..., Llore]:
+    """Factory of `Llore` instances configured in `tmp_path`, with metrics in
+    a registry of their own unless `registry` is given. Collections use fake
+    embeddings and are preloaded with `chunks` single chunk sources each"""
+
+    def build(
+        llm_models: dict[str, Any],
+        bots: list[dict[str, Any]],
+        collections: Iterable[str] = (),
+        chunks: int = 5,
+        registry: MetricsRegistry | None = None,
+        **vector_db: Any,
+    ) -> Llore:
+        config_path = write_llore_config(tmp_path, llm_models, bots, **vector_db)
+        llore = Llore(config_path, registry=MetricsRegistry() if registry is None else registry)
+        for name in collections:
+            for shard in shard_names(llore.config, name):
+                llore._collections[shard] = fake_collection(tmp_path, shard)  # pyright: ignore[reportPrivateUsage]
+            for i in range(chunks):
+                source = f"{name}-{i}.pdf"
+                shard = shard_for_source(llore.config, name, source)
+                doc = Document(page_content=f"{name} chunk {i}", metadata={"source": source})
+                add_chunks(llore.config, shard, llore.get_collection(shard), [doc])
+        return llore
+
+    return build
+
+
+@pytest.fixture
+def llm_config() -> Callable[..., LLMModelConfig]:
+    """Factory of standalone `LLMModelConfig`s with metrics in a registry of
+    their own"""
+
+    def build(**config: Any) -> LLMModelConfig:
+        llm = LLMModelConfig.model_validate(config)
+        llm.registry = MetricsRegistry()
+        return llm
+
+    return build
+
+
+@pytest.fixture
+async def fake_llm() -> AsyncIterator[FakeLLM]:
+    fake = FakeLLM()
+    yield fake
+    fake.server.stop()
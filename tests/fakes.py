@@ -0,0 +1,143 @@
+"""Fakes shared by the tests: an upstream LLM server and Llore configs
+with collections that need no embedding model."""
+
+import asyncio
+import json
+from pathlib import Path
+from typing import Any
+
+import chromadb.config
+import tornado.httpserver
+import tornado.testing
+import tornado.web
+from langchain_chroma import Chroma
+from langchain_core.embeddings import DeterministicFakeEmbedding
+from typing_extensions import override
+
+MESSAGES = [{"role": "user", "content": "hello"}]
+
+
+def write_llore_config(
+    root: Path, llm_models: dict[str, Any], bots: list[dict[str, Any]], **vector_db: Any
+) -> Path:
+    """Write minimal config and bots into `root`, returns path to config.json"""
+    (root / "bots").mkdir(parents=True, exist_ok=True)
+    for bot in bots:
+        (root / "bots" / f"{bot['name']}.json").write_text(json.dumps(bot))
+    config = {
+        "bots": {"dir": str(root / "bots"), "glob": "*.json"},
+        "state_path": str(root / "state"),
+        "hf_hub_dir": str(root / "hf_hub"),
+        "vector_db": {
+            "dir": str(root / "chroma"),
+            "embeddings": {"model_name": "fake", "model_params": {}, "encode_params": {}},
+            **vector_db,
+        },
+        "llm_models": llm_models,
+    }
+    path = root / "config.json"
+    path.write_text(json.dumps(config))
+    return path
+
+
+def fake_collection(root: Path, name: str) -> Chroma:
+    """Chroma collection with deterministic fake embeddings, no model download"""
+    return Chroma(
+        client_settings=chromadb.config.Settings(
+            is_persistent=True, persist_directory=str(root / "chroma"), anonymized_telemetry=False
+        ),
+        embedding_function=DeterministicFakeEmbedding(size=32),
+        collection_name=name,
+    )
+
+
+class FakeLLM:
+    """Upstream LLM stub answering "echo: <last message>" in OpenAI
+    (`/openai`) or Ollama (`/ollama`) shape, streamed if asked to"""
+
+    port: int
+    server: tornado.httpserver.HTTPServer
+    requests: list[dict[str, Any]]
+    delay: float
+    chunk_delay: float
+    status: int
+    response_headers: dict[str, str]
+    ignore_stream: bool
+
+    def __init__(self):
+        self.requests = []
+        self.delay = 0.0
+        self.chunk_delay = 0.0
+        self.status = 200
+        self.ignore_stream = False
+        self.response_headers = {}
+        fake = self
+
+        class Handler(tornado.web.RequestHandler):
+            @override
+            async def post(self, shape: str):
+                body = json.loads(self.request.body)
+                fake.requests.append(body)
+                await asyncio.sleep(fake.delay)
+                for k, v in fake.response_headers.items():
+                    self.set_header(k, v)
+                if fake.status != 200:
+                    self.set_status(fake.status)
+                    self.write({"error": "fake error"})
+                    return
+                content = "echo: " + body["messages"][-1]["content"]
+                if not body.get("stream") or fake.ignore_stream:
+                    self.write(fake.response(shape, content))
+                    return
+                for word in content.split(" "):
+                    self.write(fake.stream_line(shape, word + " "))
+                    await self.flush()
+                    await asyncio.sleep(fake.chunk_delay)
+                usage = (3, len(content.split()))
+                if shape == "ollama" or body.get("stream_options", {}).get("include_usage"):
+                    self.write(fake.stream_line(shape, None, usage))
+                else:
+                    self.write(fake.stream_line(shape, None))
+
+        app = tornado.web.Application([(r"/(openai|ollama)", Handler)])
+        sock, self.port = tornado.testing.bind_unused_port()
+        self.server = tornado.httpserver.HTTPServer(app)
+        self.server.add_sockets([sock])
+
+    def url(self, shape: str = "openai") -> str:
+        return f"http://127.0.0.1:{self.port}/{shape}"
+
+    @staticmethod
+    def response(shape: str, content: str) -> dict[str, Any]:
+        message = {"role": "assistant", "content": content}
+        if shape == "ollama":
+            return {"created_at": "2025-05-13T22:30:11.079216Z", "message": message, "done": True}
+        return {
+            "created": 1747173868,
+            "choices": [{"message": message, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": 3, "completion_tokens": len(content.split())},
+        }
+
+    @staticmethod
+    def stream_line(shape: str, delta: str | None, usage: tuple[int, int] | None = None) -> str:
+        """A streamed line with `delta`, or the end of the stream when None,
+        reporting `usage` there if given"""
+        if shape == "ollama":
+            message = {"role": "assistant", "content": delta or ""}
+            line: dict[str, Any] = {"message": message, "done": delta is None}
+            if usage is not None:
+                line |= {"prompt_eval_count": usage[0], "eval_count": usage[1]}
+            return json.dumps(line) + "\n"
+        if delta is None:
+            if usage is None:
+                return "data: [DONE]\n\n"
+            # like OpenAI: finish_reason, then a chunk without choices
+            finish = {"choices": [{"delta": {}, "finish_reason": "stop"}]}
+            tokens = {"prompt_tokens": usage[0], "completion_tokens": usage[1]}
+            return (
+                f"data: {json.dumps(finish)}\n\n"
+                f"data: {json.dumps({'choices': [], 'usage': tokens})}\n\n"
+                "data: [DONE]\n\n"
+            )
+        chunk = {"choices": [{"delta": {"content": delta}, "finish_reason": None}]}
+        return f"data: {json.dumps(chunk)}\n\n"
@@ -0,0 +1,76 @@
+import json
+from collections.abc import Callable
+from pathlib import Path
+
+import pytest
+
+from botglue.llore.batch import BatchResult, run_batch
+from botglue.llore.pipeline import Llore
+from tests.fakes import FakeLLM
+
+
+def write_requests(path: Path, n: int) -> None:
+    lines = [
+        {"llm_name": "fake", "messages": [{"role": "user", "content": f"q{i}"}]} for i in range(n)
+    ]
+    lines[2] = {"id": "broken", "llm_name": "missing", "messages": []}
+    path.write_text("".join(json.dumps(line) + "\n" for line in lines))
+
+
+def read_results(path: Path) -> list[BatchResult]:
+    lines = path.read_text().splitlines()
+    return [BatchResult.model_validate_json(line) for line in lines if line.endswith("}")]
+
+
+@pytest.mark.asyncio
+async def test_batch_resume(fake_llm: FakeLLM, fake_llore: Callable[..., Llore], tmp_path: Path):
+    fake_llm.delay = 0.05
+    llore = fake_llore({"fake": {"model_name": "m", "url": fake_llm.url()}}, [])
+    input, output = tmp_path / "in.jsonl", tmp_path / "out" / "results.jsonl"
+    write_requests(input, 6)
+
+    summary = await run_batch(llore, input, output, concurrency=3)
+    assert (summary.total, summary.succeeded, summary.failed) == (6, 5, 1)
+    results = {r.id: r for r in read_results(output)}
+    assert results["1"].response is not None
+    assert results["1"].response.generation.content == "echo: q0"
+    assert results["broken"].error is not None and results["broken"].response is None
+    assert all(r.seconds >= 0.05 for r in results.values() if r.error is None)
+    assert len(fake_llm.requests) == 5
+
+    # interrupted run: two answers and half of a third one made it
+    kept = [line for line in output.read_text().splitlines() if '"error":null' in line][:2]
+    output.write_text("\n".join(kept) + '\n{"id": "4", "respo')
+    summary = await run_batch(llore, input, output, concurrency=3)
+    assert (summary.skipped, summary.succeeded, summary.failed) == (2, 3, 1)
+    assert len(fake_llm.requests) == 8
+    results = read_results(output)
+    assert len(results) == 6
+    assert {r.id for r in results} == {"1", "2", "broken", "4", "5", "6"}
+
+
+@pytest.mark.asyncio
+async def test_batch_wait(fake_llm: FakeLLM, fake_llore: Callable[..., Llore], tmp_path: Path):
+    fake_llm.delay = 0.05
+    llore = fake_llore({"fake": {"model_name": "m", "url": fake_llm.url()}}, [])
+    input, output = tmp_path / "in.jsonl", tmp_path / "results.jsonl"
+    write_requests(input, 12)
+    summary = await run_batch(llore, input, output, concurrency=2)
+    assert summary.seconds > 0.25
+    # queued at most one request ahead per worker, not since the batch start
+    waits = [r.wait_seconds for r in read_results(output) if r.error is None]
+    assert len(waits) == 11 and max(waits) < 0.15
+
+
+@pytest.mark.asyncio
+async def test_batch_bad_line(fake_llm: FakeLLM, fake_llore: Callable[..., Llore], tmp_path: Path):
+    llore = fake_llore({"fake": {"model_name": "m", "url": fake_llm.url()}}, [])
+    input, output = tmp_path / "in.jsonl", tmp_path / "results.jsonl"
+    write_requests(input, 4)
+    lines = input.read_text().splitlines(keepends=True)
+    input.write_text("".join([*lines[:1], '{"llm_name": "fake", "mess\n', "[1]\n", *lines[1:]]))
+    summary = await run_batch(llore, input, output, concurrency=2)
+    assert (summary.total, summary.succeeded, summary.failed) == (6, 3, 3)
+    results = {r.id: r for r in read_results(output)}
+    assert results["2"].error is not None and results["3"].error is not None
+    assert {i for i, r in results.items() if r.error is None} == {"1", "4", "6"}
@@ -0,0 +1,89 @@
+import asyncio
+import sqlite3
+import time
+from collections.abc import Callable
+from pathlib import Path
+
+import pytest
+
+from botglue.llore.api import ChatMsg
+from botglue.llore.cache import ResponseCache
+from botglue.llore.pipeline import Llore
+from botglue.metrics import MetricsRegistry
+from tests.fakes import FakeLLM
+
+
+@pytest.mark.asyncio
+async def test_single_flight(fake_llm: FakeLLM, fake_llore: Callable[..., Llore]):
+    fake_llm.delay = 0.2
+    llore = fake_llore({"fake": {"model_name": "m", "url": fake_llm.url()}}, [])
+
+    def msgs(content: str) -> list[ChatMsg]:
+        return [ChatMsg(role="user", content=content)]
+
+    same = [llore.query_llm("fake", msgs("same")) for _ in range(5)]
+    results = await asyncio.gather(*same, llore.query_llm("fake", msgs("other")))
+    assert len(fake_llm.requests) == 2
+    assert [r.generation.content for r in results] == ["echo: same"] * 5 + ["echo: other"]
+    assert len(llore.llm_flights) == 0
+
+    # a cancelled caller does not cancel the call shared with others
+    first = asyncio.create_task(llore.query_llm("fake", msgs("same")))
+    second = asyncio.create_task(llore.query_llm("fake", msgs("same")))
+    await asyncio.sleep(0.05)
+    first.cancel()
+    assert (await second).generation.content == "echo: same"
+    assert len(fake_llm.requests) == 3
+
+
+@pytest.mark.asyncio
+async def test_response_cache(fake_llm: FakeLLM, fake_llore: Callable[..., Llore]):
+    models = {
+        "cached": {"model_name": "m", "url": fake_llm.url(), "cache": {"max_entries": 2}},
+        "plain": {"model_name": "m", "url": fake_llm.url()},
+    }
+    llore = fake_llore(models, [])
+
+    async def ask(llore: Llore, llm_name: str, content: str) -> str:
+        r = await llore.query_llm(llm_name, [ChatMsg(role="user", content=content)])
+        return r.generation.content
+
+    assert await ask(llore, "cached", "a") == await ask(llore, "cached", "a") == "echo: a"
+    assert await ask(llore, "plain", "a") == await ask(llore, "plain", "a")
+    assert len(fake_llm.requests) == 3
+    lookups = llore.registry.counter("llm_cache_lookups_total")
+    assert lookups.get(model="cached", result="hit") == 1
+
+    # survives restarts, least recently used is evicted beyond max_entries
+    llore = fake_llore(models, [])
+    for content in ("b", "a", "c", "a", "b"):
+        await ask(llore, "cached", content)
+    assert [r["messages"][-1]["content"] for r in fake_llm.requests[3:]] == ["b", "c", "b"]
+
+    llore.config.llm_models["cached"].cache.ttl = 0.01  # pyright: ignore[reportOptionalMemberAccess]
+    await ask(llore, "cached", "d")
+    await asyncio.sleep(0.05)
+    await ask(llore, "cached", "d")
+    assert len(fake_llm.requests) == 8
+
+
+def test_response_cache_accesses(tmp_path: Path):
+    cache = ResponseCache(tmp_path / "state.db", MetricsRegistry(), flush_hits=3)
+
+    def hits() -> int:
+        with sqlite3.connect(tmp_path / "state.db") as conn:
+            return conn.execute("SELECT hits FROM LlmResponse WHERE cache_key = 'k'").fetchone()[0]
+
+    cache.put("k", "m", "body", ttl=60, max_entries=10)
+    assert cache.get("k", "m") == cache.get("k", "m") == "body"
+    assert hits() == 0  # hits only read
+    # another writer holds the db, the batch is kept instead of waiting
+    locker = sqlite3.connect(tmp_path / "state.db")
+    locker.execute("BEGIN IMMEDIATE")
+    start = time.monotonic()
+    assert cache.get("k", "m") == "body"
+    assert time.monotonic() - start < 1
+    locker.rollback()
+    locker.close()
+    cache.put("k2", "m", "other", ttl=60, max_entries=10)
+    assert hits() == 3
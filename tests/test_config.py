@@ -39,6 +39,7 @@ def test_config(caplog: pytest.LogCaptureFixture):
     assert config.bots.dir == Path("data/bots/").absolute()
     assert config.vector_db.dir == Path("data/chroma/").absolute()
     assert config.llm_models["4o"].url == "https://api.openai.com/v1/chat/completions"
+    assert config.llm_models["4o"].pool.name == "4o"
     assert config.llm_models["4o"].api_key is not None
     assert config.llm_models["4o"].api_key[:3] == "sk-"
     assert len(bots) == 1
@@ -0,0 +1,61 @@
+import pytest
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+from langchain_core.documents import Document
+from pydantic import ValidationError
+
+from botglue.llore.config import LLMModelConfig, RagConfig
+from botglue.llore.context import count_tokens, format_context, merge_chunks, pack_chunks
+
+TEXT = " ".join(f"Sentence number {i} talks about block ciphers and keys." for i in range(60))
+
+
+def split(add_start_index: bool) -> list[Document]:
+    splitter = RecursiveCharacterTextSplitter(
+        chunk_size=300, chunk_overlap=60, add_start_index=add_start_index
+    )
+    return splitter.split_documents([Document(page_content=TEXT, metadata={"source": "a.pdf"})])
+
+
+def test_merge_overlapping_chunks():
+    for add_start_index in (True, False):
+        chunks = split(add_start_index)
+        assert len(chunks) > 5
+        # retrieved out of order, with a duplicate and a chunk from other source
+        other = Document(page_content="unrelated", metadata={"source": "b.pdf"})
+        retrieved = [chunks[3], other, chunks[2], chunks[3], chunks[4]]
+        merged = merge_chunks(retrieved)
+        assert [d.metadata["source"] for d in merged] == ["a.pdf", "b.pdf"]
+        text = merged[0].page_content
+        assert text.startswith(chunks[2].page_content)
+        assert text.endswith(chunks[4].page_content)
+        assert text in TEXT
+        # far apart chunks are not glued together
+        assert len(merge_chunks([chunks[0], chunks[5]])) == 2
+
+
+def test_pack_to_budget():
+    chunks = split(True)
+    texts = count_tokens(chunks[0].page_content) + count_tokens(chunks[5].page_content)
+    # headers and the separator of the rendered context count too
+    assert len(pack_chunks([chunks[0], chunks[5]], texts)) == 1
+    budget = count_tokens(format_context([chunks[0]])) + count_tokens(format_context([chunks[5]]))
+    budget += count_tokens("\n\n")
+    packed = pack_chunks([chunks[0], chunks[5], chunks[3]], budget)
+    assert [d.page_content for d in packed] == [chunks[0].page_content, chunks[5].page_content]
+    assert count_tokens(format_context(packed)) <= budget
+    assert format_context(packed).startswith("[a.pdf]\n")
+
+
+def test_rag_config():
+    rag = RagConfig(files=[], vector_db_collection="c")
+    assert rag.search_type == "similarity"
+    assert rag.search_kwargs() == {"k": 4}
+    rag = RagConfig(files=[], vector_db_collection="c", search_type="mmr", k=6, fetch_k=3)
+    assert rag.search_kwargs() == {"k": 6, "fetch_k": 6}
+    llm = LLMModelConfig(model_name="m", url="http://localhost", context_window=16384)
+    assert rag.context_budget(llm) == 8192
+    assert rag.context_budget(LLMModelConfig(model_name="m", url="http://localhost")) is None
+    with pytest.raises(ValidationError, match="needs a score_threshold"):
+        RagConfig(files=[], vector_db_collection="c", search_type="similarity_score_threshold")
+    with pytest.raises(ValidationError):
+        RagConfig(files=[], vector_db_collection=[])
@@ -0,0 +1,72 @@
+from collections.abc import Callable
+
+import pytest
+
+from botglue.llore.api import ChatMsg
+from botglue.llore.context import count_tokens
+from botglue.llore.history import (
+    SUMMARY_PREFIX,
+    history_tokens,
+    sliding_window,
+    token_counter,
+    truncate_tokens,
+)
+from botglue.llore.pipeline import Llore
+from tests.fakes import FakeLLM
+
+
+def conversation(turns: int) -> list[ChatMsg]:
+    msgs = [ChatMsg(role="system", content="You are terse.")]
+    for i in range(turns):
+        msgs.append(ChatMsg(role="user", content=f"question {i} " + "q" * 80))
+        msgs.append(ChatMsg(role="assistant", content=f"answer {i} " + "a" * 80))
+    msgs.append(ChatMsg(role="user", content="last question"))
+    return msgs
+
+
+def test_sliding_window():
+    msgs = conversation(10)
+    kept, dropped = sliding_window(msgs, 100)
+    assert history_tokens(kept) <= 100
+    assert kept[0].role == "system" and kept[-1].content == "last question"
+    assert kept[1:] == msgs[len(dropped) + 1 :]
+
+
+@pytest.mark.slow
+def test_tokenizer_fallback():
+    assert token_counter("/no/such/tokenizer") is count_tokens
+
+
+@pytest.mark.asyncio
+async def test_compaction(fake_llm: FakeLLM, fake_llore: Callable[..., Llore]):
+    models = {
+        "small": {
+            "model_name": "small",
+            "url": fake_llm.url(),
+            "context_window": 200,
+            "history": {"summarize_with": "summarizer", "summary_tokens": 32},
+        },
+        "summarizer": {"model_name": "summarizer", "url": fake_llm.url()},
+        "plain": {"model_name": "plain", "url": fake_llm.url(), "context_window": 200},
+    }
+    llore = fake_llore(models, [])
+
+    await llore.query_llm("plain", conversation(10))
+    sent = [ChatMsg.model_validate(m) for m in fake_llm.requests[-1]["messages"]]
+    assert history_tokens(sent) <= 150 and sent[-1].content == "last question"
+
+    for turns in (10, 11):
+        r = await llore.query_llm("small", conversation(turns))
+        assert r.generation.content == "echo: last question"
+    summarizer = [r for r in fake_llm.requests if r["model"] == "summarizer"]
+    small = [r for r in fake_llm.requests if r["model"] == "small"]
+    assert len(summarizer) == 2 and len(small) == 2
+    # the second summary extends the first one with the newly dropped turns only
+    first = truncate_tokens("echo: " + summarizer[0]["messages"][-1]["content"], 32)
+    transcript = summarizer[1]["messages"][-1]["content"]
+    assert transcript.startswith(f"{SUMMARY_PREFIX}{first}\n\n")
+    assert "question 0" not in transcript[len(SUMMARY_PREFIX + first) :]
+    for r in small:
+        sent = [ChatMsg.model_validate(m) for m in r["messages"]]
+        assert history_tokens(sent) <= 150
+        assert sent[1].role == "system" and sent[1].content.startswith(SUMMARY_PREFIX)
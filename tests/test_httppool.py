@@ -0,0 +1,98 @@
+import asyncio
+import json
+import time
+from collections.abc import Callable
+
+import pytest
+from tornado.httpclient import HTTPClientError, HTTPRequest
+
+from botglue.deadline import DeadlineExceeded, deadline
+from botglue.httppool import HttpPool, fetch_lines
+from botglue.llore.config import LLMModelConfig
+from botglue.llore.pipeline import Llore
+from botglue.metrics import MetricsRegistry
+from tests.fakes import MESSAGES, FakeLLM
+
+
+@pytest.mark.asyncio
+async def test_pool_per_model(fake_llm: FakeLLM, llm_config: Callable[..., LLMModelConfig]):
+    fast = FakeLLM()
+    try:
+        fake_llm.delay = 0.5
+        slow_llm = llm_config(model_name="slow", url=fake_llm.url(), http={"max_clients": 2})
+        fast_llm = llm_config(model_name="fast", url=fast.url())
+        slow = [asyncio.create_task(slow_llm.query(MESSAGES)) for _ in range(4)]
+        await asyncio.sleep(0.1)
+        start = time.monotonic()
+        await asyncio.gather(*(fast_llm.query(MESSAGES) for _ in range(10)))
+        # saturated slow backend does not hold up the fast one
+        assert time.monotonic() - start < 0.3
+        await asyncio.gather(*slow)
+        wait = slow_llm.registry.histogram("http_pool_queue_wait_seconds").get(pool="slow")
+        upstream = slow_llm.registry.histogram("http_pool_upstream_seconds").get(pool="slow")
+        assert wait.count == upstream.count == 4
+        # two requests waited for a slot the full upstream latency
+        assert 0.9 < wait.sum < 1.2 and upstream.sum >= 2.0
+    finally:
+        fast.server.stop()
+
+
+def test_pool_config(fake_llm: FakeLLM, llm_config: Callable[..., LLMModelConfig]):
+    http = {"connect_timeout": 1.5, "request_timeout": 7}
+    llm = llm_config(model_name="m", url=fake_llm.url(), http=http)
+    request = llm.pool.prepare(llm.build_request(MESSAGES))
+    assert (request.connect_timeout, request.request_timeout) == (1.5, 7)
+    request = llm.pool.prepare(llm.build_request(MESSAGES, request_timeout=3))
+    assert request.request_timeout == 3
+    assert llm.pool is llm.pool and llm.pool.name == "m"
+
+
+@pytest.mark.asyncio
+async def test_pool_abort(fake_llm: FakeLLM):
+    """A cancelled streamed fetch is aborted on its next chunk, only then
+    its slot goes to the next request"""
+    fake_llm.chunk_delay = 0.3
+    registry = MetricsRegistry()
+    pool = HttpPool("abort", max_clients=1, registry=registry)
+    body = {"model": "m", "messages": [{"role": "user", "content": "a b c d e f"}], "stream": True}
+
+    async def consume() -> None:
+        request = HTTPRequest(fake_llm.url(), method="POST", body=json.dumps(body))
+        async for _ in fetch_lines(request, pool=pool):
+            pass
+
+    task = asyncio.create_task(consume())
+    await asyncio.sleep(0.1)
+    task.cancel()
+    start = time.monotonic()
+    request = HTTPRequest(fake_llm.url(), method="POST", body=json.dumps(body | {"stream": False}))
+    response = await pool.fetch(request)
+    assert b"echo" in response.body
+    # the next chunk came 0.3s after the first, the rest of the stream would take 1.5s
+    assert 0.1 < time.monotonic() - start < 0.6
+    assert registry.gauge("http_pool_in_flight").get(pool="abort") == 0
+    pool.close()
+
+
+@pytest.mark.asyncio
+async def test_llore_warmup(fake_llm: FakeLLM, fake_llore: Callable[..., Llore]):
+    llore = fake_llore({"warm": {"model_name": "m", "url": fake_llm.url()}}, [])
+    await llore.warmup()
+    assert (llore.config.state_path / "state.db").exists()
+    # connected to the backend without sending a chat
+    assert llore.registry.histogram("http_pool_upstream_seconds").get(pool="warm").count == 1
+    assert fake_llm.requests == []
+
+
+@pytest.mark.asyncio
+async def test_query_deadline(fake_llm: FakeLLM, llm_config: Callable[..., LLMModelConfig]):
+    llm = llm_config(model_name="deadline", url=fake_llm.url(), replicas={"retries": 0})
+    fake_llm.delay = 5
+    start = time.monotonic()
+    with deadline(0.1), pytest.raises(HTTPClientError) as e:
+        await llm.query(MESSAGES)
+    # upstream timeout is cut to the deadline (plus grace), not http.request_timeout
+    assert e.value.code == 599 and time.monotonic() - start < 2
+    with deadline(0), pytest.raises(DeadlineExceeded):
+        await llm.query(MESSAGES)
+    assert len(fake_llm.requests) == 1
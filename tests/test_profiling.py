@@ -0,0 +1,82 @@
+import asyncio
+import threading
+import time
+
+import pytest
+from tornado.httpclient import AsyncHTTPClient
+from tornado.routing import PathMatches
+
+from botglue.metrics import MetricsRegistry
+from botglue.profiling import ProfilerBusy, profile_loop, sample_stacks
+from botglue.service import PROFILE_ROUTE, App, AppService, AppState
+
+
+def spin(seconds: float) -> None:
+    end = time.monotonic() + seconds
+    while time.monotonic() < end:
+        pass
+
+
+def test_sample_stacks():
+    thread = threading.Thread(target=spin, args=(0.5,), name="spinner")
+    thread.start()
+    stacks = sample_stacks(0.3, interval=0.01)
+    thread.join()
+    spinning = sum(n for stack, n in stacks.items() if stack.startswith("spinner;"))
+    assert spinning > 10
+    assert any(stack.split(";")[-1].startswith("spin (") for stack in stacks)
+
+
+@pytest.mark.asyncio
+async def test_profile_loop():
+    async def busy():
+        for _ in range(5):
+            spin(0.02)
+            await asyncio.sleep(0.01)
+
+    task = asyncio.create_task(busy())
+    profiling = asyncio.create_task(profile_loop(0.2))
+    await asyncio.sleep(0.01)
+    with pytest.raises(ProfilerBusy):
+        await profile_loop(0.1)
+    text = await profiling
+    await task
+    assert "function calls" in text and "spin" in text
+
+
+class PeriodicService(AppService[AppState]):
+    def __init__(self):
+        super().__init__()
+        self.add_periodic(1, self.busy_periodic)
+
+    def busy_periodic(self):
+        spin(0.5)
+
+
+@pytest.mark.asyncio
+async def test_profile_route():
+    registry = MetricsRegistry()
+    state = AppState(PeriodicService(), profiling=True, registry=registry)
+    app = App("profiled", state, registry=registry)
+    running = asyncio.create_task(app.run())
+    while not app.is_ready:
+        await asyncio.sleep(0.01)
+    client = AsyncHTTPClient(force_instance=True)
+    base = f"http://127.0.0.1:{state.port}/admin/profile"
+    try:
+        response = await client.fetch(f"{base}?seconds=0.3&interval=0.01")
+        # sync periodic tasks run on executor threads, sampled with the rest
+        assert b"busy_periodic (" in response.body
+        response = await client.fetch(f"{base}?seconds=0.1&mode=cprofile")
+        assert b"function calls" in response.body
+        for bad in ("mode=perf", "seconds=0", "seconds=600", "interval=0", "sort=nope"):
+            response = await client.fetch(f"{base}?{bad}", raise_error=False)
+            assert response.code == 400, bad
+    finally:
+        client.close()
+        app.shutdown()
+        await running
+    # opt-in only
+    rules = AppState(PeriodicService()).tornado_app().wildcard_router.rules
+    paths = [r.matcher.regex.pattern for r in rules if isinstance(r.matcher, PathMatches)]
+    assert "/metrics$" in paths and not [p for p in paths if p.startswith(PROFILE_ROUTE)]
@@ -0,0 +1,107 @@
+from pathlib import Path
+
+import chromadb.config
+import numpy as np
+import pytest
+from langchain_chroma import Chroma
+from langchain_core.documents import Document
+from langchain_core.embeddings import DeterministicFakeEmbedding
+from numpy.typing import NDArray
+
+from botglue.llore.config import Config, EmbeddingModel, FileGlob, VectorDb
+from botglue.llore.quant import QuantizedIndex, benchmark_recall, exact_top_k
+from botglue.llore.vector import (
+    QuantizedRetriever,
+    add_chunks,
+    delete_source,
+    get_quantized_index,
+    get_retriever,
+    quantized_index_path,
+)
+
+
+def clustered_vectors(n: int, dim: int, seed: int = 7) -> NDArray[np.float32]:
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(32, dim))
+    v = centers[rng.integers(0, 32, n)] + 0.3 * rng.normal(size=(n, dim))
+    return (v / np.linalg.norm(v, axis=1, keepdims=True)).astype(np.float32)
+
+
+@pytest.mark.parametrize("dtype,code_bytes", [("int8", 1), ("float16", 2)])
+def test_benchmark_recall(dtype: str, code_bytes: int):
+    v = clustered_vectors(5000, 64)
+    report = benchmark_recall(v[100:], v[:100], k=4, dtype=dtype, rescore_candidates=16)  # pyright: ignore[reportArgumentType]
+    # uuid sized ids, codes and a float32 norm per vector
+    assert report["quantized_bytes"] == 4900 * (36 * 4 + 64 * code_bytes + 4)
+    assert report["total_bytes"] == report["store_bytes"] + report["quantized_bytes"]
+    assert report["store_bytes"] > report["float32_bytes"]
+    assert report["recall"] > 0.9
+    assert report["rescored_recall"] >= report["recall"]
+    assert report["rescored_recall_delta"] > -0.02
+
+
+@pytest.mark.parametrize("first_batch", [1, 20])
+def test_small_batches(first_batch: int):
+    """Chunks of one document are added at a time, the int8 range widens"""
+    v = clustered_vectors(2100, 64)
+    queries, v = v[:100], v[100:]
+    index = QuantizedIndex("int8")
+    bounds = [0, first_batch, *range(first_batch + 20, len(v), 20), len(v)]
+    for start, end in zip(bounds, bounds[1:], strict=False):
+        index.add([str(i) for i in range(start, end)], v[start:end])
+    assert len(index) == len(v)
+    hits = 0
+    for q in queries:
+        exact = set(exact_top_k(v, q, 4))
+        hits += len(exact.intersection(int(i) for i, _ in index.search(q, 4)))
+    assert hits / (4 * len(queries)) > 0.9
+
+
+def test_save_load(tmp_path: Path):
+    v = clustered_vectors(300, 16)
+    index = QuantizedIndex("int8")
+    index.add([f"x{i}" for i in range(300)], v)
+    path = tmp_path / "idx.npz"
+    index.save(path)
+    loaded = QuantizedIndex.load(path)
+    assert len(loaded) == 300
+    assert loaded.search(v[5], 3) == index.search(v[5], 3)
+
+
+def test_quantized_collection(tmp_path: Path):
+    config = Config(
+        bots=FileGlob(dir=tmp_path, glob="*.json"),
+        state_path=tmp_path / "state",
+        hf_hub_dir=tmp_path / "hf_hub",
+        vector_db=VectorDb(
+            dir=tmp_path / "chroma",
+            embeddings=EmbeddingModel(model_name="fake", model_params={}, encode_params={}),
+            quantization="int8",
+            rescore_candidates=8,
+        ),
+        llm_models={},
+    )
+    db = Chroma(
+        client_settings=chromadb.config.Settings(
+            is_persistent=True,
+            persist_directory=str(tmp_path / "chroma"),
+            anonymized_telemetry=False,
+        ),
+        embedding_function=DeterministicFakeEmbedding(size=32),
+        collection_name="docs",
+    )
+    chunks = [
+        Document(page_content=f"chunk {i}", metadata={"source": f"s{i % 3}.pdf"}) for i in range(30)
+    ]
+    add_chunks(config, "docs", db, chunks)
+    assert quantized_index_path(config, "docs").exists()
+    retriever = get_retriever(config, "docs", db)
+    assert isinstance(retriever, QuantizedRetriever)
+    found = retriever.invoke("chunk 7")
+    assert found[0].page_content == "chunk 7"
+    assert len(found) == 4
+
+    delete_source(config, "docs", db, Path("s1.pdf"))
+    index = get_quantized_index(config, "docs", db)
+    assert index is not None and len(index) == 20
+    assert all(d.metadata["source"] != "s1.pdf" for d in retriever.invoke("chunk 7"))
@@ -0,0 +1,104 @@
+import asyncio
+import time
+from collections.abc import Callable
+
+import pytest
+from tornado.httpclient import HTTPClientError
+
+from botglue.llore.config import LLMModelConfig
+from botglue.metrics import MetricsRegistry
+from botglue.ratelimit import RateLimited, RateLimiter
+from tests.fakes import MESSAGES, FakeLLM
+
+
+@pytest.mark.asyncio
+async def test_requests_per_second():
+    limiter = RateLimiter("rps", requests_per_second=20, registry=MetricsRegistry())
+    start = time.monotonic()
+    await asyncio.gather(*(limiter.acquire() for _ in range(30)))
+    # a burst of 20, then 10 more at 20/s
+    assert 0.4 < time.monotonic() - start < 0.8
+
+
+@pytest.mark.asyncio
+async def test_tokens_per_minute():
+    limiter = RateLimiter("tpm", tokens_per_minute=6000, registry=MetricsRegistry())
+    start = time.monotonic()
+    await limiter.acquire(100)
+    await limiter.acquire(50)  # bucket is 100 tokens, refills 100/s
+    assert 0.4 < time.monotonic() - start < 0.7
+    limiter.settle(estimated=50, actual=10)
+    await limiter.acquire(40)
+    assert time.monotonic() - start < 0.75
+
+
+@pytest.mark.asyncio
+async def test_priority_and_queue():
+    registry = MetricsRegistry()
+    limiter = RateLimiter("prio", requests_per_second=10, max_queue=3, registry=registry)
+    for _ in range(10):
+        await limiter.acquire()
+    order: list[str] = []
+
+    async def call(name: str, priority: str):
+        await limiter.acquire(priority=priority)  # pyright: ignore[reportArgumentType]
+        order.append(name)
+
+    batch = [asyncio.create_task(call(f"b{i}", "batch")) for i in range(2)]
+    await asyncio.sleep(0)
+    interactive = asyncio.create_task(call("i", "interactive"))
+    await asyncio.sleep(0)
+    with pytest.raises(RateLimited):
+        await limiter.acquire()
+    batch[1].cancel()
+    await asyncio.gather(batch[0], interactive)
+    assert order == ["i", "b0"]
+    assert registry.counter("rate_limit_rejected_total").get(limiter="prio") == 1
+
+
+@pytest.mark.asyncio
+async def test_throttled():
+    limiter = RateLimiter("429", requests_per_second=100, registry=MetricsRegistry())
+    assert limiter.requests is not None
+    limiter.throttled(retry_after=0.3)
+    limiter.throttled()
+    assert limiter.requests.rate == 25
+    start = time.monotonic()
+    await limiter.acquire()
+    assert time.monotonic() - start >= 0.29
+    for _ in range(20):
+        limiter.succeeded()
+    assert limiter.requests.rate == 100
+
+
+@pytest.mark.asyncio
+async def test_no_queue():
+    limiter = RateLimiter("noq", requests_per_second=10, max_queue=0, registry=MetricsRegistry())
+    for _ in range(10):
+        await limiter.acquire()
+    with pytest.raises(RateLimited) as e:
+        await limiter.acquire()
+    assert 0.05 < e.value.retry_after <= 0.1
+    await asyncio.sleep(0.1)
+    await limiter.acquire()
+
+
+@pytest.mark.asyncio
+async def test_rate_limit_429(fake_llm: FakeLLM, llm_config: Callable[..., LLMModelConfig]):
+    fake_llm.status = 429
+    fake_llm.response_headers = {"Retry-After": "0.3"}
+    asyncio.get_running_loop().call_later(0.1, setattr, fake_llm, "status", 200)
+    llm = llm_config(model_name="m", url=fake_llm.url(), rate_limit={"requests_per_second": 50})
+    start = time.monotonic()
+    result = await llm.query(MESSAGES)
+    assert result["choices"][0]["message"]["content"] == "echo: hello"
+    assert time.monotonic() - start >= 0.29 and len(fake_llm.requests) == 2
+    assert llm.limiter is not None and llm.limiter.requests is not None
+    assert llm.limiter.requests.rate < 50
+
+    fake_llm.status = 429
+    llm.rate_limit.retries = 0  # pyright: ignore[reportOptionalMemberAccess]
+    with pytest.raises(HTTPClientError) as e:
+        await llm.query(MESSAGES)
+    assert e.value.code == 429
+    assert llm.estimate_tokens([{"role": "user", "content": "x" * 40}]) == 10
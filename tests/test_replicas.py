@@ -0,0 +1,91 @@
+import asyncio
+import time
+from collections.abc import AsyncGenerator, Callable
+from functools import partial
+
+import pytest
+import tornado.testing
+from tornado.httpclient import HTTPClientError
+
+from botglue.llore.config import LLMModelConfig
+from botglue.replicas import ReplicaSet
+from tests.fakes import MESSAGES, FakeLLM
+
+
+def dead_url() -> str:
+    sock, port = tornado.testing.bind_unused_port()
+    sock.close()
+    return f"http://127.0.0.1:{port}/openai"
+
+
+def test_replica_set_balancing():
+    rs = ReplicaSet("x", ["a", "b", "c"], failure_threshold=2, cooldown=60)
+    a, b = rs.acquire(), rs.acquire()
+    assert {a.url, b.url} == {"a", "b"}
+    rs.release(a)
+    assert rs.acquire().url in ("a", "c")
+    for _ in range(2):
+        rs.release(rs.replicas[1], HTTPClientError(502))
+        rs.replicas[1].outstanding += 1
+    rs.release(rs.replicas[1])
+    # "b" is ejected, least loaded of the rest is picked
+    assert [rs.acquire().url for _ in range(4)].count("b") == 0
+    for r in rs.replicas:
+        r.ejected_until = time.monotonic() + 10 if r.url != "c" else time.monotonic() + 5
+    assert rs.acquire().url == "c"
+
+
+@pytest.mark.asyncio
+async def test_replica_cancelled(fake_llm: FakeLLM, llm_config: Callable[..., LLMModelConfig]):
+    """Cancelled requests leave the failure count of the replica alone"""
+    rs = ReplicaSet("x", ["a"], failure_threshold=2)
+    rs.release(rs.acquire(), HTTPClientError(502))
+    task = asyncio.create_task(rs.call(partial(asyncio.sleep, 10)))
+    await asyncio.sleep(0.01)
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+    assert (rs.replicas[0].outstanding, rs.replicas[0].failures) == (0, 1)
+
+    fake_llm.chunk_delay = 0.05
+    llm = llm_config(model_name="m", url=fake_llm.url())
+    replica = llm.replica_set.replicas[0]
+    replica.failures = 1
+    stream = llm.query_stream(MESSAGES)
+    assert isinstance(stream, AsyncGenerator)
+    await anext(stream)
+    await stream.aclose()
+    assert (replica.outstanding, replica.failures) == (0, 1)
+
+
+@pytest.mark.asyncio
+async def test_replicas_failover(fake_llm: FakeLLM, llm_config: Callable[..., LLMModelConfig]):
+    broken = FakeLLM()
+    broken.status = 503
+    try:
+        replicas = {
+            "urls": [broken.url(), fake_llm.url()],
+            "retries": 2,
+            "backoff": 0.01,
+            "failure_threshold": 1,
+        }
+        llm = llm_config(model_name="m", url=dead_url(), replicas=replicas)
+        for _ in range(3):
+            result = await llm.query(MESSAGES)
+            assert result["choices"][0]["message"]["content"] == "echo: hello"
+        # both failing replicas got ejected after their first failure
+        assert len(broken.requests) == 1 and len(fake_llm.requests) == 3
+        chunks = [c async for c in llm.query_stream(MESSAGES)]
+        assert "".join(c.delta for c in chunks) == "echo: hello "
+
+        llm = llm_config(model_name="m", url=broken.url(), replicas={"retries": 1, "backoff": 0})
+        with pytest.raises(HTTPClientError) as e:
+            await llm.query(MESSAGES)
+        assert e.value.code == 503 and len(broken.requests) == 3
+        fake_llm.status = 400  # client errors are not retried
+        llm = llm_config(model_name="m", url=fake_llm.url())
+        with pytest.raises(HTTPClientError):
+            await llm.query(MESSAGES)
+        assert len(fake_llm.requests) == 5
+    finally:
+        broken.server.stop()
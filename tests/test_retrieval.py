@@ -0,0 +1,107 @@
+import subprocess
+import sys
+from collections.abc import Callable
+from pathlib import Path
+
+import pytest
+
+from botglue.llore.pipeline import Llore
+from botglue.llore.vector import shard_for_source, shard_names
+
+COLLECTIONS = ("policies", "tickets", "docs")
+INGEST_SCRIPT = """
+import sys
+from langchain_core.documents import Document
+from langchain_core.embeddings import DeterministicFakeEmbedding
+from botglue.llore.pipeline import Llore
+from botglue.llore.vector import add_chunks, get_vector_collection, mark_ingested
+
+config = Llore(sys.argv[1]).config
+db = get_vector_collection(config, "docs", DeterministicFakeEmbedding(size=32))
+add_chunks(config, "docs", db, [Document(page_content="docs chunk new", metadata={"source": "new.pdf"})])
+mark_ingested(config)
+"""
+MODELS = {"m": {"model_name": "m", "url": "http://localhost:1/", "context_window": 4096}}
+
+
+@pytest.mark.asyncio
+async def test_fan_out_retrieval(fake_llore: Callable[..., Llore]):
+    bot = {
+        "name": "multi",
+        "model": {"name": "m", "params": {}},
+        "rag": {"files": [], "vector_db_collection": list(COLLECTIONS), "k": 3},
+    }
+    llore = fake_llore(MODELS, [bot], COLLECTIONS)
+    rag = llore.bots["multi"].rag
+    assert rag is not None and rag.collections == list(COLLECTIONS)
+    docs = await llore.retrieve(rag, "tickets chunk 2")
+    assert len(docs) == 3
+    assert docs[0].page_content == "tickets chunk 2"
+    assert llore.retrieval.queued == llore.retrieval.active == 0
+
+
+@pytest.mark.asyncio
+async def test_sharded_retrieval(fake_llore: Callable[..., Llore]):
+    bot = {
+        "name": "sharded",
+        "model": {"name": "m", "params": {}},
+        "rag": {"files": [], "vector_db_collection": "docs", "k": 4},
+    }
+    llore = fake_llore(MODELS, [bot], ["docs"], chunks=30, shards=3)
+    shards = shard_names(llore.config, "docs")
+    assert len(shards) == 3
+    sizes = [len(llore.get_collection(s).get()["ids"]) for s in shards]
+    assert sum(sizes) == 30 and all(n > 0 for n in sizes)
+    assert shard_for_source(llore.config, "docs", "x.pdf") == shard_for_source(
+        llore.config, "docs", "x.pdf"
+    )
+    rag = llore.bots["sharded"].rag
+    assert rag is not None
+    for i in (3, 17, 29):
+        docs = await llore.retrieve(rag, f"docs chunk {i}")
+        assert len(docs) == 4
+        assert docs[0].page_content == f"docs chunk {i}"
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("quantization", ["none", "int8"])
+async def test_score_threshold(fake_llore: Callable[..., Llore], quantization: str):
+    rag = {"files": [], "vector_db_collection": "docs", "k": 3, "score_threshold": 0.9}
+    bots = [
+        {"name": "plain", "model": {"name": "m", "params": {}}, "rag": rag},
+        {
+            "name": "threshold",
+            "model": {"name": "m", "params": {}},
+            "rag": {**rag, "search_type": "similarity_score_threshold"},
+        },
+    ]
+    llore = fake_llore(MODELS, bots, ["docs"], quantization=quantization)
+    for name, expected in (("plain", 3), ("threshold", 1)):
+        bot_rag = llore.bots[name].rag
+        assert bot_rag is not None
+        docs = await llore.retrieve(bot_rag, "docs chunk 2")
+        assert len(docs) == expected
+        assert docs[0].page_content == "docs chunk 2"
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("quantization", ["none", "int8"])
+async def test_ingest_by_other_process(
+    fake_llore: Callable[..., Llore], tmp_path: Path, quantization: str
+):
+    """Only the leader worker ingests files, the others pick up the changes"""
+    bot = {
+        "name": "docs",
+        "model": {"name": "m", "params": {}},
+        "rag": {"files": [], "vector_db_collection": "docs", "k": 2},
+    }
+    llore = fake_llore(MODELS, [bot], ["docs"], quantization=quantization)
+    rag = llore.bots["docs"].rag
+    assert rag is not None
+    docs = await llore.retrieve(rag, "docs chunk new")
+    assert "docs chunk new" not in [d.page_content for d in docs]
+    script = tmp_path / "ingest.py"
+    script.write_text(INGEST_SCRIPT)
+    subprocess.run([sys.executable, str(script), str(tmp_path / "config.json")], check=True)
+    docs = await llore.retrieve(rag, "docs chunk new")
+    assert docs[0].page_content == "docs chunk new"
@@ -0,0 +1,71 @@
+import asyncio
+import time
+from collections.abc import Callable
+from functools import partial
+
+import pytest
+
+from botglue.llore.api import ChatMsg
+from botglue.llore.pipeline import Llore
+from botglue.llore.routing import hedge
+from tests.fakes import FakeLLM
+
+
+@pytest.mark.asyncio
+async def test_hedge():
+    async def answer(value: str, delay: float, fail: bool = False) -> str:
+        await asyncio.sleep(delay)
+        if fail:
+            raise ValueError(value)
+        return value
+
+    cancelled: list[str] = []
+
+    async def slow(value: str) -> str:
+        try:
+            return await answer(value, 10)
+        except asyncio.CancelledError:
+            cancelled.append(value)
+            raise
+
+    assert await hedge([partial(answer, "a", 0.01), partial(answer, "b", 0)], [0.2]) == (0, "a")
+    assert await hedge([partial(slow, "a"), partial(answer, "b", 0.01)], [0.05]) == (1, "b")
+    assert cancelled == ["a"]
+    # a failure starts the next call without waiting for the delay
+    start = time.monotonic()
+    calls = [partial(answer, "a", 0, True), partial(answer, "b", 0)]
+    assert await hedge(calls, [5]) == (1, "b")
+    assert time.monotonic() - start < 1
+    with pytest.raises(ValueError, match="a"):
+        await hedge([partial(answer, "a", 0, True), partial(answer, "b", 0.01, True)], [0])
+
+
+@pytest.mark.asyncio
+async def test_hedged_query_llm(fake_llm: FakeLLM, fake_llore: Callable[..., Llore]):
+    fast = FakeLLM()
+    try:
+        fake_llm.delay = 1.0
+        models = {
+            "slow": {
+                "model_name": "slow",
+                "url": fake_llm.url(),
+                "routing": {"alternates": ["fast"], "initial_delay": 0.1},
+            },
+            "fast": {"model_name": "fast", "url": fast.url()},
+            "race": {
+                "model_name": "slow",
+                "url": fake_llm.url(),
+                "routing": {"mode": "race", "alternates": ["fast"]},
+            },
+        }
+        llore = fake_llore(models, [])
+        for name in ("slow", "race"):
+            start = time.monotonic()
+            r = await llore.query_llm(name, [ChatMsg(role="user", content=name)])
+            assert r.generation.content == f"echo: {name}"
+            assert time.monotonic() - start < 0.5
+        assert [r["model"] for r in fast.requests] == ["fast", "fast"]
+        wins = llore.registry.counter("llm_hedge_wins_total")
+        assert wins.get(model="slow", winner="fast", mode="hedge") == 1
+    finally:
+        fast.server.stop()
@@ -1,14 +1,28 @@
 import asyncio
 import json
 import logging
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+import urllib.request
 from collections.abc import Callable
+from pathlib import Path
 from typing import Any
 
 import pytest
 import tornado
+from tornado.httpclient import AsyncHTTPClient, HTTPClientError
 from typing_extensions import override
 
-from botglue.service import BIND_ERRNO, App, AppService, AppState, PortSeekStrategy, get_json
+from botglue import random_port
+from botglue.concurrency import BoundedExecutor, ExecutorBusy, RouteLimit, SingleFlight
+from botglue.deadline import DeadlineExceeded, deadline, remaining_time
+from botglue.httppool import HttpPool, get_json
+from botglue.metrics import MetricsRegistry
+from botglue.service import BIND_ERRNO, App, AppService, AppState, PortSeekStrategy
 
 
 class OkService(AppService[AppState]):
@@ -151,3 +165,371 @@ async def test_value_ex():
         raise AssertionError
     except ValueError as e:
         assert e.args == ("Failed to find an available port after max_attempts", 1)
+
+
+@pytest.mark.asyncio
+async def test_bounded_executor():
+    registry = MetricsRegistry()
+    executor = BoundedExecutor("test", max_workers=2, max_queue=1, registry=registry)
+    release = threading.Event()
+
+    def blocking(n: int) -> int:
+        release.wait(5)
+        return n
+
+    tasks = [asyncio.create_task(executor.run(blocking, i)) for i in range(3)]
+    await asyncio.sleep(0.1)
+    # event loop is not blocked while workers wait
+    assert (executor.active, executor.queued) == (2, 1)
+    assert registry.gauge("executor_queue_depth").get(executor="test") == 1
+    with pytest.raises(ExecutorBusy):
+        await executor.run(blocking, 4)
+    assert registry.counter("executor_rejected_total").get(executor="test") == 1
+    release.set()
+    assert await asyncio.gather(*tasks) == [0, 1, 2]
+    assert (executor.active, executor.queued) == (0, 0)
+    assert registry.histogram("executor_queue_wait_seconds").get(executor="test").count == 3
+    executor.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_executor_deadline():
+    executor = BoundedExecutor("deadline", max_workers=1, registry=MetricsRegistry())
+    called: list[float] = []
+    busy = asyncio.create_task(executor.run(time.sleep, 0.3))
+    with deadline(0.1):
+        late = asyncio.create_task(executor.run(called.append, 1.0))
+    await busy
+    with pytest.raises(DeadlineExceeded):
+        await late
+    assert called == []  # not run once nobody waits for it
+    executor.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_single_flight_deadlines():
+    flights: SingleFlight[float | None] = SingleFlight("deadline", registry=MetricsRegistry())
+    calls = 0
+
+    async def call() -> float | None:
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.5)
+        return remaining_time()
+
+    async def with_deadline(seconds: float | None) -> float | None:
+        with deadline(seconds):
+            return await flights.run("key", call)
+
+    short = asyncio.create_task(with_deadline(0.2))
+    await asyncio.sleep(0.01)
+    start = time.monotonic()
+    # joins the call started under the short deadline, and outlives it
+    assert await with_deadline(None) is None
+    assert time.monotonic() - start > 0.4 and calls == 1
+    with pytest.raises(DeadlineExceeded):
+        await short
+
+
+WORKERS_SCRIPT = """
+import json, os, sys
+import tornado.web
+from botglue.service import App, AppService, AppState
+
+class PidService(AppService[AppState]):
+    def __init__(self, log_path):
+        super().__init__()
+        service = self
+
+        def periodic():
+            with open(log_path, "a") as f:
+                f.write(f"{os.getpid()}\\n")
+
+        class PidHandler(tornado.web.RequestHandler):
+            def get(self):
+                self.write({"pid": os.getpid(), "task_id": service.get_app_state().get_app().task_id})
+
+        self.add_periodic(1, periodic)
+        self.add_route(r"/pid", PidHandler)
+
+port, log_path = int(sys.argv[1]), sys.argv[2]
+App("workers", AppState(PidService(log_path), port=port)).run_workers(3, reuse_port=True)
+"""
+
+
+def test_run_workers(tmp_path: Path):
+    script, log_path = tmp_path / "workers.py", tmp_path / "periodic.log"
+    script.write_text(WORKERS_SCRIPT)
+    port = random_port()
+    proc = subprocess.Popen([sys.executable, str(script), str(port), str(log_path)])
+
+    def get_pid() -> dict[str, int]:
+        for _ in range(100):
+            try:
+                with urllib.request.urlopen(f"http://127.0.0.1:{port}/pid", timeout=1) as r:
+                    return json.loads(r.read())
+            except OSError:
+                time.sleep(0.05)
+        raise AssertionError("workers are not serving")
+
+    try:
+        seen = {r["pid"]: r["task_id"] for r in (get_pid() for _ in range(50))}
+        assert len(seen) > 1 and set(seen.values()) <= {0, 1, 2}
+        time.sleep(1.5)
+        leaders = set(log_path.read_text().split())
+        assert len(leaders) == 1 and int(leaders.pop()) in seen
+
+        # killed leader is restarted with the same task_id and takes over
+        leader = next(pid for pid, task_id in seen.items() if task_id == 0)
+        os.kill(leader, signal.SIGKILL)
+        for _ in range(100):
+            r = get_pid()
+            if r["task_id"] == 0 and r["pid"] != leader:
+                break
+        else:
+            raise AssertionError("leader was not restarted")
+        time.sleep(1.5)
+        assert str(r["pid"]) in log_path.read_text().split()
+
+        proc.send_signal(signal.SIGTERM)
+        assert proc.wait(timeout=10) == 0
+    finally:
+        proc.kill()
+
+
+class SlowService(AppService[AppState]):
+    # handlers cancelled by deadlines and disconnects
+    cancelled: int
+
+    def __init__(self, release: asyncio.Event, **limits: Any):
+        super().__init__()
+        self.cancelled = 0
+        service = self
+
+        class SlowHandler(tornado.web.RequestHandler):
+            @override
+            async def get(self):
+                try:
+                    await release.wait()
+                except asyncio.CancelledError:
+                    service.cancelled += 1
+                    raise
+                self.write({"ok": True})
+
+        self.add_route(r"/slow", SlowHandler, **limits)
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("drain_timeout", [5.0, 0.2])
+async def test_drain(drain_timeout: float):
+    release = asyncio.Event()
+    registry = MetricsRegistry()
+    state = AppState(SlowService(release))
+    app = App("drain", state, drain_timeout=drain_timeout, registry=registry)
+    running = asyncio.create_task(app.run())
+    while not app.is_ready:
+        await asyncio.sleep(0.01)
+    url = f"http://127.0.0.1:{state.port}/slow"
+    client = AsyncHTTPClient(force_instance=True)
+    pending = asyncio.ensure_future(client.fetch(url))
+    while app.in_flight == 0:
+        await asyncio.sleep(0.01)
+
+    app.shutdown()
+    await asyncio.sleep(0.1)
+    assert app.is_draining and not app.is_ready
+    with pytest.raises(OSError):  # new connections are refused
+        await AsyncHTTPClient(force_instance=True).fetch(url.replace("/slow", "/"))
+    if drain_timeout > 1:
+        release.set()
+        assert (await pending).code == 200
+        await running
+        assert registry.counter("app_drained_requests_total").get(app="drain") == 1
+        assert registry.counter("app_aborted_requests_total").get(app="drain") == 0
+    else:
+        await running
+        assert app.in_flight == 1
+        assert registry.counter("app_aborted_requests_total").get(app="drain") == 1
+        release.set()
+        await pending
+    client.close()
+
+
+@pytest.mark.asyncio
+async def test_route_metrics():
+    registry = MetricsRegistry()
+    state = AppState(OkService(), registry=registry)
+    app = App("metrics", state, registry=registry)
+    running = asyncio.create_task(app.run())
+    while not app.is_ready:
+        await asyncio.sleep(0.01)
+    base = f"http://127.0.0.1:{state.port}"
+    try:
+        for _ in range(2):
+            assert (await get_json(f"{base}/status"))["ok"]
+        client = AsyncHTTPClient(force_instance=True)
+        response = await client.fetch(f"{base}/status", method="POST", body="", raise_error=False)
+        assert response.code == 405
+        response = await client.fetch(f"{base}/metrics")
+        client.close()
+    finally:
+        app.shutdown()
+        await running
+    assert response.headers["Content-Type"].startswith("text/plain; version=0.0.4")
+    text = response.body.decode()
+    assert 'http_requests_total{method="GET",route="/status",status="200"} 2' in text
+    assert 'http_requests_total{method="POST",route="/status",status="405"} 1' in text
+    assert 'http_request_seconds_count{method="GET",route="/status"} 2' in text
+    assert 'http_requests_in_flight{route="/status"} 0' in text
+    assert registry.counter("http_requests_total").by("route") == {"/status": 3}
+
+
+@pytest.mark.asyncio
+async def test_route_limit():
+    limit = RouteLimit(max_concurrency=1, max_queue=1)
+    assert await limit.acquire()
+    waiting = asyncio.create_task(limit.acquire())
+    await asyncio.sleep(0)
+    assert limit.queued == 1 and not await limit.acquire()  # queue is full
+    limit.release()  # the slot goes to the waiter
+    assert await waiting and (limit.active, limit.queued) == (1, 0)
+    cancelled = asyncio.create_task(limit.acquire())
+    await asyncio.sleep(0)
+    cancelled.cancel()
+    await asyncio.sleep(0)
+    limit.release()
+    assert (limit.active, limit.queued) == (0, 0)
+
+
+@pytest.mark.asyncio
+async def test_load_shedding():
+    release = asyncio.Event()
+    registry = MetricsRegistry()
+    state = AppState(SlowService(release, max_concurrency=2, max_queue=1), registry=registry)
+    app = App("shedding", state, registry=registry)
+    running = asyncio.create_task(app.run())
+    while not app.is_ready:
+        await asyncio.sleep(0.01)
+    client = AsyncHTTPClient(force_instance=True, max_clients=10)
+    url = f"http://127.0.0.1:{state.port}/slow"
+    try:
+        admitted = [asyncio.ensure_future(client.fetch(url)) for _ in range(3)]
+        while app.in_flight < 3:
+            await asyncio.sleep(0.01)
+        start = time.monotonic()
+        shed = await client.fetch(url, raise_error=False)
+        assert shed.code == 503 and shed.headers["Retry-After"] == "1"
+        assert time.monotonic() - start < 0.5
+        release.set()
+        assert [(await r).code for r in admitted] == [200] * 3
+    finally:
+        client.close()
+        app.shutdown()
+        await running
+    assert registry.counter("http_route_rejected_total").get(route="/slow") == 1
+    assert registry.histogram("http_route_queue_seconds").get(route="/slow").count == 3
+    statuses = registry.counter("http_requests_total").by("status", route="/slow")
+    assert statuses == {"200": 3, "503": 1}
+
+
+class WarmupService(AppService[AppState]):
+    warmed: asyncio.Event
+
+    def __init__(self, warmed: asyncio.Event):
+        super().__init__()
+        self.warmed = warmed
+
+    @override
+    async def warmup(self) -> None:
+        await self.warmed.wait()
+
+
+@pytest.mark.asyncio
+async def test_warmup_readiness():
+    warmed = asyncio.Event()
+    registry = MetricsRegistry()
+    state = AppState(OkService(), WarmupService(warmed), registry=registry)
+    app = App("warmup", state, registry=registry)
+    running = asyncio.create_task(app.run())
+    while not app.is_running:
+        await asyncio.sleep(0.01)
+    client = AsyncHTTPClient(force_instance=True)
+    base = f"http://127.0.0.1:{state.port}"
+    try:
+        assert (await client.fetch(f"{base}/healthz")).code == 200
+        not_ready = await client.fetch(f"{base}/readyz", raise_error=False)
+        assert not_ready.code == 503 and json.loads(not_ready.body) == {"ready": False}
+        # requests are served while warming up
+        assert (await get_json(f"{base}/status"))["ok"]
+        warmed.set()
+        await asyncio.sleep(0.05)
+        assert (await client.fetch(f"{base}/readyz")).code == 200
+        assert registry.gauge("app_warmup_seconds").get(app="warmup") > 0
+    finally:
+        client.close()
+        app.shutdown()
+        await running
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("tcp", [True, False])
+async def test_unix_socket(tmp_path: Path, tcp: bool):
+    path = tmp_path / "app.sock"
+    registry = MetricsRegistry()
+    state = AppState(OkService(), unix_socket=path, tcp=tcp, registry=registry)
+    app = App("unix", state, registry=registry)
+    running = asyncio.create_task(app.run())
+    while not app.is_running:
+        await asyncio.sleep(0.01)
+    pool = HttpPool("unix", unix_socket=path, registry=registry)
+    try:
+        assert path.is_socket()
+        # the host is not resolved, only sent in the Host header
+        assert (await get_json("http://llore/status", unix_socket=path))["ok"]
+        assert (await get_json("http://localhost/status", pool=pool))["ok"]
+        assert bool(state.sockets) == tcp
+        if tcp:
+            assert (await get_json(f"http://127.0.0.1:{state.port}/status"))["ok"]
+    finally:
+        pool.close()
+        app.shutdown()
+        await running
+    assert not path.exists()
+    assert registry.counter("http_requests_total").by("status", route="/status") == {
+        "200": 3 if tcp else 2
+    }
+
+
+@pytest.mark.asyncio
+async def test_deadlines_and_disconnects():
+    release = asyncio.Event()
+    registry = MetricsRegistry()
+    service = SlowService(release, timeout=2.0)
+    state = AppState(service, registry=registry)
+    app = App("deadlines", state, registry=registry)
+    running = asyncio.create_task(app.run())
+    while not app.is_ready:
+        await asyncio.sleep(0.01)
+    url = f"http://127.0.0.1:{state.port}/slow"
+    client = AsyncHTTPClient(force_instance=True)
+    try:
+        start = time.monotonic()
+        headers = {"X-Request-Timeout": "0.2"}
+        response = await client.fetch(url, headers=headers, raise_error=False)
+        assert response.code == 504 and b"Deadline" in response.body
+        assert time.monotonic() - start < 1 and service.cancelled == 1
+
+        # client gives up, the handler is cancelled too
+        with pytest.raises(HTTPClientError):
+            await client.fetch(url, request_timeout=0.2)
+        for _ in range(100):
+            if service.cancelled >= 2:
+                break
+            await asyncio.sleep(0.01)
+        assert service.cancelled == 2 and app.in_flight == 0
+    finally:
+        client.close()
+        app.shutdown()
+        await running
+    statuses = registry.counter("http_requests_total").by("status", route="/slow")
+    assert statuses == {"504": 1, "499": 1}
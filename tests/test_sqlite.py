@@ -63,12 +63,17 @@ def test_sqlite_db(caplog: pytest.LogCaptureFixture):
     extract = tuple(search_caplog(caplog, "execute: ", category="llore.state"))
     print(extract)
     assert extract == (
+        "SELECT name FROM sqlite_master WHERE type='table' ",
         "CREATE TABLE RagSource (source_id INTEGER PRIMARY KEY, absolute_path TEXT)",
         "CREATE TABLE RagAction (action_id INTEGER PRIMARY KEY, source_id INTEGER REFERENCES RagSource(source_id), timestamp TEXT, n_chunks INTEGER, error TEXT NULL, sha256 TEXT)",
         "CREATE TABLE RagActionCollection (action_id INTEGER REFERENCES RagAction(action_id), action TEXT, collection TEXT, timestamp TEXT)",
         "CREATE TABLE ConvoMessage (role TEXT, content TEXT, finish_reason TEXT, message_id INTEGER PRIMARY KEY, session_id INTEGER REFERENCES ConvoSession(session_id), captured TEXT)",
         "CREATE TABLE ConvoSession (session_id INTEGER PRIMARY KEY, created TEXT, updated TEXT, model TEXT, user_id TEXT NULL, session_type TEXT)",
+        "CREATE TABLE LlmResponse (cache_key TEXT PRIMARY KEY, model TEXT, created TEXT, accessed TEXT, expires TEXT, hits INTEGER, body TEXT)",
     )
+    caplog.clear()
+    create_schema(test_db_path)  # only missing tables are created
+    assert not any(m.startswith("CREATE") for m in search_caplog(caplog, "execute: "))
 
 
 def test_add_attempt():
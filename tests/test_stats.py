@@ -0,0 +1,41 @@
+from collections.abc import Callable
+
+import pytest
+from tornado.httpclient import HTTPClientError
+
+from botglue.llore.config import LLMModelConfig
+from tests.fakes import MESSAGES, FakeLLM
+
+
+@pytest.mark.asyncio
+async def test_model_stats(fake_llm: FakeLLM, llm_config: Callable[..., LLMModelConfig]):
+    llm = llm_config(
+        model_name="stats",
+        url=fake_llm.url(),
+        replicas={"retries": 0},
+        params={"stream_options": {"include_usage": True}},
+    )
+    fake_llm.chunk_delay = 0.05
+    for _ in range(2):
+        await llm.query(MESSAGES)
+    chunks = [c async for c in llm.query_stream(MESSAGES)]
+    assert chunks[-1].done
+    fake_llm.status = 500
+    with pytest.raises(HTTPClientError):
+        await llm.query(MESSAGES)
+
+    stats = llm.metrics.model_stats("stats")
+    assert stats["requests"] == 4 and stats["errors"] == {"http_5xx": 1}
+    assert stats["latency"]["count"] == 3 and stats["ttfb"]["count"] == 4
+    assert stats["ttft"]["count"] == 1
+    # the first of two chunks is sent right away, the generation takes longer
+    assert stats["ttft"]["mean"] < 0.05 < stats["latency"]["p99"]
+    # the usage chunk follows the end of the streamed generation
+    assert stats["tokens"] == {"prompt": 9, "completion": 6}
+    assert stats["completion_tokens_per_second"] > 0
+
+    ollama = llm_config(model_name="stats", url=fake_llm.url("ollama"))
+    fake_llm.status = 200
+    chunks = [c async for c in ollama.query_stream(MESSAGES)]
+    assert "".join(c.delta for c in chunks) == "echo: hello " and chunks[-1].done
+    assert ollama.metrics.model_stats("stats")["tokens"] == {"prompt": 3, "completion": 2}
@@ -0,0 +1,137 @@
+import asyncio
+import json
+import logging
+import time
+from pathlib import Path
+
+import pytest
+from tornado.httpclient import AsyncHTTPClient, HTTPClientError, HTTPRequest
+
+from botglue.httppool import fetch_lines
+from botglue.llore.api import ChatChunk, ChatRequest
+from botglue.llore.config import LLMModelConfig
+from botglue.llore.server import LloreService, LloreState
+from botglue.metrics import MetricsRegistry
+from botglue.service import App
+from tests.fakes import FakeLLM, write_llore_config
+
+MESSAGES = [{"role": "user", "content": "hello streaming world"}]
+
+
+async def collect(llm: LLMModelConfig) -> list[tuple[float, ChatChunk]]:
+    start = time.monotonic()
+    return [(time.monotonic() - start, c) async for c in llm.query_stream(MESSAGES)]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("shape", ["openai", "ollama"])
+async def test_query_stream(fake_llm: FakeLLM, shape: str):
+    fake_llm.chunk_delay = 0.1
+    llm = LLMModelConfig(model_name="m", url=fake_llm.url(shape))
+    chunks = await collect(llm)
+    assert fake_llm.requests[0]["stream"] is True
+    assert "".join(c.delta for _, c in chunks) == "echo: hello streaming world "
+    assert chunks[-1][1].done and not chunks[0][1].done
+    # first token arrives long before the generation is over
+    assert chunks[0][0] < 0.1 < chunks[-1][0] - chunks[0][0]
+
+
+@pytest.mark.asyncio
+async def test_query_stream_fallbacks(fake_llm: FakeLLM):
+    fake_llm.ignore_stream = True
+    llm = LLMModelConfig(model_name="m", url=fake_llm.url("ollama"))
+    chunks = [c for _, c in await collect(llm)]
+    assert [(c.delta, c.done) for c in chunks] == [("echo: hello streaming world", True)]
+    fake_llm.status = 500
+    with pytest.raises(HTTPClientError) as e:
+        await collect(llm)
+    assert e.value.code == 500
+    assert "fake error" in str(e.value.message)
+
+
+@pytest.mark.asyncio
+async def test_chats_stream(fake_llm: FakeLLM, tmp_path: Path):
+    models = {"fake": {"model_name": "m", "url": fake_llm.url()}}
+    config_path = write_llore_config(tmp_path, models, [])
+    state = LloreState(LloreService(), config_path=config_path)
+    app = App("test", state)
+    running = asyncio.create_task(app.run())
+    await asyncio.sleep(0.1)
+    request = ChatRequest(llm_name="fake", messages=MESSAGES, stream=True)  # pyright: ignore[reportArgumentType]
+    lines = fetch_lines(
+        HTTPRequest(
+            f"http://localhost:{state.port}/chats",
+            method="POST",
+            body=request.model_dump_json(),
+        )
+    )
+    chunks = [ChatChunk.model_validate_json(line) async for line in lines if line]
+    app.shutdown()
+    await running
+    assert "".join(c.delta for c in chunks) == "echo: hello streaming world "
+    assert chunks[-1].done
+
+
+@pytest.mark.asyncio
+async def test_chats_server_timing(
+    fake_llm: FakeLLM, tmp_path: Path, caplog: pytest.LogCaptureFixture
+):
+    fake_llm.delay = 0.1
+    models = {"timed": {"model_name": "m", "url": fake_llm.url()}}
+    config_path = write_llore_config(tmp_path, models, [])
+    state = LloreState(LloreService(), config_path=config_path, log_timings=True)
+    app = App("timing", state)
+    running = asyncio.create_task(app.run())
+    while not app.is_ready:
+        await asyncio.sleep(0.01)
+    client = AsyncHTTPClient(force_instance=True)
+    url = f"http://localhost:{state.port}/chats"
+    try:
+        headers: dict[str, dict[str, float]] = {}
+        for stream in (False, True):
+            request = ChatRequest(llm_name="timed", messages=MESSAGES, stream=stream)  # pyright: ignore[reportArgumentType]
+            with caplog.at_level(logging.INFO, logger="botglue.timing"):
+                response = await client.fetch(url, method="POST", body=request.model_dump_json())
+            headers[str(stream)] = {
+                name: float(dur.removeprefix("dur="))
+                for name, dur in (
+                    v.split(";") for v in response.headers["Server-Timing"].split(", ")
+                )
+            }
+    finally:
+        client.close()
+        app.shutdown()
+        await running
+    spans = headers["False"]
+    assert {"validate", "history", "pool_wait", "upstream", "llm", "serialize"} <= set(spans)
+    assert spans["upstream"] >= 100 and spans["total"] >= spans["llm"] >= spans["upstream"]
+    # streamed headers go out with the first chunk, before the generation is done
+    assert "serialize" not in headers["True"] and "history" in headers["True"]
+    logged = [json.loads(r.message) for r in caplog.records if r.name == "botglue.timing"]
+    assert [(e["route"], e["status"]) for e in logged] == [("/chats", 200)] * 2
+    assert logged[0]["spans"]["llm"] >= 0.1
+
+
+@pytest.mark.asyncio
+async def test_chats_rate_limited(fake_llm: FakeLLM, tmp_path: Path):
+    rate_limit = {"requests_per_second": 0.5, "max_queue": 0}
+    models = {"slow": {"model_name": "m", "url": fake_llm.url(), "rate_limit": rate_limit}}
+    registry = MetricsRegistry()
+    config_path = write_llore_config(tmp_path, models, [])
+    state = LloreState(LloreService(), config_path=config_path, registry=registry)
+    app = App("rate", state, registry=registry)
+    running = asyncio.create_task(app.run())
+    while not app.is_ready:
+        await asyncio.sleep(0.01)
+    client = AsyncHTTPClient(force_instance=True)
+    body = ChatRequest(llm_name="slow", messages=MESSAGES).model_dump_json()  # pyright: ignore[reportArgumentType]
+    url = f"http://localhost:{state.port}/chats"
+    try:
+        assert (await client.fetch(url, method="POST", body=body)).code == 200
+        response = await client.fetch(url, method="POST", body=body, raise_error=False)
+        # the bucket refills one request in 2 seconds
+        assert response.code == 429 and response.headers["Retry-After"] == "2"
+    finally:
+        client.close()
+        app.shutdown()
+        await running
@@ -0,0 +1,32 @@
+import asyncio
+import time
+
+import pytest
+
+from botglue.metrics import MetricsRegistry
+from botglue.watchdog import LoopMonitor
+
+
+def blocking_function():
+    time.sleep(0.5)
+
+
+@pytest.mark.asyncio
+async def test_loop_monitor():
+    registry = MetricsRegistry()
+    monitor = LoopMonitor("test", interval=0.05, threshold=0.2, registry=registry)
+    monitor.start()
+    try:
+        await asyncio.sleep(0.2)
+        assert not monitor.blocked
+        blocking_function()
+        await asyncio.sleep(0.1)
+    finally:
+        monitor.stop()
+    assert len(monitor.blocked) == 1
+    blocked = monitor.blocked[0]
+    assert "blocking_function" in blocked.stack and "time.sleep(0.5)" in blocked.stack
+    assert blocked.seconds is not None and 0.4 < blocked.seconds < 0.7
+    assert registry.counter("event_loop_blocked_total").get(app="test") == 1
+    lag = registry.histogram("event_loop_lag_seconds").get(app="test")
+    assert lag.count > 4 and lag.quantile(1.0) >= 0.25